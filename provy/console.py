@@ -25,6 +25,16 @@ class Messages(object):
     recursive option."""
     password = """Password to use for authentication with servers.
     If passwords differ from server to server this does not work."""
+    refresh_facts = """Ignore the server facts (distribution, logged user,
+    hostname, CPUs, memory) kept from previous runs and gather them again."""
+    record = """Record every command run in the servers, with its output and
+    latency, to the given file."""
+    replay = """Answer the commands with the results recorded in the given
+    file, instead of connecting to the servers."""
+    replay_latency = """When replaying, wait for the recorded latency of each
+    command."""
+    stats = """Show how many calls each role made to the servers, and how long
+    they took."""
 
 
 def __get_extra_options():
@@ -44,6 +54,18 @@ def __get_arguments():
     parser.add_option("-s", "--server", dest="server", help=Messages.server)
     parser.add_option("-p", "--password", dest="password", default=None,
                       help=Messages.password)
+    parser.add_option("--refresh-facts", dest="refresh_facts",
+                      action="store_true", default=False,
+                      help=Messages.refresh_facts)
+    parser.add_option("--record", dest="record", default=None,
+                      help=Messages.record)
+    parser.add_option("--replay", dest="replay", default=None,
+                      help=Messages.replay)
+    parser.add_option("--replay-latency", dest="replay_latency",
+                      action="store_true", default=False,
+                      help=Messages.replay_latency)
+    parser.add_option("--stats", dest="stats", action="store_true",
+                      default=False, help=Messages.stats)
 
     (options, args) = parser.parse_args()
 
@@ -71,7 +93,10 @@ def main():
         print "\nInfo: Provy is running using the 'test' set of servers.\n"
         options.server = 'test'
 
-    run(provyfile_path, options.server, options.password, extra_options)
+    run(provyfile_path, options.server, options.password, extra_options,
+        refresh_facts=options.refresh_facts, record=options.record,
+        replay=options.replay, replay_latency=options.replay_latency,
+        stats=options.stats)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for the provy agent, a small python helper that is uploaded once to each server and answers file and stat queries over a single long-lived channel.
+
+The agent is enabled per server, with the ``agent`` key in the ``servers`` dictionary:
+::
+
+    servers = {
+        'frontend': {
+            'address': '33.33.33.33',
+            'user': 'vagrant',
+            'agent': True,
+            'roles': [
+                FrontEnd
+            ]
+        }
+    }
+
+When enabled, :class:`Role <provy.core.roles.Role>` methods like :meth:`remote_exists <provy.core.roles.Role.remote_exists>` or :meth:`md5_remote <provy.core.roles.Role.md5_remote>` become calls to the agent instead of new remote processes.
+'''
+
+import inspect
+import json
+import uuid
+from StringIO import StringIO
+
+import fabric.api
+
+from provy.core import agent_script
+from provy.core.channels import RemoteChannel
+from provy.core.errors import RemoteAgentError
+
+
+IO_ERRORS = ('IOError', 'OSError', 'FileNotFoundError', 'PermissionError')
+
+
+def agent_source():
+    return inspect.getsource(agent_script)
+
+
+class RemoteAgent(object):
+    '''
+    Client for the provy agent running in the current server.
+
+    The agent is uploaded and started (as the super-user) on the first call, and removes its own script from the server as soon as it is running.
+    '''
+    def __init__(self):
+        self.channel = None
+
+    def start(self):
+        script_path = '.provy-agent-%s.py' % uuid.uuid4().hex
+        with fabric.api.settings(fabric.api.hide('warnings', 'running', 'stdout', 'stderr')):
+            fabric.api.put(StringIO(agent_source()), script_path)
+        self.channel = RemoteChannel('python %s --remove' % script_path, sudo=True).open()
+
+    def call(self, operation, **arguments):
+        '''
+        Runs an operation in the agent and returns its result.
+
+        :param operation: Name of the operation, as listed in :data:`provy.core.agent_script.OPERATIONS`.
+        :type operation: :class:`str`
+
+        :return: The operation result.
+
+        :raise: :class:`IOError` if the operation failed with an I/O error in the server, :class:`RemoteAgentError <provy.core.errors.RemoteAgentError>` for any other failure.
+        '''
+        if self.channel is None:
+            self.start()
+
+        data = json.dumps({'operation': operation, 'arguments': arguments})
+        self.channel.write('%d\n%s' % (len(data), data))
+        header = self.channel.readline()
+        response = json.loads(self.channel.read(int(header)))
+
+        if not response['ok']:
+            if response['type'] in IO_ERRORS:
+                raise IOError(response['error'])
+            raise RemoteAgentError('%s: %s' % (response['type'], response['error']))
+        return response['result']
+
+    def close(self):
+        '''
+        Stops the agent, if it was started.
+        '''
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+The provy agent that runs in the remote server.
+
+This module is not imported by provy itself: its source is uploaded to the remote server by :class:`RemoteAgent <provy.core.agent.RemoteAgent>` and executed there with whatever python is available, so it must keep working with both python 2 and python 3 and must only use the standard library.
+
+Requests and responses are JSON documents, each one preceded by a line holding its length in bytes.
+'''
+
+import codecs
+import grp
+import hashlib
+import json
+import os
+import pwd
+import stat
+import struct
+import sys
+import tempfile
+import zlib
+
+COPY_CHUNK = 65536
+
+
+def exists(path):
+    return os.path.isfile(path)
+
+
+def exists_dir(path):
+    return os.path.isdir(path)
+
+
+def md5(path):
+    if not os.path.isfile(path):
+        return None
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def md5_files(paths):
+    return dict((path, md5(path)) for path in paths)
+
+
+def manifest(directory):
+    files = {}
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            files[os.path.relpath(path, directory)] = [stat.st_size, int('%o' % (stat.st_mode & 0o7777)), md5(path)]
+    return files
+
+
+def mode(path):
+    if not os.path.exists(path):
+        raise IOError('The file at path %s does not exist' % path)
+    return int('%o' % (os.stat(path).st_mode & 0o7777))
+
+
+def user_name(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return 'UNKNOWN'
+
+
+def group_name(gid):
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return 'UNKNOWN'
+
+
+def stat_paths(paths, hashes=False):
+    # Same fields as provy.core.pathinfo.stat_command prints.
+    results = []
+    for path in paths:
+        try:
+            info = os.lstat(path)
+        except OSError:
+            results.append(None)
+            continue
+        target = os.readlink(path) if stat.S_ISLNK(info.st_mode) else ''
+        results.append([
+            '%x' % info.st_mode, '%o' % (info.st_mode & 0o7777), info.st_uid, info.st_gid, user_name(info.st_uid), group_name(info.st_gid),
+            info.st_size, int(info.st_mtime), (md5(path) or '') if hashes else '', target,
+        ])
+    return results
+
+
+def list_directory(path):
+    return os.listdir(path)
+
+
+def read(path, encoding='utf-8'):
+    with codecs.open(path, 'r', encoding) as f:
+        return f.read()
+
+
+def temp_dir():
+    return tempfile.gettempdir()
+
+
+def signatures(path, block_size):
+    if not os.path.isfile(path):
+        return None
+    blocks = []
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            blocks.append([zlib.adler32(block) & 0xffffffff, hashlib.md5(block).hexdigest()])
+    return blocks
+
+
+def read_chunks(f, size):
+    while size > 0:
+        chunk = f.read(min(size, COPY_CHUNK))
+        if not chunk:
+            break
+        size -= len(chunk)
+        yield chunk
+
+
+def apply_delta(basis, delta, block_size):
+    while True:
+        operation = delta.read(1)
+        if not operation:
+            break
+        if operation == b'C':
+            start, count = struct.unpack('>II', delta.read(8))
+            basis.seek(start * block_size)
+            for chunk in read_chunks(basis, count * block_size):
+                yield chunk
+        else:
+            size = struct.unpack('>I', delta.read(4))[0]
+            for chunk in read_chunks(delta, size):
+                yield chunk
+
+
+def patch(path, delta_path, block_size, md5):
+    path = os.path.realpath(path)
+    temp_path = '%s.provy-%d' % (path, os.getpid())
+    try:
+        digest = hashlib.md5()
+        with open(path, 'rb') as basis:
+            with open(delta_path, 'rb') as delta:
+                with open(temp_path, 'wb') as target:
+                    for chunk in apply_delta(basis, delta, block_size):
+                        digest.update(chunk)
+                        target.write(chunk)
+        if digest.hexdigest() != md5:
+            raise IOError('The patched file at %s does not match the local one' % path)
+        stat = os.stat(path)
+        os.chmod(temp_path, stat.st_mode & 0o7777)
+        os.chown(temp_path, stat.st_uid, stat.st_gid)
+        os.rename(temp_path, path)
+    finally:
+        os.remove(delta_path)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+OPERATIONS = {
+    'exists': exists,
+    'exists_dir': exists_dir,
+    'md5': md5,
+    'md5_files': md5_files,
+    'manifest': manifest,
+    'mode': mode,
+    'list_directory': list_directory,
+    'stat': stat_paths,
+    'read': read,
+    'temp_dir': temp_dir,
+    'signatures': signatures,
+    'patch': patch,
+}
+
+
+def handle(request):
+    try:
+        operation = OPERATIONS[request['operation']]
+        arguments = dict((str(key), value) for key, value in request.get('arguments', {}).items())
+        return {'ok': True, 'result': operation(**arguments)}
+    except Exception as e:
+        return {'ok': False, 'error': str(e), 'type': e.__class__.__name__}
+
+
+def read_frame(stream):
+    header = stream.readline()
+    if not header.strip():
+        return None
+    return json.loads(stream.read(int(header)).decode('utf-8'))
+
+
+def write_frame(stream, document):
+    data = json.dumps(document).encode('utf-8')
+    stream.write(('%d\n' % len(data)).encode('ascii'))
+    stream.write(data)
+    stream.flush()
+
+
+def serve(stdin, stdout):
+    while True:
+        request = read_frame(stdin)
+        if request is None:
+            break
+        write_frame(stdout, handle(request))
+
+
+def main():
+    if '--remove' in sys.argv[1:]:
+        os.remove(sys.argv[0])
+    serve(getattr(sys.stdin, 'buffer', sys.stdin), getattr(sys.stdout, 'buffer', sys.stdout))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for commands that keep running in the remote server while provy goes on with the provisioning.
+
+It's recommended not to use this module directly in your roles; use :meth:`Role.execute_async <provy.core.roles.Role.execute_async>` instead.
+'''
+
+from pipes import quote
+
+from fabric.utils import error
+
+
+LOST = -1
+
+
+class BackgroundCommand(object):
+    '''
+    Handle for a command started with :meth:`Role.execute_async <provy.core.roles.Role.execute_async>`.
+
+    The command runs detached from the SSH connection (with ``nohup``), and keeps its process id, its output and, when it finishes, its exit code in files under ``directory``.
+
+    :param role: The role that started the command, used to run the checks in the server.
+    :type role: :class:`Role <provy.core.roles.Role>`
+    :param command: The command being run.
+    :type command: :class:`str`
+    :param directory: Remote directory where the command keeps its files.
+    :type directory: :class:`str`
+    :param sudo: Whether the command runs as the super-user.
+    :type sudo: :class:`bool`
+    :param user: The user the command runs as, if any.
+    :type user: :class:`str`
+    '''
+    def __init__(self, role, command, directory, sudo=False, user=None):
+        self.role = role
+        self.command = command
+        self.directory = directory
+        self.sudo = sudo
+        self.user = user
+        self.return_code = None
+
+    def path(self, name):
+        return '%s/%s' % (self.directory, name)
+
+    def start_command(self):
+        # The exit code is moved into place once written, so that the status file is never seen empty.
+        detached = '( %s ) > %s 2>&1; echo $? > %s && mv %s %s' % (
+            self.command, self.path('log'), self.path('status.tmp'), self.path('status.tmp'), self.path('status'))
+        return 'mkdir -p %s && { nohup sh -c %s > /dev/null 2>&1 < /dev/null & echo $! > %s; }' % (
+            self.directory, quote(detached), self.path('pid'))
+
+    def start(self):
+        '''
+        Starts the command in the server.
+
+        :return: The handle itself, so that it can be chained.
+        :rtype: :class:`BackgroundCommand`
+        '''
+        self.__run(self.start_command())
+        return self
+
+    def __run(self, command):
+        return self.role.execute(command, stdout=False, sudo=self.sudo, user=self.user)
+
+    @property
+    def done(self):
+        return self.return_code is not None
+
+    def poll(self):
+        '''
+        Checks, without waiting, whether the command finished.
+
+        :return: :data:`None` if the command is still running; otherwise its exit code, or ``-1`` if it was killed before it could report one.
+        :rtype: :class:`int`
+        '''
+        if not self.done:
+            status = self.__run('cat {status} 2>/dev/null || (kill -0 $(cat {pid}) 2>/dev/null && echo running) || echo {lost}'.format(
+                status=self.path('status'), pid=self.path('pid'), lost=LOST)).strip()
+            if status != 'running':
+                self.return_code = int(status)
+        return self.return_code
+
+    def wait(self, interval=1):
+        '''
+        Waits (in the server, with a single command) until the command finishes.
+
+        Just like :meth:`Role.execute <provy.core.roles.Role.execute>`, aborts if the exit code is not zero, unless fabric's ``warn_only`` setting is on.
+
+        :param interval: Seconds between checks in the server. Defaults to ``1``.
+        :type interval: :class:`int`
+
+        :return: The exit code of the command.
+        :rtype: :class:`int`
+        '''
+        if not self.done:
+            status = self.__run('while [ ! -f {status} ] && kill -0 $(cat {pid}) 2>/dev/null; do sleep {interval}; done; cat {status} 2>/dev/null || echo {lost}'.format(
+                status=self.path('status'), pid=self.path('pid'), interval=interval, lost=LOST))
+            self.return_code = int(status.strip())
+            if self.return_code != 0:
+                error("execute_async() received nonzero return code %s while executing!\n\nRequested: %s" % (self.return_code, self.command),
+                      stdout=self.output())
+        return self.return_code
+
+    def output(self):
+        '''
+        Returns the output (both standard output and error) written by the command so far.
+
+        :rtype: :class:`str`
+        '''
+        return self.__run('cat %s 2>/dev/null; true' % self.path('log'))
+
+
+def wait_for_background(context):
+    '''
+    Waits for all the commands started in the server with :meth:`Role.execute_async <provy.core.roles.Role.execute_async>` that are not done yet.
+    '''
+    for command in context.get('background', []):
+        command.wait()
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for deferring commands that change the remote server, so that many of them can be sent at once.
+
+Mutations are queued either inside a :meth:`Role.batch <provy.core.roles.Role.batch>` block, or, for the base :class:`Role <provy.core.roles.Role>` helpers (like :meth:`ensure_dir <provy.core.roles.Role.ensure_dir>` or :meth:`change_path_owner <provy.core.roles.Role.change_path_owner>`), automatically for servers with the ``batch`` key in the ``servers`` dictionary:
+::
+
+    servers = {
+        'frontend': {
+            'address': '33.33.33.33',
+            'user': 'vagrant',
+            'batch': True,
+            'roles': [
+                FrontEnd
+            ]
+        }
+    }
+
+The queue is flushed as a single ``set -e`` shell script whenever something may depend on it: a query over a path that a queued command touches, any other command, a file upload, or the end of the provisioning. Each command runs in the script with fabric's ``cd``, ``prefix``, ``path`` and ``shell_env`` context managers that were in effect when it was queued.
+'''
+
+import posixpath
+import re
+import uuid
+from pipes import quote
+
+import fabric.api
+from fabric.operations import _prefix_commands, _prefix_env_vars
+from fabric.utils import error
+
+
+def paths_overlap(path, other):
+    '''
+    Returns :data:`True` if one of the paths is the other one or contains it. Relative paths are considered to overlap with anything.
+    '''
+    if not posixpath.isabs(path) or not posixpath.isabs(other):
+        return True
+    path = posixpath.normpath(path).rstrip('/') + '/'
+    other = posixpath.normpath(other).rstrip('/') + '/'
+    return path.startswith(other) or other.startswith(path)
+
+
+class PendingResult(object):
+    '''
+    Result of a command that was queued to run later.
+
+    Until the queue is flushed, :attr:`done` is :data:`False`; afterwards, :attr:`output`, :attr:`return_code`, :attr:`succeeded` and :attr:`failed` hold the command results. If a previous command in the same flush failed, the command doesn't run and :attr:`return_code` stays :data:`None`.
+    '''
+    def __init__(self, command):
+        self.command = command
+        self.done = False
+        self.output = None
+        self.return_code = None
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    @property
+    def failed(self):
+        return self.return_code is not None and self.return_code != 0
+
+    def __str__(self):
+        return self.output or ''
+
+
+class Mutation(object):
+    def __init__(self, command, sudo, user, paths, warn_only):
+        self.command = command
+        self.full_command = _prefix_env_vars(_prefix_commands(command, 'remote'))
+        self.sudo = sudo or (user is not None)
+        self.user = user
+        self.paths = paths
+        self.warn_only = warn_only
+        self.result = PendingResult(command)
+
+
+class MutationQueue(object):
+    '''
+    Queue of commands waiting to be run in the current server.
+
+    :param automatic: Whether the base :class:`Role <provy.core.roles.Role>` helpers should queue their changes even outside a :meth:`Role.batch <provy.core.roles.Role.batch>` block. Defaults to :data:`False`.
+    :type automatic: :class:`bool`
+    '''
+    def __init__(self, automatic=False):
+        self.automatic = automatic
+        self.deferring = 0
+        self.pending = []
+
+    @property
+    def active(self):
+        '''
+        Whether mutations are being queued right now.
+        '''
+        return self.automatic or self.deferring > 0
+
+    def add(self, command, sudo=False, user=None, paths=None):
+        '''
+        Queues a command, along with fabric's ``cd``, ``prefix``, ``path`` and ``shell_env`` context managers in effect.
+
+        :param paths: Remote paths changed by the command. Defaults to :data:`None`, which means the command may change anything.
+        :type paths: :class:`list`
+
+        :return: The result that will be filled when the queue is flushed.
+        :rtype: :class:`PendingResult`
+        '''
+        mutation = Mutation(command, sudo, user, paths, fabric.api.env.warn_only)
+        self.pending.append(mutation)
+        return mutation.result
+
+    def depends_on(self, paths):
+        '''
+        Returns :data:`True` if any queued command may change one of the given paths.
+        '''
+        for mutation in self.pending:
+            if mutation.paths is None:
+                return True
+            for path in paths:
+                for changed_path in mutation.paths:
+                    if paths_overlap(path, changed_path):
+                        return True
+        return False
+
+    def build_script(self, marker, sudo):
+        lines = ['set -e']
+        for index, mutation in enumerate(self.pending):
+            command = mutation.full_command
+            if mutation.user is not None:
+                command = 'sudo -u %s sh -c %s' % (quote(mutation.user), quote(command))
+            elif sudo and not mutation.sudo:
+                command = 'sudo -u "$SUDO_USER" sh -c %s' % quote(command)
+            lines.append("printf '%s %d\\n'" % (marker, index))
+            lines.append('code=0; ( %s ) || code=$?' % command)
+            lines.append("printf '\\n%s %d %%d\\n' $code" % (marker, index))
+            if not mutation.warn_only:
+                lines.append('[ $code -eq 0 ] || exit $code')
+        return '\n'.join(lines)
+
+    def flush(self, run):
+        '''
+        Runs all the queued commands as a single shell script and fills their results.
+
+        If any command needs the super-user (or another user), the whole script runs as the super-user, and the other commands run as the logged user.
+
+        :param run: Callable that runs a shell command in the server (with the ``sudo`` keyword argument), returning its output.
+        :type run: callable
+        '''
+        if not self.pending:
+            return
+
+        marker = 'provy-batch-%s' % uuid.uuid4().hex
+        sudo = any(mutation.sudo for mutation in self.pending)
+        script = self.build_script(marker, sudo)
+        mutations, self.pending = self.pending, []
+
+        output = run('sh -c %s' % quote(script), sudo=sudo)
+        self.fill_results(mutations, marker, output)
+
+        for mutation in mutations:
+            if mutation.result.failed and not mutation.warn_only:
+                error("Queued command received nonzero return code %s while executing!\n\nRequested: %s" % (mutation.result.return_code, mutation.command),
+                      stdout=mutation.result.output)
+
+    def fill_results(self, mutations, marker, output):
+        pattern = re.compile(r'^%s (\d+)(?: (\d+))?\r?$' % marker, re.MULTILINE)
+        start = {}
+        for match in pattern.finditer(output):
+            index = int(match.group(1))
+            if match.group(2) is None:
+                start[index] = match.end()
+                continue
+            result = mutations[index].result
+            result.output = output[start.get(index, match.start()):match.start()].strip()
+            result.return_code = int(match.group(2))
+        for mutation in mutations:
+            mutation.result.done = True
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for the content-addressed cache of uploaded files kept in each server.
+
+When enabled for a server (with the ``blob_cache`` key in the ``servers`` dictionary), every file uploaded with :meth:`Role.put_file <provy.core.roles.Role.put_file>` is also kept in a directory in the server (:data:`DEFAULT_BLOB_DIR`, by default), named after the sha256 hash of its contents. Uploading the same contents again - in the same run or in any later one - becomes a copy inside the server instead of a transfer; like any other change, that copy is queued when the server is in batch mode.
+
+The uploaded files are added to the cache with a single command per server, at the end of its provisioning (or earlier, along with the first copy that needs them). The cache directory is only readable by the super-user, so the copies are always made by the super-user - but the copied files get the same owner an upload would give them, and files uploaded without ``sudo`` are only copied if the logged user can write them.
+'''
+
+import hashlib
+import uuid
+from pipes import quote
+
+
+DEFAULT_BLOB_DIR = '/var/cache/provy/blobs'
+
+
+def payload_digest(data):
+    '''
+    Returns the sha256 hash of a local file (given by its path) or of an in-memory file object, or :data:`None` if it can't be known without consuming ``data``.
+    '''
+    digest = hashlib.sha256()
+    if isinstance(data, basestring):
+        try:
+            with open(data, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), ''):
+                    digest.update(chunk)
+        except IOError:
+            return None
+    elif hasattr(data, 'getvalue'):
+        digest.update(data.getvalue())
+    else:
+        return None
+    return digest.hexdigest()
+
+
+class BlobCache(object):
+    '''
+    The cache of uploaded files in a server.
+
+    :param directory: Remote directory where the files are kept. Defaults to :data:`DEFAULT_BLOB_DIR`.
+    :type directory: :class:`str`
+    '''
+    def __init__(self, directory=DEFAULT_BLOB_DIR):
+        self.directory = directory
+        self.blobs = None
+        self.pending = {}
+        self.run = None
+
+    def path(self, digest):
+        return '%s/%s' % (self.directory, digest)
+
+    def contains(self, digest, run):
+        '''
+        Returns :data:`True` if the contents with the given hash are in the cache (or will be, once the pending uploads are stored). The cached hashes are listed, with ``run``, the first time.
+        '''
+        if self.blobs is None:
+            self.blobs = set(run('ls -1 %s 2>/dev/null; true' % quote(self.directory)).split())
+        return digest in self.blobs or digest in self.pending
+
+    def remember(self, digest, path, run):
+        '''
+        Marks the remote file at ``path``, just uploaded with the contents with the given hash, to be stored in the cache.
+        '''
+        self.pending[digest] = path
+        self.run = run
+
+    def store_command(self):
+        '''
+        Returns the command that stores the pending uploads in the cache (skipping the ones that changed since they were uploaded), or :data:`None` if there are none, and considers them stored.
+        '''
+        if not self.pending:
+            return None
+        commands = ['mkdir -p {directory} && chmod 700 {directory}'.format(directory=quote(self.directory))]
+        for digest, path in sorted(self.pending.items()):
+            commands.append('{{ echo {check} | sha256sum -c --status && cp -f {path} {blob}; }}'.format(
+                check=quote('%s  %s' % (digest, path)), path=quote(path), blob=self.path(digest)))
+        self.blobs = (self.blobs or set()) | set(self.pending)
+        self.pending = {}
+        return '%s; true' % '; '.join(commands)
+
+    def copy_command(self, digest, to_file, owner=None):
+        '''
+        Returns the command that writes the cached contents with the given hash to ``to_file`` (storing the pending uploads first, if needed).
+
+        Just like fabric's ``put``, the contents are written in place, keeping the owner and the mode of an existing file, unless an ``owner`` is given: then, like ``put`` with ``use_sudo``, they are written to a new file, owned by ``owner`` (and its login group), that replaces ``to_file``.
+        '''
+        if owner is None:
+            command = 'cat %s > %s' % (self.path(digest), quote(to_file))
+        else:
+            temp_file = quote('%s.provy-%s' % (to_file, uuid.uuid4().hex))
+            command = 'cat {blob} > {temp} && chown {owner}: {temp} && mv -f {temp} {target} || {{ rm -f {temp}; false; }}'.format(
+                blob=self.path(digest), temp=temp_file, owner=quote(owner), target=quote(to_file))
+        if digest in self.pending:
+            command = '%s && %s' % (self.store_command(), command)
+        return command
+
+    def flush(self):
+        '''
+        Stores the pending uploads in the cache, with a single command.
+        '''
+        command = self.store_command()
+        if command is not None:
+            self.run(command)
@@ -0,0 +1,245 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for long-lived channels to the remote server.
+
+A :class:`RemoteChannel` runs a single remote command over its own SSH channel (reusing fabric's cached connection to the host) and lets provy talk to that command through its standard input and output while it runs. Channels can be opened from many threads at once (like :mod:`provy.core.collection` does): the connections are looked up, and established, one at a time.
+
+It's recommended not to use this module directly in your roles; the base :class:`Role <provy.core.roles.Role>` uses it for you.
+'''
+
+import threading
+import time
+import uuid
+from pipes import quote
+from tempfile import SpooledTemporaryFile
+
+import fabric.api
+from fabric.state import connections
+from paramiko.agent import AgentRequestHandler
+
+
+CONNECTION_LOCK = threading.Lock()
+
+
+class RemoteChannel(object):
+    '''
+    A remote command whose standard input and output stay open for as long as provy needs them.
+
+    The command is wrapped so that it announces itself with a random marker as soon as it starts; any ``sudo`` password prompt that shows up before the marker is answered with fabric's password for the host.
+
+    :param command: The command to be executed.
+    :type command: :class:`str`
+    :param sudo: Specifies whether this command needs to be run as the super-user. Defaults to :data:`False`.
+    :type sudo: :class:`bool`
+    :param user: If specified, will be the user with which the command will be executed. Defaults to :data:`None`.
+    :type user: :class:`str`
+    :param host_string: Host to connect to. Defaults to fabric's current ``host_string``.
+    :type host_string: :class:`str`
+    :param forward_agent: If :data:`True`, the local SSH agent is forwarded to the remote command, so that it can connect to other servers with the local keys. Defaults to :data:`False`.
+    :type forward_agent: :class:`bool`
+    '''
+    poll_interval = 0.01
+    chunk_size = 32768
+
+    def __init__(self, command, sudo=False, user=None, host_string=None, forward_agent=False):
+        self.command = command
+        self.sudo = sudo or (user is not None)
+        self.user = user
+        self.host_string = host_string or fabric.api.env.host_string
+        self.forward_agent = forward_agent
+        self.channel = None
+        self._buffer = ''
+        self._stderr_buffer = ''
+
+    def build_command(self, marker):
+        command = 'sh -c %s' % quote('echo %s && %s' % (marker, self.command))
+        if not self.sudo:
+            return command
+        user = ''
+        if self.user is not None:
+            user = '-u %s ' % quote(self.user)
+        return 'sudo -S -p %s %s%s' % (quote(fabric.api.env.sudo_prompt), user, command)
+
+    def open(self):
+        '''
+        Starts the remote command and waits until it is running.
+
+        :return: The channel itself, so that it can be chained.
+        :rtype: :class:`RemoteChannel`
+        '''
+        marker = 'provy-channel-%s' % uuid.uuid4().hex
+        # Fabric's connection cache (and the settings it may prompt for)
+        # isn't thread-safe, but each established transport is.
+        with CONNECTION_LOCK:
+            transport = connections[self.host_string].get_transport()
+        self.channel = transport.open_session()
+        if self.forward_agent:
+            AgentRequestHandler(self.channel)
+        self.channel.exec_command(self.build_command(marker))
+        self._wait_for(marker)
+        return self
+
+    def _wait_for(self, marker):
+        prompt = fabric.api.env.sudo_prompt
+        stderr = ''
+        while True:
+            if self.channel.recv_stderr_ready():
+                stderr += self.channel.recv_stderr(self.chunk_size)
+                if self.sudo and stderr.rstrip().endswith(prompt.rstrip()):
+                    self.write('%s\n' % self._password())
+                    stderr = ''
+            elif self.channel.recv_ready():
+                line = self.readline()
+                if line.strip() == marker:
+                    return
+            elif self.channel.exit_status_ready():
+                raise IOError('Remote command "%s" exited before starting: %s' % (self.command, stderr.strip()))
+            else:
+                time.sleep(self.poll_interval)
+
+    def _password(self):
+        env = fabric.api.env
+        password = env.passwords.get(self.host_string, env.password)
+        if password is None:
+            raise IOError('sudo asked for a password, but no password was provided for %s' % self.host_string)
+        return password
+
+    def write(self, data):
+        '''
+        Sends data to the standard input of the remote command.
+        '''
+        self.channel.sendall(data)
+
+    def _fill(self):
+        data = self.channel.recv(self.chunk_size)
+        if not data:
+            raise EOFError('Remote command "%s" closed its output' % self.command)
+        self._buffer += data
+
+    def read(self, size):
+        '''
+        Reads exactly ``size`` bytes from the standard output of the remote command.
+        '''
+        while len(self._buffer) < size:
+            self._fill()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self):
+        '''
+        Reads a line (including its trailing line break) from the standard output of the remote command.
+        '''
+        while '\n' not in self._buffer:
+            self._fill()
+        line, self._buffer = self._buffer.split('\n', 1)
+        return line + '\n'
+
+    def iter_chunks(self):
+        '''
+        Yields the standard output of the remote command in chunks, as they arrive, until the command closes it. The standard error is read along the way and kept in :attr:`stderr`.
+        '''
+        if self._buffer:
+            data, self._buffer = self._buffer, ''
+            yield data
+        while True:
+            if self.channel.recv_ready():
+                data = self.channel.recv(self.chunk_size)
+                if not data:
+                    break
+                yield data
+            elif self.channel.recv_stderr_ready():
+                self._stderr_buffer += self.channel.recv_stderr(self.chunk_size)
+            elif self.channel.exit_status_ready() and not self.channel.recv_ready():
+                break
+            else:
+                time.sleep(self.poll_interval)
+        while self.channel.recv_stderr_ready():
+            self._stderr_buffer += self.channel.recv_stderr(self.chunk_size)
+
+    @property
+    def stderr(self):
+        return self._stderr_buffer
+
+    def exit_status(self):
+        '''
+        Waits for the remote command to finish and returns its exit code.
+        '''
+        return self.channel.recv_exit_status()
+
+    def finish(self):
+        '''
+        Closes the standard input of the remote command, waits for it to finish (reading whatever it still writes, and keeping its standard error in :attr:`stderr`) and returns its exit code.
+        '''
+        self.channel.shutdown_write()
+        for chunk in self.iter_chunks():
+            pass
+        return self.exit_status()
+
+    def read_until(self, marker):
+        '''
+        Reads both the standard output and the standard error of the remote command until each of them has a line that starts with ``marker``.
+
+        :param marker: The marker that ends the reading.
+        :type marker: :class:`str`
+
+        :return: A tuple with the output and the error read before the markers, and the rest of the marker line in the output.
+        :rtype: :class:`tuple`
+        '''
+        stdout_marker = '\n%s' % marker
+        stderr_marker = '\n%s\n' % marker
+        while True:
+            stdout_found = stdout_marker in self._buffer and '\n' in self._buffer.split(stdout_marker, 1)[1]
+            stderr_found = stderr_marker in self._stderr_buffer
+            if stdout_found and stderr_found:
+                break
+            if self.channel.recv_ready():
+                self._fill()
+            elif self.channel.recv_stderr_ready():
+                self._stderr_buffer += self.channel.recv_stderr(self.chunk_size)
+            elif self.channel.exit_status_ready() and not self.channel.recv_ready():
+                raise EOFError('Remote command "%s" closed its output' % self.command)
+            else:
+                time.sleep(self.poll_interval)
+
+        stdout, self._buffer = self._buffer.split(stdout_marker, 1)
+        rest, self._buffer = self._buffer.split('\n', 1)
+        stderr, self._stderr_buffer = self._stderr_buffer.split(stderr_marker, 1)
+        return stdout, stderr, rest
+
+    def close(self):
+        '''
+        Closes the standard input of the remote command and the channel itself.
+        '''
+        if self.channel is not None:
+            self.channel.shutdown_write()
+            self.channel.close()
+            self.channel = None
+
+
+def iter_lines(chunks):
+    '''
+    Turns an iterator of data chunks into an iterator of lines, without their line breaks.
+    '''
+    pending = ''
+    for chunk in chunks:
+        pending += chunk
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+    if pending:
+        yield pending.rstrip('\r')
+
+
+def spooled(chunks, max_memory):
+    '''
+    Reads all the given data chunks right away, keeping up to ``max_memory`` bytes of them in memory and spilling the rest to a temporary file, and then yields them back.
+    '''
+    with SpooledTemporaryFile(max_size=max_memory) as spool:
+        for chunk in chunks:
+            spool.write(chunk)
+        spool.seek(0)
+        for chunk in iter(lambda: spool.read(RemoteChannel.chunk_size), ''):
+            yield chunk
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for collecting files (like logs and configuration files) from many servers at once.
+
+:func:`collect` runs a single command in each server, which finds the files matching the given paths (that may have shell wildcards) and streams them back as a gzipped tar archive. The archive is extracted as it arrives into a directory per server, keeping the remote paths. The servers are read concurrently::
+
+    from provy.core import Role
+    from provy.core.collection import collect
+
+    class Incident(Role):
+        def provision(self):
+            collect(['/var/log/nginx/*.log', '/etc/nginx/nginx.conf'], 'incident-42', ['deploy@10.0.0.%d' % i for i in range(1, 51)],
+                    max_size=50 * 1024 * 1024, sudo=True)
+
+With the example above, the access log of the first server ends up in ``incident-42/deploy@10.0.0.1/var/log/nginx/access.log``.
+'''
+
+import os
+import re
+import tarfile
+import threading
+from pipes import quote
+
+from fabric.utils import error
+
+from provy.core.channels import RemoteChannel
+
+
+PARALLEL = 10
+GLOB_PATTERN = re.compile(r'([*?]|\[[^\]/]*\])')
+
+
+def quote_pattern(pattern):
+    '''
+    Quotes a path for the shell, leaving its wildcards (``*``, ``?`` and ``[...]``) to be expanded.
+    '''
+    parts = GLOB_PATTERN.split(pattern)
+    return ''.join(part if index % 2 else quote(part) for index, part in enumerate(parts) if part)
+
+
+def collect_command(remote_paths, max_size=None):
+    '''
+    Returns the command that writes to its standard output a gzipped tar archive with the regular files matching the given paths (or inside the matching directories), skipping the ones larger than ``max_size`` bytes.
+    '''
+    size_filter = ' -size -%dc' % (max_size + 1) if max_size is not None else ''
+    return 'find {paths} -type f{size_filter} -print0 2>/dev/null | tar -czf - --null -T -'.format(
+        paths=' '.join(quote_pattern(path) for path in remote_paths), size_filter=size_filter)
+
+
+def host_directory(host_string):
+    return re.sub(r'[^\w.@-]', '_', host_string)
+
+
+def is_safe_member(member):
+    '''
+    Returns :data:`True` if the archive member is a regular file or a directory that is extracted inside the target directory.
+    '''
+    if not (member.isfile() or member.isdir()):
+        return False
+    return not os.path.isabs(member.name) and '..' not in member.name.split('/')
+
+
+class ChunkReader(object):
+    '''
+    File-like object that reads from an iterator of data chunks, so that an archive can be extracted as it arrives.
+    '''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class Collection(object):
+    '''
+    Collection of remote files from many servers, concurrently.
+
+    :param remote_paths: Paths of the remote files or directories, possibly with wildcards.
+    :type remote_paths: :class:`list`
+    :param local_dir: Local directory where a directory is created for each server.
+    :type local_dir: :class:`str`
+    :param hosts: Host strings of the servers.
+    :type hosts: :class:`list`
+    :param max_size: Files larger than this number of bytes are not collected. Defaults to :data:`None`, which means no limit.
+    :type max_size: :class:`int`
+    :param sudo: Indicates whether the files should be read by the super-user. Defaults to :data:`False`.
+    :type sudo: :class:`bool`
+    :param parallel: Maximum number of servers read at the same time. Defaults to :data:`PARALLEL`.
+    :type parallel: :class:`int`
+    '''
+    channel_class = RemoteChannel
+
+    def __init__(self, remote_paths, local_dir, hosts, max_size=None, sudo=False, parallel=PARALLEL):
+        self.command = collect_command(remote_paths, max_size)
+        self.local_dir = local_dir
+        self.hosts = list(hosts)
+        self.sudo = sudo
+        self.parallel = parallel
+        self.collected = {}
+        self.failed = {}
+        self.lock = threading.Lock()
+
+    def collect_from(self, host):
+        '''
+        Collects the files from a server, returning the local paths of the files extracted.
+        '''
+        directory = os.path.join(self.local_dir, host_directory(host))
+        paths = []
+        channel = self.channel_class(self.command, sudo=self.sudo, host_string=host).open()
+        try:
+            archive = tarfile.open(fileobj=ChunkReader(channel.iter_chunks()), mode='r|gz')
+            for member in archive:
+                if is_safe_member(member):
+                    archive.extract(member, directory)
+                    if member.isfile():
+                        paths.append(os.path.join(directory, member.name))
+            archive.close()
+            return_code = channel.finish()
+        finally:
+            channel.close()
+
+        if return_code != 0:
+            raise IOError('return code %s: %s' % (return_code, channel.stderr.strip()))
+        return paths
+
+    def worker(self, pending):
+        while True:
+            with self.lock:
+                if not pending:
+                    return
+                host = pending.pop(0)
+            try:
+                paths = self.collect_from(host)
+            except Exception as e:
+                with self.lock:
+                    self.failed[host] = str(e)
+            else:
+                with self.lock:
+                    self.collected[host] = paths
+
+    def run(self):
+        '''
+        Collects the files from all the servers.
+        '''
+        pending = list(self.hosts)
+        threads = [threading.Thread(target=self.worker, args=(pending,)) for i in range(min(self.parallel, len(pending)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+def collect(remote_paths, local_dir, hosts, max_size=None, sudo=False, parallel=PARALLEL):
+    '''
+    Downloads the remote files matching the given paths from many servers, concurrently (refer to :class:`Collection`).
+
+    Aborts, after reading all the other servers, if some server could not be read, unless fabric's ``warn_only`` setting is on.
+
+    :param remote_paths: Paths of the remote files or directories, possibly with wildcards.
+    :type remote_paths: :class:`list`
+    :param local_dir: Local directory where a directory is created for each server.
+    :type local_dir: :class:`str`
+    :param hosts: Host strings of the servers.
+    :type hosts: :class:`list`
+    :param max_size: Files larger than this number of bytes are not collected. Defaults to :data:`None`, which means no limit.
+    :type max_size: :class:`int`
+    :param sudo: Indicates whether the files should be read by the super-user. Defaults to :data:`False`.
+    :type sudo: :class:`bool`
+    :param parallel: Maximum number of servers read at the same time. Defaults to :data:`PARALLEL`.
+    :type parallel: :class:`int`
+
+    :return: The local paths of the files collected, by host string.
+    :rtype: :class:`dict`
+    '''
+    collection = Collection(remote_paths, local_dir, hosts, max_size=max_size, sudo=sudo, parallel=parallel)
+    collection.run()
+    if collection.failed:
+        error('Could not collect files from %s' % ', '.join('%s (%s)' % item for item in sorted(collection.failed.items())))
+    return collection.collected
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for compressing the files uploaded to the servers.
+
+Files larger than :data:`COMPRESS_THRESHOLD` bytes are gzip-compressed on the fly and streamed to a ``gzip -dc`` command in the server, over a :class:`RemoteChannel <provy.core.channels.RemoteChannel>`, instead of being sent as they are. A sample from the start of each file is compressed first, and files that don't compress well (like archives or images) are sent as they are.
+
+:meth:`Role.put_file <provy.core.roles.Role.put_file>` uses it automatically.
+'''
+
+import uuid
+import zlib
+from pipes import quote
+
+from fabric.utils import error
+
+from provy.core.channels import RemoteChannel
+
+
+COMPRESS_THRESHOLD = 64 * 1024
+SAMPLE_SIZE = 64 * 1024
+MIN_SAVING = 0.1
+CHUNK_SIZE = 256 * 1024
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def worth_compressing(sample):
+    '''
+    Returns :data:`True` if compressing the given sample saves at least :data:`MIN_SAVING` of its size.
+    '''
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - MIN_SAVING)
+
+
+def compressed_chunks(chunks, level=6):
+    '''
+    Compresses the given data chunks to the gzip format, yielding the compressed chunks as they are ready.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def read_chunks(source, first_chunk=''):
+    if first_chunk:
+        yield first_chunk
+    for chunk in iter(lambda: source.read(CHUNK_SIZE), ''):
+        yield chunk
+
+
+def upload_command(to_file, sudo):
+    '''
+    Returns the command that decompresses its standard input to ``to_file``. Just like fabric's ``put``, the file is written in place, or, if ``sudo`` is :data:`True`, written to a temporary file, given to the logged user (the one that ran ``sudo``) and then moved over ``to_file``, so that the file ends up with the same owner either way.
+    '''
+    if not sudo:
+        return 'gzip -dc > %s' % quote(to_file)
+    temp_file = '%s.provy-%s' % (to_file, uuid.uuid4().hex)
+    return ('gzip -dc > {temp} && chown ${{SUDO_UID:-$(id -u)}}:${{SUDO_GID:-$(id -g)}} {temp} && mv -f {temp} {target} || '
+            '{{ rm -f {temp}; exit 1; }}').format(temp=quote(temp_file), target=quote(to_file))
+
+
+class CompressedUpload(object):
+    '''
+    Upload of a file to the server, compressed on the fly.
+
+    :param source: The file object to upload, from its current position.
+    :type source: :class:`file`
+    :param sample: Data already read from the start of ``source`` (refer to :func:`worth_compressing`).
+    :type sample: :class:`str`
+    :param to_file: Target path in the remote server.
+    :type to_file: :class:`str`
+    :param sudo: Indicates whether the file should be created by the super-user.
+    :type sudo: :class:`bool`
+    '''
+    def __init__(self, source, sample, to_file, sudo=False):
+        self.source = source
+        self.sample = sample
+        self.to_file = to_file
+        self.sudo = sudo
+        self.sent = 0
+
+    def send(self):
+        '''
+        Streams the file to the server, aborting if it could not be written there.
+        '''
+        channel = RemoteChannel(upload_command(self.to_file, self.sudo), sudo=self.sudo).open()
+        try:
+            for chunk in compressed_chunks(read_chunks(self.source, self.sample)):
+                channel.write(chunk)
+                self.sent += len(chunk)
+            return_code = channel.finish()
+        finally:
+            channel.close()
+
+        if return_code != 0:
+            error("put_file() received nonzero return code %s while uploading %s!" % (return_code, self.to_file), stderr=channel.stderr)
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for sending only the changed parts of large files to the servers, rsync-style.
+
+The provy agent (refer to :mod:`provy.core.agent`) splits the file already in the server in blocks and returns a weak (adler32) and a strong (md5) checksum for each of them. The local file is then scanned with a rolling checksum to find the blocks it shares with the remote one, at any offset, and only a delta - block copies and the bytes that changed - is uploaded. The agent rebuilds the file from the delta into a temporary file next to it, checks its md5 and renames it over the old one, so the change is atomic. If the target path is a symbolic link, the file it points to is the one rebuilt.
+
+Scanning the local file is much slower than sending it, so the delta is given up on (and the file sent whole) as soon as more than :data:`MAX_LITERAL_FRACTION` of it would have to be sent as it is. Since the agent rebuilds the file as the super-user, files uploaded without ``sudo`` only get a delta if the logged user can write them.
+
+:meth:`Role.put_file <provy.core.roles.Role.put_file>` (and so :meth:`Role.update_file <provy.core.roles.Role.update_file>`, which uploads the rendered template from memory) uses it automatically for files (or seekable file objects) larger than :data:`DELTA_THRESHOLD` bytes, when the agent is enabled for the server.
+'''
+
+import hashlib
+import math
+import mmap
+import struct
+import zlib
+from contextlib import contextmanager
+
+
+DELTA_THRESHOLD = 1024 * 1024
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+ADLER_MOD = 65521
+MAX_LITERAL_FRACTION = 0.5
+
+
+def block_size_for(size):
+    '''
+    Returns the block size to use for a file with the given size: about its square root, within :data:`MIN_BLOCK_SIZE` and :data:`MAX_BLOCK_SIZE`.
+    '''
+    block_size = int(math.sqrt(size)) // 1024 * 1024
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def weak_checksum(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+def roll(checksum, removed, added, block_size):
+    '''
+    Returns the adler32 checksum of the window moved one byte forward, given the checksum of the current window, the byte that leaves it and the byte that enters it.
+    '''
+    a = checksum & 0xffff
+    b = checksum >> 16
+    a = (a - removed + added) % ADLER_MOD
+    b = (b - block_size * removed + a - 1) % ADLER_MOD
+    return (b << 16) | a
+
+
+class DeltaWriter(object):
+    '''
+    Writes a delta to a file: ``C`` followed by the first block and the number of blocks to copy from the remote file, or ``D`` followed by the length and the bytes to write.
+    '''
+    def __init__(self, output):
+        self.output = output
+        self.copy_start = None
+        self.copy_count = 0
+        self.literal_bytes = 0
+
+    def copy(self, index):
+        if self.copy_start is not None and index == self.copy_start + self.copy_count:
+            self.copy_count += 1
+            return
+        self.flush()
+        self.copy_start = index
+        self.copy_count = 1
+
+    def data(self, data):
+        if not data:
+            return
+        self.flush()
+        self.output.write(b'D' + struct.pack('>I', len(data)))
+        self.output.write(data)
+        self.literal_bytes += len(data)
+
+    def flush(self):
+        if self.copy_start is not None:
+            self.output.write(b'C' + struct.pack('>II', self.copy_start, self.copy_count))
+            self.copy_start = None
+            self.copy_count = 0
+
+
+@contextmanager
+def local_data(source):
+    '''
+    Gives the contents of a local file, by its path (memory mapped) or as a file object (read from its current position, which is restored afterwards).
+    '''
+    if isinstance(source, basestring):
+        with open(source, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield data
+            finally:
+                data.close()
+    else:
+        start = source.tell()
+        try:
+            yield source.read()
+        finally:
+            source.seek(start)
+
+
+def write_delta(source, signatures, block_size, output, max_literal=None):
+    '''
+    Writes to ``output`` the delta that turns the remote file, with the given block signatures, into the local file (or file object) ``source``.
+
+    :param source: Path of the local file, or a file object (like the rendered contents of a template), which must not be empty.
+    :type source: :class:`str` or :class:`file`
+    :param signatures: The ``[weak, strong]`` checksums of each block of the remote file, as returned by the agent.
+    :type signatures: :class:`list`
+    :param block_size: The size of the blocks.
+    :type block_size: :class:`int`
+    :param output: File object to write the delta to.
+    :type output: :class:`file`
+    :param max_literal: If specified, the scan stops as soon as more than this number of bytes would have to be sent as they are. Defaults to :data:`None`.
+    :type max_literal: :class:`int`
+
+    :return: A tuple with the number of bytes that had to be sent as they are and the md5 hash of the local file, or :data:`None` if the scan was stopped.
+    :rtype: :class:`tuple`
+    '''
+    blocks = {}
+    for block_index, (weak, strong) in enumerate(signatures):
+        blocks.setdefault(weak, []).append((strong, block_index))
+
+    writer = DeltaWriter(output)
+    with local_data(source) as data:
+        size = len(data)
+        position = 0
+        literal_start = 0
+        checksum = None
+        while position < size:
+            window = min(block_size, size - position)
+            if checksum is None:
+                checksum = weak_checksum(data[position:position + window])
+
+            if checksum in blocks:
+                window_strong = hashlib.md5(data[position:position + window]).hexdigest()
+                matches = [index for block_strong, index in blocks[checksum] if block_strong == window_strong]
+                if matches:
+                    writer.data(data[literal_start:position])
+                    writer.copy(matches[0])
+                    position += window
+                    literal_start = position
+                    checksum = None
+                    continue
+
+            if window < block_size or position + window >= size:
+                # There are no more bytes to roll into the window, so the
+                # rest of the file goes as it is.
+                break
+            if max_literal is not None and writer.literal_bytes + position - literal_start > max_literal:
+                return None
+            checksum = roll(checksum, ord(data[position]), ord(data[position + window]), window)
+            position += 1
+
+        writer.data(data[literal_start:size])
+        writer.flush()
+        if max_literal is not None and writer.literal_bytes > max_literal:
+            return None
+        digest = hashlib.md5()
+        for start in range(0, size, MAX_BLOCK_SIZE):
+            digest.update(data[start:start + MAX_BLOCK_SIZE])
+
+    return writer.literal_bytes, digest.hexdigest()
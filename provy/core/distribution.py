@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for distributing large files (like release archives) to many servers at once.
+
+Instead of uploading the file from the local machine to each server, :func:`distribute` uploads it to a few servers, which then relay it to others, in rounds: in each round, the local machine and every server that already has the file send it to ``fanout`` servers that don't, so the number of servers with the file grows geometrically and the distribution takes a number of rounds proportional to the logarithm of the number of servers. The file is checked against its sha256 hash at each hop before it's moved into place.
+
+The servers relay the file with ``ssh``, using the local SSH agent (forwarded to them), so the keys loaded in it must give access to all the servers, and the servers must be able to reach each other::
+
+    from provy.core import Role
+    from provy.core.distribution import distribute
+
+    class Release(Role):
+        def provision(self):
+            distribute('dist/app-1.0.tar.gz', '/srv/releases/app-1.0.tar.gz', ['deploy@10.0.0.%d' % i for i in range(1, 201)])
+
+Since it sends the file to all the given servers, it's meant to be called once per run - for instance, in a role used only in the first server.
+'''
+
+from collections import defaultdict
+from pipes import quote
+import posixpath
+
+from fabric.network import normalize
+from fabric.utils import error
+
+from provy.core.blobs import payload_digest
+from provy.core.channels import RemoteChannel
+
+
+FANOUT = 3
+MAX_ATTEMPTS = 3
+CHUNK_SIZE = 256 * 1024
+
+
+def receive_command(remote_path, digest, sudo=False):
+    '''
+    Returns the command that writes its standard input to ``remote_path``, only if it matches the given sha256 hash.
+    '''
+    temp_path = '%s.provy-%s' % (remote_path, digest[:16])
+    command = 'mkdir -p {directory} && cat > {temp} && echo {check} | sha256sum -c --status && mv -f {temp} {path} || {{ rm -f {temp}; exit 1; }}'.format(
+        directory=quote(posixpath.dirname(remote_path) or '.'), temp=quote(temp_path), check=quote('%s  %s' % (digest, temp_path)), path=quote(remote_path))
+    if sudo:
+        return 'sudo -n sh -c %s' % quote(command)
+    return command
+
+
+def relay_command(remote_path, digest, host_string, sudo=False):
+    '''
+    Returns the command that sends the file at ``remote_path``, in the current server, to the same path in the server at ``host_string``.
+    '''
+    user, host, port = normalize(host_string)
+    return 'ssh -o BatchMode=yes -o StrictHostKeyChecking=no -p {port} {user}@{host} {command} < {path}'.format(
+        port=port, user=user, host=host, command=quote(receive_command(remote_path, digest, sudo)), path=quote(remote_path))
+
+
+class Distribution(object):
+    '''
+    Distribution of a local file to many servers, in rounds.
+
+    :param local_path: Path of the local file.
+    :type local_path: :class:`str`
+    :param remote_path: Path of the file in the servers.
+    :type remote_path: :class:`str`
+    :param hosts: Host strings of the servers.
+    :type hosts: :class:`list`
+    :param fanout: Number of servers each server (and the local machine) sends the file to in each round. Defaults to :data:`FANOUT`.
+    :type fanout: :class:`int`
+    :param sudo: Indicates whether the file should be written by the super-user. In the servers that receive the file from other servers, this requires ``sudo`` without a password. Defaults to :data:`False`.
+    :type sudo: :class:`bool`
+    '''
+    channel_class = RemoteChannel
+
+    def __init__(self, local_path, remote_path, hosts, fanout=FANOUT, sudo=False):
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.fanout = fanout
+        self.sudo = sudo
+        self.digest = payload_digest(local_path)
+        self.pending = list(hosts)
+        self.holders = []
+        self.failed = []
+        self.attempts = defaultdict(int)
+
+    def plan(self):
+        '''
+        Returns the transfers of the next round, as ``(source, host)`` tuples, where ``source`` is :data:`None` for the local machine.
+        '''
+        transfers = []
+        for source in [None] + self.holders:
+            for i in range(self.fanout):
+                if not self.pending:
+                    return transfers
+                transfers.append((source, self.pending.pop(0)))
+        return transfers
+
+    def open_channel(self, source, host):
+        if source is None:
+            return self.channel_class(receive_command(self.remote_path, self.digest), sudo=self.sudo, host_string=host).open()
+        return self.channel_class(relay_command(self.remote_path, self.digest, host, self.sudo), host_string=source, forward_agent=True).open()
+
+    def run_round(self, transfers):
+        '''
+        Runs the transfers of a round at the same time: the relays run in the servers while the local file is streamed to the servers that get it from the local machine. A server that can't even be connected to counts as a failed attempt, like one that didn't get the file.
+        '''
+        opened = []
+        try:
+            for source, host in transfers:
+                try:
+                    channel = self.open_channel(source, host)
+                except Exception:
+                    self.retry_later(host)
+                else:
+                    opened.append((source, host, channel))
+
+            direct = [item[2] for item in opened if item[0] is None]
+            if direct:
+                with open(self.local_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                        for channel in direct:
+                            channel.write(chunk)
+
+            for source, host, channel in opened:
+                if channel.finish() == 0:
+                    self.holders.append(host)
+                else:
+                    self.retry_later(host)
+        finally:
+            for source, host, channel in opened:
+                channel.close()
+
+    def retry_later(self, host):
+        '''
+        Counts a failed attempt to send the file to a server, which is tried again in a later round, unless it already failed :data:`MAX_ATTEMPTS` times.
+        '''
+        self.attempts[host] += 1
+        if self.attempts[host] < MAX_ATTEMPTS:
+            self.pending.append(host)
+        else:
+            self.failed.append(host)
+
+    def run(self):
+        '''
+        Runs rounds until every server has the file, or failed to get it :data:`MAX_ATTEMPTS` times.
+
+        :return: The number of rounds.
+        :rtype: :class:`int`
+        '''
+        rounds = 0
+        while self.pending:
+            self.run_round(self.plan())
+            rounds += 1
+        return rounds
+
+
+def distribute(local_path, remote_path, hosts, fanout=FANOUT, sudo=False):
+    '''
+    Sends a local file to many servers, relaying it from server to server (refer to :class:`Distribution`).
+
+    Aborts if some server could not get the file, unless fabric's ``warn_only`` setting is on.
+
+    :param local_path: Path of the local file.
+    :type local_path: :class:`str`
+    :param remote_path: Path of the file in the servers.
+    :type remote_path: :class:`str`
+    :param hosts: Host strings of the servers.
+    :type hosts: :class:`list`
+    :param fanout: Number of servers each server (and the local machine) sends the file to in each round. Defaults to :data:`FANOUT`.
+    :type fanout: :class:`int`
+    :param sudo: Indicates whether the file should be written by the super-user. Defaults to :data:`False`.
+    :type sudo: :class:`bool`
+
+    :return: The host strings of the servers that got the file.
+    :rtype: :class:`list`
+    '''
+    distribution = Distribution(local_path, remote_path, hosts, fanout=fanout, sudo=sudo)
+    distribution.run()
+    if distribution.failed:
+        error('Could not distribute %s to %s' % (local_path, ', '.join(distribution.failed)))
+    return distribution.holders
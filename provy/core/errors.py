@@ -4,3 +4,11 @@
 
 class ConfigurationError(RuntimeError):
     '''Raised when there's a configuration error in the provyfile.'''
+
+
+class RemoteAgentError(RuntimeError):
+    '''Raised when the provy agent fails to run an operation in the remote server.'''
+
+
+class ReplayError(RuntimeError):
+    '''Raised when a call made while replaying was never recorded.'''
@@ -0,0 +1,230 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for the facts about each server - its distribution, logged user, hostname, temp dir, CPUs and memory.
+
+Instead of each role asking the server for these, one at a time, all of them are gathered with a single command the first time any role in the server needs one of them, and shared by all the roles in the server (refer to :meth:`Role.gather_facts <provy.core.roles.Role.gather_facts>`).
+
+The facts are also kept in the local machine between runs, by a :class:`FactStore`. Each fact is kept for some time (its TTL), and only while the server fingerprint - its boot id and the modification time of its package database - stays the same; so a run right after another one only asks the server for its fingerprint. Use the ``--refresh-facts`` option of the console runner to gather all the facts again.
+'''
+
+import json
+import os
+import re
+import time
+
+FACT_MARKER = 'provy-fact:'
+
+FACT_COMMANDS = (
+    ('distro', 'lsb_release -a 2>/dev/null'),
+    ('user', 'whoami'),
+    ('hostname', 'uname -n'),
+    ('temp_dir', "python -c 'from tempfile import gettempdir; print(gettempdir())' 2>/dev/null || echo ${TMPDIR:-/tmp}"),
+    ('cpus', 'getconf _NPROCESSORS_ONLN 2>/dev/null || grep -c ^processor /proc/cpuinfo'),
+    ('memory', "awk '/^MemTotal:/ { print $2 * 1024 }' /proc/meminfo"),
+)
+
+FACT_NAMES = tuple(name for name, command in FACT_COMMANDS)
+
+FINGERPRINT_COMMAND = 'cat /proc/sys/kernel/random/boot_id 2>/dev/null; stat -c %Y /var/lib/dpkg/status /var/lib/rpm/Packages 2>/dev/null'
+
+DAY = 24 * 60 * 60
+
+
+def facts_command(names=None, fingerprint=False):
+    '''
+    Returns the shell command that prints the given facts (or all of them, if ``names`` is :data:`None`), each one after a marker line.
+
+    If ``fingerprint`` is :data:`True`, the server fingerprint is printed first.
+    '''
+    commands = []
+    if fingerprint:
+        commands.append(('fingerprint', FINGERPRINT_COMMAND))
+    commands.extend((name, command) for name, command in FACT_COMMANDS if names is None or name in names)
+    return '; '.join('echo %s%s; %s' % (FACT_MARKER, name, command) for name, command in commands)
+
+
+def parse_sections(output):
+    '''
+    Splits the output of :func:`facts_command` into a dictionary with the output of each fact.
+    '''
+    sections = {}
+    name = None
+    for line in output.splitlines():
+        line = line.rstrip('\r')
+        if line.startswith(FACT_MARKER):
+            name = line[len(FACT_MARKER):]
+            sections[name] = []
+        elif name is not None:
+            sections[name].append(line)
+    return dict((name, '\n'.join(lines).strip()) for name, lines in sections.items())
+
+
+def parse_distro_info(output):
+    '''
+    Builds a :class:`DistroInfo` from the output of ``lsb_release -a``.
+    '''
+    distro_info = DistroInfo()
+    for line in output.splitlines():
+        if ':' in line:
+            key, value = line.split(':', 1)
+            info_property = key.lower().replace(' ', '_')
+            setattr(distro_info, info_property, value.strip())
+    return distro_info
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+class DistroInfo(object):
+    '''
+    Value object used to contain distribution information.
+
+    Refer to :meth:`Role.get_distro_info <provy.core.roles.Role.get_distro_info>` usage.
+    '''
+    lsb_version = None
+    distributor_id = None
+    description = None
+    release = None
+    codename = None
+
+
+class HostFacts(object):
+    '''
+    Value object used to contain the facts about a server. Until :meth:`parse` is called, :attr:`gathered` is :data:`False` and all the facts are :data:`None`.
+
+    * ``distro`` - a :class:`DistroInfo`;
+    * ``user`` - the logged user;
+    * ``hostname`` - the server hostname;
+    * ``temp_dir`` - the path of a temporary directory in the server;
+    * ``cpus`` - the number of online CPUs;
+    * ``memory`` - the total memory, in bytes.
+    '''
+    def __init__(self):
+        self.gathered = False
+        self.distro = None
+        self.user = None
+        self.hostname = None
+        self.temp_dir = None
+        self.cpus = None
+        self.memory = None
+
+    def parse(self, output):
+        '''
+        Fills the facts from the output of :func:`facts_command`.
+        '''
+        self.fill(parse_sections(output))
+
+    def gather(self, run, store=None, host=None):
+        '''
+        Gathers the facts from the server.
+
+        :param run: Callable that runs a shell command in the server, returning its output.
+        :type run: callable
+        :param store: If specified, the facts still fresh in it are reused (as long as the server fingerprint didn't change), and the gathered ones are saved to it. Defaults to :data:`None`.
+        :type store: :class:`FactStore`
+        :param host: The server host string, used as the key in the ``store``.
+        :type host: :class:`str`
+        '''
+        if store is None:
+            self.parse(run(facts_command()))
+            return
+
+        stored_fingerprint, stored_values = store.load(host)
+        stale = [name for name in FACT_NAMES if name not in stored_values]
+        values = parse_sections(run(facts_command(stale, fingerprint=True)))
+        fingerprint = values.pop('fingerprint', '')
+
+        if fingerprint and fingerprint == stored_fingerprint:
+            gathered = dict(values)
+            values.update(stored_values)
+        else:
+            fresh = [name for name in FACT_NAMES if name not in stale]
+            if fresh:
+                values.update(parse_sections(run(facts_command(fresh))))
+            gathered = values
+
+        store.save(host, fingerprint, gathered)
+        self.fill(values)
+
+    def fill(self, values):
+        '''
+        Fills the facts from a dictionary with the output of each fact.
+        '''
+        self.distro = parse_distro_info(values.get('distro', ''))
+        self.user = values.get('user') or None
+        self.hostname = values.get('hostname') or None
+        self.temp_dir = values.get('temp_dir') or None
+        self.cpus = parse_int(values.get('cpus', ''))
+        self.memory = parse_int(values.get('memory', ''))
+        self.gathered = True
+
+
+class FactStore(object):
+    '''
+    Facts about the servers, kept as one JSON file per server in a local directory.
+
+    :param directory: The directory where the files are kept.
+    :type directory: :class:`str`
+    :param refresh: If :data:`True`, the facts kept from previous runs are ignored (and replaced). Defaults to :data:`False`.
+    :type refresh: :class:`bool`
+    '''
+    ttls = {
+        'distro': 30 * DAY,
+        'user': 30 * DAY,
+        'hostname': DAY,
+        'temp_dir': 7 * DAY,
+        'cpus': DAY,
+        'memory': DAY,
+    }
+
+    def __init__(self, directory, refresh=False):
+        self.directory = directory
+        self.refresh = refresh
+
+    def path(self, host):
+        return os.path.join(self.directory, '%s.json' % re.sub(r'[^\w.@-]', '_', host))
+
+    def read(self, host):
+        if self.refresh:
+            return {}
+        try:
+            with open(self.path(host)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def load(self, host):
+        '''
+        Returns a tuple with the fingerprint of the server and a dictionary with the output of each fact still within its TTL.
+        '''
+        data = self.read(host)
+        now = time.time()
+        values = {}
+        for name, entry in data.get('facts', {}).items():
+            if now - entry['time'] < self.ttls.get(name, 0):
+                values[name] = entry['value']
+        return data.get('fingerprint'), values
+
+    def save(self, host, fingerprint, values):
+        '''
+        Keeps the output of the given facts, along with the fingerprint of the server.
+        '''
+        data = self.read(host)
+        if data.get('fingerprint') != fingerprint:
+            data = {}
+        facts = data.get('facts', {})
+        now = time.time()
+        for name, value in values.items():
+            facts[name] = {'value': value, 'time': now}
+
+        path = self.path(host)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'facts': facts}, f)
+        os.rename(temp_path, path)
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for hashing local files.
+
+:meth:`Role.md5_local <provy.core.roles.Role.md5_local>` hashes the files in-process, and remembers each hash along with the size, modification time and inode of the file, so that an unchanged file is never read again - not for another server in the same run, nor in later runs, since the runner keeps the hashes in ``~/.provy/local-hashes.json``.
+
+Files modified less than :data:`SETTLE_TIME` seconds before being hashed are not remembered, since they could still change without their modification time telling.
+'''
+
+import hashlib
+import json
+import os
+import time
+
+
+CHUNK_SIZE = 65536
+SETTLE_TIME = 2
+
+
+def md5_file(path):
+    '''
+    Returns the md5 hash of a local file, reading it in chunks.
+    '''
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class LocalHashes(object):
+    '''
+    The md5 hashes of local files, by their absolute path.
+
+    :param path: Path of the JSON file where the hashes are kept between runs. If :data:`None`, they are only kept in memory. Defaults to :data:`None`.
+    :type path: :class:`str`
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = None
+        self.changed = False
+
+    def load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def md5(self, path):
+        '''
+        Returns the md5 hash of a local file, or :data:`None` if it doesn't exist.
+        '''
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        self.load()
+        key = [stat.st_size, stat.st_mtime, stat.st_ino]
+        entry = self.entries.get(path)
+        if entry is not None and entry[:3] == key:
+            return entry[3]
+
+        md5 = md5_file(path)
+        if time.time() - stat.st_mtime >= SETTLE_TIME:
+            self.entries[path] = key + [md5]
+            self.changed = True
+        return md5
+
+    def save(self):
+        '''
+        Writes the hashes to the JSON file, if they changed, leaving out the files that no longer exist.
+        '''
+        if self.path is None or not self.changed:
+            return
+        entries = dict((path, entry) for path, entry in self.entries.items() if os.path.exists(path))
+        temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(entries, f)
+        os.rename(temp_path, self.path)
+        self.changed = False
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for remembering the results of read-only queries to the remote server.
+
+The base :class:`Role <provy.core.roles.Role>` helpers that only read from the server (like :meth:`remote_exists <provy.core.roles.Role.remote_exists>`, :meth:`md5_remote <provy.core.roles.Role.md5_remote>` or :meth:`remote_temp_dir <provy.core.roles.Role.remote_temp_dir>`) are answered from a :class:`QueryCache` shared by all the roles in the same server, and forgotten as soon as something may have changed their answer:
+
+* a helper that changes a path (like :meth:`put_file <provy.core.roles.Role.put_file>`, :meth:`ensure_dir <provy.core.roles.Role.ensure_dir>` or :meth:`remove_file <provy.core.roles.Role.remove_file>`) forgets the queries over that path, its parents and its contents;
+* any other command forgets all the queries over paths, since there's no telling what it changed.
+
+Queries that don't depend on any path (like :meth:`get_logged_user <provy.core.roles.Role.get_logged_user>`) are kept for the whole provisioning.
+
+The cache is enabled by default, and can be disabled per server with the ``query_cache`` key in the ``servers`` dictionary:
+::
+
+    servers = {
+        'frontend': {
+            'address': '33.33.33.33',
+            'user': 'vagrant',
+            'query_cache': False,
+            'roles': [
+                FrontEnd
+            ]
+        }
+    }
+'''
+
+from copy import deepcopy
+
+from provy.core.batch import paths_overlap
+
+
+class QueryCache(object):
+    '''
+    Results of read-only queries in the current server, along with the paths each of them depends on.
+    '''
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key):
+        '''
+        Returns a copy of the result stored for the query.
+
+        :raise: :class:`KeyError` if the result is not stored.
+        '''
+        paths, value = self.entries[key]
+        return deepcopy(value)
+
+    def store(self, key, paths, value):
+        '''
+        Stores the result of a query.
+
+        :param paths: Remote paths the result depends on. If empty, the result is kept until the cache is cleared.
+        :type paths: :class:`list`
+        '''
+        self.entries[key] = (tuple(paths), deepcopy(value))
+
+    def invalidate(self, paths=None):
+        '''
+        Forgets the queries over the given paths (or over any path, if ``paths`` is :data:`None`).
+        '''
+        for key, (entry_paths, value) in list(self.entries.items()):
+            if not entry_paths:
+                continue
+            if paths is None or any(paths_overlap(path, entry_path) for path in paths for entry_path in entry_paths):
+                del self.entries[key]
+
+    def clear(self):
+        '''
+        Forgets all the queries.
+        '''
+        self.entries = {}
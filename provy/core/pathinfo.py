@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for the information about remote paths gathered by :meth:`Role.remote_stat <provy.core.roles.Role.remote_stat>`.
+
+The information about all the paths is gathered with a single command (or a single call to the agent), which runs ``stat`` (without following symbolic links), ``readlink`` and, optionally, ``md5sum`` for each of them. The type of each path is told from its raw mode, in hexadecimal, since the type names ``stat`` prints depend on the locale of the server.
+
+The commands built by :func:`owner_command` and :func:`mode_command` reconcile the owner and the mode of a whole tree in the same spirit: they only touch the entries that differ from the desired state, and print how many entries were changed.
+'''
+
+import stat
+from pipes import quote
+
+
+STAT_FORMAT = '%f|%a|%u|%g|%U|%G|%s|%Y'
+MISSING = 'missing'
+TYPES = {
+    stat.S_IFREG: 'file',
+    stat.S_IFDIR: 'directory',
+    stat.S_IFLNK: 'link',
+}
+
+
+class PathInfo(object):
+    '''
+    Value object with the information about a remote path.
+
+    :ivar exists: Whether the path exists (for a symbolic link, whether the link itself exists).
+    :ivar type: ``'file'``, ``'directory'``, ``'link'``, ``'other'``, or :data:`None` if the path doesn't exist.
+    :ivar mode: The permission mode, like ``644``.
+    :ivar uid: The id of the owner.
+    :ivar gid: The id of the group.
+    :ivar owner: The name of the owner.
+    :ivar group: The name of the group.
+    :ivar size: The size, in bytes.
+    :ivar mtime: The modification time, as a timestamp.
+    :ivar target: The path a symbolic link points to, or :data:`None`.
+    :ivar md5: The md5 hash of a regular file (or of the file a symbolic link points to), if requested, or :data:`None`.
+    '''
+    def __init__(self, path, type=None, mode=None, uid=None, gid=None, owner=None, group=None, size=None, mtime=None, target=None, md5=None):
+        self.path = path
+        self.exists = type is not None
+        self.type = type
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.owner = owner
+        self.group = group
+        self.size = size
+        self.mtime = mtime
+        self.target = target
+        self.md5 = md5
+
+    @property
+    def is_file(self):
+        return self.type == 'file'
+
+    @property
+    def is_dir(self):
+        return self.type == 'directory'
+
+    @property
+    def is_link(self):
+        return self.type == 'link'
+
+    def __eq__(self, other):
+        return isinstance(other, PathInfo) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<PathInfo %s %s>' % (self.path, self.type or MISSING)
+
+
+def stat_command(paths, hashes=False):
+    '''
+    Returns the command that prints a line with the information about each path, in order.
+    '''
+    md5 = '$([ -f "$p" ] && md5sum < "$p" | cut -c 1-32)' if hashes else ''
+    return ("for p in {paths}; do if s=$(stat -c '{format}' -- \"$p\" 2>/dev/null); then "
+            "printf '%s|%s|%s\\n' \"$s\" \"{md5}\" \"$(readlink -- \"$p\")\"; else echo {missing}; fi; done").format(
+        paths=' '.join(quote(path) for path in paths), format=STAT_FORMAT, md5=md5, missing=MISSING)
+
+
+def path_info(path, fields):
+    '''
+    Builds a :class:`PathInfo` from the fields printed by :func:`stat_command` (or returned by the agent), or from :data:`None` if the path doesn't exist.
+    '''
+    if fields is None:
+        return PathInfo(path)
+    raw_mode, mode, uid, gid, owner, group, size, mtime, md5, target = fields
+    return PathInfo(path, type=TYPES.get(stat.S_IFMT(int(raw_mode, 16)), 'other'), mode=int(mode), uid=int(uid), gid=int(gid), owner=owner, group=group,
+                    size=int(size), mtime=int(mtime), target=target or None, md5=md5 or None)
+
+
+def parse_stat(output, paths):
+    '''
+    Builds the :class:`PathInfo` of each path, by path, from the output of :func:`stat_command`. The paths without a line in the output are considered missing.
+    '''
+    infos = dict((path, PathInfo(path)) for path in paths)
+    lines = [line.rstrip('\r') for line in output.splitlines()]
+    for path, line in zip(paths, lines):
+        if line != MISSING:
+            infos[path] = path_info(path, line.split('|', 9))
+    return infos
+
+
+def owner_command(path, owner):
+    '''
+    Returns the command that changes the owner (and the group, for an ``owner`` like ``'user:group'``) of the entries under a path that don't have it yet, printing how many entries were changed.
+    '''
+    user, _, group = owner.partition(':')
+    condition = '! -user %s' % quote(user)
+    if group:
+        condition = '\\( %s -o ! -group %s \\)' % (condition, quote(group))
+    return 'changed=$(find %s %s -exec chown -h %s {} + -printf .) && echo ${#changed}' % (quote(path), condition, quote(owner))
+
+
+def mode_command(path, mode):
+    '''
+    Returns the command that changes the mode of the entries under a path (except symbolic links) that don't have it yet, printing how many entries were changed.
+    '''
+    return 'changed=$(find %s ! -type l ! -perm %s -exec chmod %s {} + -printf .) && echo ${#changed}' % (quote(path), mode, mode)
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for recording the commands that roles run in the servers, and for replaying them later without any server.
+
+A :class:`Recorder` saves every :meth:`execute <provy.core.roles.Role.execute>` and :meth:`put_file <provy.core.roles.Role.put_file>` call, with its output, exit code and latency, to a file. A :class:`Player` answers the same calls from that file, optionally sleeping for the recorded latency, so that the number of round trips and the time taken by a change in a role can be measured offline::
+
+    $ provy -s frontend --record=frontend.provy-trace
+    $ provy -s frontend --replay=frontend.provy-trace --replay-latency
+
+The provy agent is not used while recording or replaying, so that its checks go through ``execute`` and are recorded too. Neither are the facts kept between runs (refer to :class:`FactStore <provy.core.facts.FactStore>`), so that a replay asks for the facts with the same command as the recording.
+'''
+
+import json
+import re
+import time
+from collections import defaultdict
+
+import fabric.api
+from fabric.utils import abort, error
+
+from provy.core.errors import ReplayError
+from provy.core.sessions import CommandResult
+
+
+UNIQUE_IDS = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|[0-9a-f]{32}')
+
+
+def normalize(command):
+    '''
+    Replaces the random ids (like the ones in temporary file names and output markers) in a command, so that the same command matches across runs.
+    '''
+    return UNIQUE_IDS.sub('<id>', command)
+
+
+class Recorder(object):
+    '''
+    Runs the calls in the servers, saving each one of them, as a JSON line, to the file at ``path``.
+
+    :param path: Path of the file to record to.
+    :type path: :class:`str`
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w')
+
+    def execute(self, kind, command, run):
+        '''
+        Runs ``run`` (the actual call to the server) and records its result.
+
+        :param kind: Either ``'execute'`` or ``'put'``.
+        :type kind: :class:`str`
+        :param command: The command being run (or the target path, for uploads).
+        :type command: :class:`str`
+        :param run: Callable that makes the call to the server.
+        :type run: callable
+        '''
+        entry = {'host': fabric.api.env.host_string, 'kind': kind, 'command': command}
+        start = time.time()
+        try:
+            result = run()
+        except SystemExit:
+            entry.update(aborted=True, latency=time.time() - start)
+            self.write(entry)
+            raise
+
+        entry.update(
+            latency=time.time() - start,
+            output=str(result) if kind == 'execute' else None,
+            stderr=getattr(result, 'stderr', ''),
+            return_code=getattr(result, 'return_code', 0),
+        )
+        self.write(entry)
+        return result
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class Player(object):
+    '''
+    Answers the calls with the results recorded by a :class:`Recorder`, without connecting to any server.
+
+    Calls are matched, per server, by their kind and command (ignoring random ids); a command run more times than it was recorded gets its last recorded result again.
+
+    :param path: Path of the recorded file.
+    :type path: :class:`str`
+    :param latency: If :data:`True`, sleeps for the recorded latency of each call. Defaults to :data:`False`.
+    :type latency: :class:`bool`
+    '''
+    def __init__(self, path, latency=False):
+        self.path = path
+        self.latency = latency
+        self.entries = defaultdict(list)
+        self.positions = defaultdict(int)
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries[self.key(entry['host'], entry['kind'], entry['command'])].append(entry)
+
+    def key(self, host, kind, command):
+        return (host, kind, normalize(command))
+
+    def find(self, kind, command):
+        key = self.key(fabric.api.env.host_string, kind, command)
+        entries = self.entries.get(key)
+        if not entries:
+            raise ReplayError('No recorded result for %s "%s" in %s' % (kind, command, key[0]))
+        position = self.positions[key]
+        self.positions[key] = position + 1
+        return entries[min(position, len(entries) - 1)]
+
+    def execute(self, kind, command, run):
+        '''
+        Returns the recorded result for the call, instead of calling ``run``.
+
+        Just like the actual call would, aborts if the recorded call aborted or failed (unless fabric's ``warn_only`` setting is on).
+
+        :raise: :class:`ReplayError <provy.core.errors.ReplayError>` if the call was never recorded.
+        '''
+        entry = self.find(kind, command)
+        if self.latency:
+            time.sleep(entry['latency'])
+
+        if entry.get('aborted'):
+            abort('Recorded %s aborted: %s' % (kind, command))
+        if kind != 'execute':
+            return None
+
+        result = CommandResult(entry['output'], entry['stderr'], entry['return_code'], command)
+        if result.failed:
+            error("Recorded command received nonzero return code %s while executing!\n\nRequested: %s" % (result.return_code, command),
+                  stdout=result, stderr=result.stderr)
+        return result
+
+    def close(self):
+        pass
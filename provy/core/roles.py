@@ -6,17 +6,62 @@ Module responsible for the base Role and its operations.
 '''
 import re
 import codecs
+import hashlib
 from contextlib import contextmanager
+from functools import wraps
+import inspect
 import os
+import posixpath
+import sys
+import tarfile
+import time
 from os.path import exists, split, dirname, isabs
 from datetime import datetime
-from tempfile import gettempdir, NamedTemporaryFile
+from tempfile import gettempdir, NamedTemporaryFile, TemporaryFile
 
 import fabric.api
+from fabric.utils import error
+from pipes import quote
 from jinja2 import Environment, PackageLoader, FileSystemLoader
 import uuid
 from StringIO import StringIO
 
+from provy.core.background import BackgroundCommand
+from provy.core.batch import MutationQueue, PendingResult
+from provy.core.blobs import payload_digest
+from provy.core.channels import RemoteChannel, iter_lines, spooled
+from provy.core.compression import COMPRESS_THRESHOLD, SAMPLE_SIZE, CompressedUpload, worth_compressing
+from provy.core.delta import DELTA_THRESHOLD, MAX_LITERAL_FRACTION, block_size_for, write_delta
+from provy.core.facts import DistroInfo, HostFacts, parse_distro_info  # NOQA
+from provy.core.hashing import LocalHashes
+from provy.core.pathinfo import mode_command, owner_command, parse_stat, path_info, stat_command
+from provy.core.stats import find_caller, payload_size
+from provy.core.sync import compare, local_manifest, manifest_command, parse_manifest
+
+
+def query(*path_arguments):
+    '''
+    Decorator for :class:`Role` methods that only read from the remote server.
+
+    ``path_arguments`` are the names of the method arguments holding the remote paths that the query depends on. Before the query runs, any queued mutation over those paths is flushed (refer to :mod:`provy.core.batch`); mutations over other paths stay queued.
+
+    The result is remembered for the current server, keyed by the method and its arguments, until a change to one of those paths (refer to :mod:`provy.core.memo`).
+    '''
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            arguments = inspect.getcallargs(method, self, *args, **kwargs)
+            paths = [arguments.pop(name) for name in path_arguments]
+            arguments.pop('self')
+            key = (method, tuple(paths), tuple(sorted(arguments.items())))
+            try:
+                hash(key)
+            except TypeError:
+                key = None
+            return self._query(paths, lambda: method(self, *args, **kwargs), key)
+        return wrapper
+    return decorator
+
 
 class UsingRole(object):
     '''
@@ -67,10 +112,10 @@ class Role(object):
             context['used_roles'] = {}
         if 'roles_in_context' not in context:
             context['roles_in_context'] = {}
-        self._paths_to_remove = set()
         self.prov = prov
         self.context = context
         self.__distro_info = None
+        self.__tracking = 0
 
     def register_template_loader(self, package_name):
         '''
@@ -200,11 +245,116 @@ class Role(object):
                 def cleanup(self):
                     pass
         '''
-        for path in self._paths_to_remove:
+        self.flush_mutations()
+
+    def __agent(self):
+        return self.context.get('agent')
+
+    @contextmanager
+    def batch(self):
+        '''
+        Context manager that defers the changes made by the base helpers (like :meth:`ensure_dir` or :meth:`change_path_owner`), so that they are all sent at once, as a single shell script, when the block ends.
+
+        Inside the block, read-only helpers (like :meth:`remote_exists`) still run right away, flushing first only the queued commands that touch the paths they read. Any other command (like the ones run with :meth:`execute`, whose output may be needed right away) also runs right away, after all the queued ones. If the block raises an exception, the commands queued inside it are discarded.
+
+        Example:
+        ::
+
+            from provy.core import Role
+
+            class MySampleRole(Role):
+                def provision(self):
+                    with self.batch():
+                        self.ensure_dir('/srv/app', owner='app')
+                        self.ensure_dir('/srv/app/logs', owner='app')
+                        self.change_path_mode('/srv/app', 755, recursive=True)
+        '''
+        queue = self.context.setdefault('mutations', MutationQueue())
+        queued_before = list(queue.pending)
+        queue.deferring += 1
+        try:
+            yield queue
+        except Exception:
+            queue.deferring -= 1
+            queue.pending = [mutation for mutation in queue.pending if any(mutation is queued for queued in queued_before)]
+            raise
+        queue.deferring -= 1
+        if not queue.active:
+            self.flush_mutations()
+
+    def flush_mutations(self):
+        '''
+        Runs right away all the commands queued for the current server (refer to :mod:`provy.core.batch`). The base :meth:`cleanup` does this for you.
+
+        Example:
+        ::
+
+            from provy.core import Role
+
+            class MySampleRole(Role):
+                def provision(self):
+                    self.ensure_dir('/srv/app', owner='app')
+                    self.flush_mutations()
+        '''
+        queue = self.context.get('mutations')
+        if queue is not None:
+            queue.flush(self.__run_batch)
+
+    def __run_batch(self, command, sudo=False):
+        # Each queued command carries the context managers it was queued in.
+        with self.__showing_command_output(False):
+            with fabric.api.settings(warn_only=True, cwd='', command_prefixes=[], path='', shell_env={}):
+                return self.__execute_command(command, sudo=sudo)
+
+    def __flush_mutations_over(self, paths):
+        queue = self.context.get('mutations')
+        if queue is not None and queue.depends_on(paths):
+            self.flush_mutations()
+
+    def _query(self, paths, fetch, key=None):
+        cache = self.context.get('query_cache')
+        if cache is not None and key is not None:
             try:
-                self.remove_dir(path, True, True)
-            except Exception:
-                self.log("Couldn't clean path {}".format(path))
+                return cache.get(key)
+            except KeyError:
+                pass
+
+        self.__flush_mutations_over(paths)
+        with self.__tracked():
+            value = fetch()
+
+        if cache is not None and key is not None:
+            cache.store(key, paths, value)
+        return value
+
+    def __forget_queries(self, paths=None):
+        cache = self.context.get('query_cache')
+        if cache is not None:
+            cache.invalidate(paths)
+
+    def _mutate(self, command, paths, sudo=False):
+        self.__forget_queries(paths)
+        queue = self.context.get('mutations')
+        if queue is not None and queue.active:
+            return queue.add(command, sudo=sudo, paths=paths)
+        self.__flush_mutations_over(paths)
+        with self.__tracked():
+            return self.execute(command, stdout=False, sudo=sudo)
+
+    @contextmanager
+    def __tracked(self):
+        # Commands run by queries and mutations with known paths take care
+        # of the queue and the cache themselves.
+        self.__tracking += 1
+        try:
+            yield
+        finally:
+            self.__tracking -= 1
+
+    def __before_command(self):
+        if not self.__tracking:
+            self.__forget_queries()
+            self.flush_mutations()
 
     @contextmanager
     def __showing_command_output(self, show=True):
@@ -236,6 +386,12 @@ class Role(object):
         `run <https://fabric.readthedocs.org/en/latest/api/core/operations.html#fabric.operations.run>`_
         and `sudo <https://fabric.readthedocs.org/en/latest/api/core/operations.html#fabric.operations.sudo>`_ methods.
 
+        If the server has the ``sudo_session`` setting enabled, commands that need the super-user (or another user) are sent to a persistent session for that user instead of paying a separate ``sudo`` invocation each (refer to :mod:`provy.core.sessions`).
+
+        When recording or replaying (refer to :mod:`provy.core.replay`), the command and its result go through the recorder or the player.
+
+        Any command queued by the base helpers runs before this one (refer to :mod:`provy.core.batch`).
+
         :param command: The command to be executed.
         :type command: :class:`str`
         :param stdout: If you specify this argument as False, the standard output of the command execution will not be displayed in the console. Defaults to True.
@@ -262,15 +418,152 @@ class Role(object):
                     self.execute('ls /', stdout=False, sudo=True)
                     self.execute('ls /', stdout=False, user='vip')
         '''
+        self.__before_command()
+
         with self.__showing_command_output(stdout):
             with self.__cd(cwd):
                 return self.__execute_command(command, sudo=sudo, user=user)
 
+    def __measure(self, kind, call, sent=0):
+        stats = self.context.get('stats')
+        if stats is None:
+            return call()
+        caller = find_caller(sys._getframe(1), Role)
+        return stats.measure(fabric.api.env.host_string, kind, caller, call, sent)
+
+    def __account(self, kind, elapsed, sent=0, received=0):
+        # For calls that can't be wrapped by __measure, like the lines
+        # yielded by execute_iter.
+        stats = self.context.get('stats')
+        if stats is not None:
+            stats.add(fabric.api.env.host_string, kind, find_caller(sys._getframe(1), Role), elapsed, sent, received)
+
+    def __call_agent(self, operation, **arguments):
+        return self.__measure('agent', lambda: self.__agent().call(operation, **arguments))
+
     def __execute_command(self, command, sudo=False, user=None):
+        return self.__measure('execute', lambda: self.__send_command(command, sudo=sudo, user=user), sent=len(command))
+
+    def __send_command(self, command, sudo=False, user=None):
+        transport = self.context.get('transport')
+        if transport is not None:
+            return transport.execute('execute', command, lambda: self.__run_command(command, sudo=sudo, user=user))
+        return self.__run_command(command, sudo=sudo, user=user)
+
+    def __run_command(self, command, sudo=False, user=None):
         if sudo or (user is not None):
+            sessions = self.context.get('sessions')
+            if sessions is not None:
+                return sessions.run(command, user=user)
             return fabric.api.sudo(command, user=user)
         return fabric.api.run(command)
 
+    def execute_iter(self, command, stdout=False, sudo=False, user=None, cwd=None, max_memory=None):
+        '''
+        Just like :meth:`execute`, but instead of returning the whole output at once, yields it line by line as it arrives from the remote server.
+
+        Use this method for commands with large outputs that are parsed line by line, like listings.
+
+        :param command: The command to be executed.
+        :type command: :class:`str`
+        :param stdout: If you specify this argument as True, the output lines will also be displayed in the console. Defaults to :data:`False`.
+        :type stdout: :class:`bool`
+        :param sudo: Specifies whether this command needs to be run as the super-user. Doesn't need to be provided if the "user" parameter (below) is provided. Defaults to :data:`False`.
+        :type sudo: :class:`bool`
+        :param user: If specified, will be the user with which the command will be executed. Defaults to :data:`None`.
+        :type user: :class:`str`
+        :param cwd: Represents a directory on remote server. If specified we will cd into that directory before executing command.
+        :type cwd: :class:`str`
+        :param max_memory: If specified, the whole output is read from the server right away (so the command doesn't wait for the lines to be consumed), keeping up to this number of bytes in memory and spilling the rest to a local temporary file. Defaults to :data:`None`, which means output is read from the server only as the lines are consumed.
+        :type max_memory: :class:`int`
+
+        :return: The output lines, without line breaks.
+        :rtype: iterator
+
+        Example:
+        ::
+
+            from provy.core import Role
+
+            class MySampleRole(Role):
+                def provision(self):
+                    for line in self.execute_iter('dpkg -l', max_memory=1024 * 1024):
+                        if line.startswith('ii'):
+                            pass
+        '''
+        if 'transport' in self.context:
+            for line in self.execute(command, stdout=stdout, sudo=sudo, user=user, cwd=cwd).splitlines():
+                yield line
+            return
+
+        self.__before_command()
+        env = fabric.api.env
+        if cwd is None:
+            cwd = env.cwd
+        if cwd:
+            command = 'cd %s && %s' % (cwd, command)
+        if stdout:
+            print "[%s] %s: %s" % (env.host_string, 'sudo' if sudo or user is not None else 'run', command)
+
+        start = time.time()
+        received = 0
+        channel = RemoteChannel(command, sudo=sudo, user=user).open()
+        try:
+            chunks = channel.iter_chunks()
+            if max_memory is not None:
+                chunks = spooled(chunks, max_memory)
+            for line in iter_lines(chunks):
+                received += len(line) + 1
+                if stdout:
+                    print "[%s] out: %s" % (env.host_string, line)
+                yield line
+            return_code = channel.exit_status()
+        finally:
+            channel.close()
+            self.__account('execute', time.time() - start, sent=len(command), received=received)
+
+        if return_code != 0:
+            error("execute_iter() received nonzero return code %s while executing!\n\nRequested: %s" % (return_code, command),
+                  stderr=channel.stderr)
+
+    def execute_async(self, command, sudo=False, user=None, cwd=None):
+        '''
+        Starts a command in the remote server and returns right away, while the command keeps running detached from the connection.
+
+        Use this method for long commands (like compiling from source or installing many packages) that other steps in the same server don't depend on. Before the roles are cleaned up, provy waits for all the commands that are still running.
+
+        :param command: The command to be executed.
+        :type command: :class:`str`
+        :param sudo: Specifies whether this command needs to be run as the super-user. Doesn't need to be provided if the "user" parameter (below) is provided. Defaults to :data:`False`.
+        :type sudo: :class:`bool`
+        :param user: If specified, will be the user with which the command will be executed. Defaults to :data:`None`.
+        :type user: :class:`str`
+        :param cwd: Represents a directory on remote server. If specified we will cd into that directory before executing command.
+        :type cwd: :class:`str`
+
+        :return: A handle to check on the command, with ``poll()``, ``wait()`` and ``output()`` methods.
+        :rtype: :class:`BackgroundCommand <provy.core.background.BackgroundCommand>`
+
+        Example:
+        ::
+
+            from provy.core import Role
+
+            class MySampleRole(Role):
+                def provision(self):
+                    build = self.execute_async('make && make install', cwd='/tmp/node-src', sudo=True)
+                    self.ensure_dir('/srv/app', owner='app')
+                    if build.wait() == 0:
+                        self.log(build.output())
+        '''
+        if cwd is not None:
+            command = 'cd %s && %s' % (cwd, command)
+        directory = '%s/provy-async-%s' % (self.remote_scratch_dir(), uuid.uuid4().hex)
+
+        background = BackgroundCommand(self, command, directory, sudo=sudo, user=user).start()
+        self.context.setdefault('background', []).append(background)
+        return background
+
     def execute_local(self, command, stdout=True, sudo=False, user=None):
         '''
         Allows you to perform any shell action in the local machine. It is an abstraction over the `fabric.api.local <https://fabric.readthedocs.org/en/latest/api/core/operations.html#fabric.operations.local>`_ method.
@@ -297,6 +590,7 @@ class Role(object):
                     self.execute_local('ls /', stdout=False, sudo=True)
                     self.execute_local('ls /', stdout=False, user='vip')
         '''
+        self.__before_command()
         with self.__showing_command_output(stdout):
             return self.__execute_local_command(command, sudo=sudo, user=user)
 
@@ -305,7 +599,7 @@ class Role(object):
             command = 'sudo -u %s %s' % (user, command)
         elif sudo:
             command = 'sudo %s' % command
-        return fabric.api.local(command, capture=True)
+        return self.__measure('local', lambda: fabric.api.local(command, capture=True))
 
     def execute_python(self, command, stdout=True, sudo=False):
         '''
@@ -357,6 +651,7 @@ class Role(object):
 
         return self.execute('python "{}"'.format(script_file), stdout, sudo)
 
+    @query('path')
     def remote_list_directory(self, path):
         """
         Lists contents of remote directory and returns them as a python
@@ -368,11 +663,15 @@ class Role(object):
 
         :rtype: list
         """
+        if self.__agent() is not None:
+            return self.__call_agent('list_directory', path=path)
+
         import json  # in case someone uses python 2.6
         result = self.execute_python('''import os, json; print json.dumps(os.listdir('{}'))'''.format(path), False, True)
         contents = json.loads(result)
         return contents
 
+    @query()
     def get_logged_user(self):
         '''
         Returns the currently logged user in the remote server.
@@ -389,8 +688,31 @@ class Role(object):
                 def provision(self):
                     self.context['my-user'] = self.get_logged_user()
         '''
+        if 'facts' in self.context:
+            return self.gather_facts().user
         return self.execute('whoami', stdout=False)
 
+    @query()
+    def get_hostname(self):
+        '''
+        Returns the hostname of the remote server.
+
+        :return: The hostname
+        :rtype: :class:`str`
+
+        Example:
+        ::
+
+            from provy.core import Role
+
+            class MySampleRole(Role):
+                def provision(self):
+                    self.context['hostname'] = self.get_hostname()
+        '''
+        if 'facts' in self.context:
+            return self.gather_facts().hostname
+        return self.execute_python('import os; print os.uname()[1]', stdout=False)
+
     def local_exists(self, file_path):
         '''
         Returns True if the file exists locally.
@@ -413,6 +735,7 @@ class Role(object):
         '''
         return exists(file_path)
 
+    @query('file_path')
     def remote_exists(self, file_path):
         '''
         Returns True if the file exists in the remote server.
@@ -433,8 +756,11 @@ class Role(object):
                     if self.remote_exists('/tmp/my-file'):
                         pass
         '''
+        if self.__agent() is not None:
+            return self.__call_agent('exists', path=file_path)
         return self.execute('test -f %s; echo $?' % file_path, stdout=False, sudo=True) == '0'
 
+    @query('file_path')
     def remote_exists_dir(self, file_path):
         '''
         Returns True if the directory exists in the remote server.
@@ -455,8 +781,44 @@ class Role(object):
                     if self.remote_exists_dir('/tmp'):
                         pass
         '''
+        if self.__agent() is not None:
+            return self.__call_agent('exists_dir', path=file_path)
         return self.execute('test -d %s; echo $?' % file_path, stdout=False, sudo=True) == '0'
 
+    def remote_stat(self, paths, hashes=False):
+        '''
+        Returns information about many remote paths at once, gathered with a single command: whether each of them exists, its type, mode, owner and group, size, modification time, the path it points to (for symbolic links) and, optionally, the md5 hash of its contents.
+
+        Symbolic links are not followed, except for the hashes.
+
+        :param paths: The paths to check.
+        :type paths: :class:`list`
+        :param hashes: Indicates whether the md5 hashes of the regular files should also be calculated. Defaults to :data:`False`.
+        :type hashes: :class:`bool`
+
+        :return: A :class:`PathInfo <provy.core.pathinfo.PathInfo>` for each path, by path.
+        :rtype: :class:`dict`
+
+        Example:
+        ::
+
+            from provy.core import Role
+
+            class MySampleRole(Role):
+                def provision(self):
+                    infos = self.remote_stat(['/etc/nginx/nginx.conf', '/etc/nginx/sites-enabled/default'])
+                    if infos['/etc/nginx/nginx.conf'].owner != 'root':
+                        pass
+        '''
+        paths = list(paths)
+
+        def fetch():
+            if self.__agent() is not None:
+                return dict((path, path_info(path, fields)) for path, fields in zip(paths, self.__call_agent('stat', paths=paths, hashes=hashes)))
+            return parse_stat(self.execute(stat_command(paths, hashes), stdout=False, sudo=True), paths)
+
+        return self._query(paths, fetch, key=('remote_stat', tuple(paths), hashes))
+
     def local_temp_dir(self):
         '''
         Returns the path of a temporary directory in the local machine.
@@ -475,6 +837,7 @@ class Role(object):
         '''
         return gettempdir()
 
+    @query()
     def remote_temp_dir(self):
         '''
         Returns the path of a temporary directory in the remote server.
@@ -491,15 +854,58 @@ class Role(object):
                 def provision(self):
                     self.context['target_dir'] = self.remote_temp_dir()
         '''
+        if 'facts' in self.context:
+            return self.gather_facts().temp_dir
+        if self.__agent() is not None:
+            return self.__call_agent('temp_dir')
         return self.execute_python('from tempfile import gettempdir; print gettempdir()', stdout=False)
 
+    def remote_scratch_dir(self):
+        '''
+        Returns the path of the provy scratch directory in the remote server, creating it the first time any role in the server asks for it.
+
+        The scratch directory is a directory of its own inside :meth:`remote_temp_dir`, shared by all the roles in the server and removed, with everything in it, with a single command after all the roles are cleaned up (refer to :meth:`remove_remote_scratch_dir`). Like the system temp dir, anyone can create files in it.
+
+        :return: The scratch dir path
+        :rtype: :class:`str`
+
+        Example:
+        ::
+
+            from provy.core import Role
+
+            class MySampleRole(Role):
+                def provision(self):
+                    self.execute('tar -czf %s/backup.tgz /etc' % self.remote_scratch_dir(), sudo=True)
+        '''
+        directory = self.context.get('scratch_dir')
+        if directory is None:
+            directory = self.context['scratch_dir'] = '%s/provy-%s' % (self.remote_temp_dir(), uuid.uuid4().hex)
+            self._mutate('mkdir -m 1777 %s' % directory, [directory])
+        return directory
+
+    def remove_remote_scratch_dir(self):
+        '''
+        Removes the provy scratch directory (refer to :meth:`remote_scratch_dir`) and everything in it, if it was created. provy calls this method after all the roles in the server are cleaned up.
+        '''
+        directory = self.context.pop('scratch_dir', None)
+        if directory is None:
+            return
+        try:
+            self._mutate('rm -rf %s' % directory, [directory], sudo=True)
+            self.flush_mutations()
+        except Exception:
+            self.log("Couldn't clean path {}".format(directory))
+
     def create_remote_temp_file(self, prefix='', suffix='', cleanup=True):
         """
         Creates random unique file name in the remote server temp dir.
 
         This file is not uploaded by server, but because it is generated
         by :class:`uuid.uuid4` you can be sure no other process will
-        clash with it.
+        clash with it. No command runs to create the name: files to be
+        cleaned up are named inside :meth:`remote_scratch_dir`, which is
+        removed as a whole, and the others inside :meth:`remote_temp_dir`.
 
         :param prefix: Optional prefix to the file name.
         :type prefix: :class:`str`
@@ -513,17 +919,15 @@ class Role(object):
         :return: Created file name.
         :rtype: str
         """
-        file_name = "{}/{}{}.{}".format(self.remote_temp_dir(), prefix,
-                                        str(uuid.uuid4()), suffix)
-        if cleanup:
-            self._paths_to_remove.add(file_name)
-        return file_name
+        directory = self.remote_scratch_dir() if cleanup else self.remote_temp_dir()
+        return "{}/{}{}.{}".format(directory, prefix, str(uuid.uuid4()), suffix)
 
     def create_remote_temp_dir(self, dirname=None, owner=None, chmod=None, cleanup=True):
         """
 
         Creates temporary directory on remote server. This directory will be
-        stored in temporary directory on remote server.
+        stored in temporary directory on remote server (inside
+        :meth:`remote_scratch_dir`, if it is to be cleaned up).
 
         :param dirname: Name of the directory. If None random name will be
             choosen. Defaults to None.
@@ -547,16 +951,14 @@ class Role(object):
         if dirname is None:
             dirname = str(uuid.uuid4())  # NOQA
 
-        prepared_dirname = "{}/{}".format(self.remote_temp_dir(), dirname)
+        parent = self.remote_scratch_dir() if cleanup else self.remote_temp_dir()
+        prepared_dirname = "{}/{}".format(parent, dirname)
 
         self.ensure_dir(prepared_dirname, owner, owner is not None)
 
         if chmod is not None:
             self.change_path_mode(prepared_dirname, chmod)
 
-        if cleanup:
-            self._paths_to_remove.add(prepared_dirname)
-
         return prepared_dirname
 
     def ensure_dir(self, directory, owner=None, sudo=False):
@@ -582,8 +984,9 @@ class Role(object):
         if owner:
             sudo = True
 
-        if not self.remote_exists_dir(directory):
-            self.execute('mkdir -p %s' % directory, stdout=False, sudo=sudo)
+        info = self.remote_stat([directory])[directory]
+        if not info.is_dir:
+            self._mutate('mkdir -p %s' % directory, [directory], sudo=sudo)
 
         if owner:
             self.change_path_owner(directory, owner)
@@ -592,11 +995,16 @@ class Role(object):
         '''
         Changes the owner of a given path. Please be advised that this method is recursive, so if the path is a directory, all contents of it will belong to the specified owner.
 
+        Only the entries that are not owned by the owner yet are changed (by a single ``find`` command), so running it again over an unchanged tree changes nothing. The owner may also be given as ``'user:group'``, in which case the entries with a different group are changed as well.
+
         :param path: Path to have its owner changed.
         :type path: :class:`str`
-        :param owner: User that should own this path.
+        :param owner: User (or ``'user:group'``) that should own this path.
         :type owner: :class:`str`
 
+        :return: The number of entries changed, or :data:`None` if the change was queued (refer to :mod:`provy.core.batch`).
+        :rtype: :class:`int`
+
         Example:
         ::
 
@@ -606,8 +1014,12 @@ class Role(object):
                 def provision(self):
                     self.change_path_owner(path='/etc/my-path', owner='someuser')
         '''
-        self.execute('chown -R %s %s' % (owner, path), stdout=False, sudo=True)
+        changed = self.__changed_count(self._mutate(owner_command(path, owner), [path], sudo=True))
+        if changed:
+            self.log("Changed the owner of %d paths under %s to %s." % (changed, path, owner))
+        return changed
 
+    @query('path')
     def get_object_mode(self, path):
         '''
         Returns the permission mode of a given object. Raises IOError if the path doesn't exist.
@@ -630,14 +1042,17 @@ class Role(object):
                     if self.get_object_mode('/home/user/logs') == 644:
                         pass
         '''
-        if not self.remote_exists(path) and not self.remote_exists_dir(path):
+        info = self.remote_stat([path])[path]
+        if not info.exists:
             raise IOError('The file at path %s does not exist' % path)
-        return int(self.execute('stat -c %%a %s' % path, stdout=False, sudo=True))
+        return info.mode
 
     def change_path_mode(self, path, mode, recursive=False):
         '''
         Changes the mode of a given path.
 
+        Only the entries that don't have the mode yet are changed: the path is checked first, or, recursively, a single ``find`` command changes the entries with a different mode (except symbolic links).
+
         :param path: Path to have its mode changed.
         :type path: :class:`str`
         :param mode: Mode to change to.
@@ -645,6 +1060,9 @@ class Role(object):
         :param recursive: Indicates if the mode of the objects in the path should be changed recursively. Defaults to :class:`False`.
         :type recursive: :class:`bool`
 
+        :return: The number of entries changed, or :data:`None` if the change was queued (refer to :mod:`provy.core.batch`).
+        :rtype: :class:`int`
+
         Example:
         ::
 
@@ -654,19 +1072,30 @@ class Role(object):
                 def provision(self):
                     self.change_path_mode(directory='/home/user/logs', mode=644, recursive=True)
         '''
-        options = ""
         if recursive:
-            options += "-R "
+            changed = self.__changed_count(self._mutate(mode_command(path, mode), [path], sudo=True))
+            if changed:
+                self.log("Changed the mode of %d paths under %s to %s." % (changed, path, mode))
+            return changed
 
         previous_mode = self.get_object_mode(path)
-        if previous_mode != mode or recursive:
-            self.execute('chmod %s%s %s' % (options, mode, path), stdout=False, sudo=True)
-            self.log("Path %s had mode %s. Changed it %sto %s." % (path, previous_mode, recursive and "recursively " or "", mode))
+        if previous_mode == mode:
+            return 0
+        self._mutate('chmod %s %s' % (mode, path), [path], sudo=True)
+        self.log("Path %s had mode %s. Changed it to %s." % (path, previous_mode, mode))
+        return 1
+
+    def __changed_count(self, result):
+        if isinstance(result, PendingResult) and not result.done:
+            return None
+        return int(str(result).strip() or 0)
 
     def md5_local(self, path):
         '''
         Calculates an md5 hash for a given file in the local system. Returns :class:`None` if file does not exist.
 
+        The file is hashed in-process, and the hash is remembered for as long as the file's size, modification time and inode don't change (refer to :mod:`provy.core.hashing`).
+
         :param path: Path of the local file.
         :type path: :class:`str`
 
@@ -682,12 +1111,9 @@ class Role(object):
                 def provision(self):
                     hash = self.md5_local('/tmp/my-file')
         '''
-        if not self.local_exists(path):
-            return None
-
-        result = self.execute_local(self.__md5_hash_command(path), stdout=False, sudo=True)
-        return result.strip()
+        return self.context.setdefault('local_hashes', LocalHashes()).md5(path)
 
+    @query('path')
     def md5_remote(self, path):
         '''
         Calculates an md5 hash for a given file in the remote system. Returns :class:`None` if file does not exist.
@@ -707,12 +1133,51 @@ class Role(object):
                 def provision(self):
                     hash = self.md5_remote('/tmp/my-file')
         '''
+        if self.__agent() is not None:
+            return self.__call_agent('md5', path=path)
+
         if not self.remote_exists(path):
             return None
 
         result = self.execute(self.__md5_hash_command(path), stdout=False, sudo=True)
         return result.strip()
 
+    def md5_remote_files(self, paths):
+        '''
+        Calculates the md5 hashes for many files in the remote system at once, with a single command. Files that don't exist get :class:`None`.
+
+        :param paths: Paths of the remote files.
+        :type paths: :class:`list`
+
+        :return: The hash of each file, by path.
+        :rtype: :class:`dict`
+
+        Example:
+        ::
+
+            from provy.core import Role
+
+            class MySampleRole(Role):
+                def provision(self):
+                    hashes = self.md5_remote_files(['/etc/hosts', '/etc/hostname'])
+        '''
+        paths = list(paths)
+
+        def fetch():
+            if self.__agent() is not None:
+                return self.__call_agent('md5_files', paths=paths)
+
+            hashes = dict((path, None) for path in paths)
+            if paths:
+                output = self.execute('md5sum %s 2>/dev/null; true' % ' '.join(quote(path) for path in paths), stdout=False, sudo=True)
+                for line in output.splitlines():
+                    md5, path = line[:32], line[34:].rstrip('\r')
+                    if path in hashes:
+                        hashes[path] = md5
+            return hashes
+
+        return self._query(paths, fetch, key=('md5_remote_files', tuple(paths)))
+
     def __md5_hash_command(self, path):
         return 'md5sum %s | cut -d " " -f 1' % path
 
@@ -744,7 +1209,7 @@ class Role(object):
                 command = 'rm -rf %s'
             else:
                 command = 'rmdir %s'
-            self.execute(command % path, stdout=False, sudo=sudo)
+            self._mutate(command % path, [path], sudo=sudo)
             if stdout:
                 self.log('%s removed!' % path)
             return True
@@ -773,7 +1238,7 @@ class Role(object):
         '''
 
         if self.remote_exists(path):
-            self.execute('rm -f %s' % path, stdout=False, sudo=sudo)
+            self._mutate('rm -f %s' % path, [path], sudo=sudo)
             self.log('%s removed!' % path)
             return True
         return False
@@ -798,20 +1263,19 @@ class Role(object):
                 def provision(self):
                     self.remote_symlink('/home/user/my-app', '/etc/init.d/my-app', sudo=True)
         '''
-        if not self.remote_exists(from_file):
+        infos = self.remote_stat([from_file, to_file])
+        if not infos[from_file].exists:
             raise RuntimeError("The file to create a symlink from (%s) was not found!" % from_file)
 
         command = 'ln -sf %s %s' % (from_file, to_file)
-        if self.remote_exists(to_file):
-            result = self.execute('ls -la %s' % to_file, stdout=False, sudo=sudo)
-            if '->' in result:
-                path = result.split('->')[-1].strip()
-                if path != from_file:
-                    self.log('Symlink has different path(%s). Syncing...' % path)
-                    self.execute(command, stdout=False, sudo=sudo)
+        to_info = infos[to_file]
+        if to_info.exists:
+            if to_info.is_link and to_info.target != from_file:
+                self.log('Symlink has different path(%s). Syncing...' % to_info.target)
+                self._mutate(command, [to_file], sudo=sudo)
         else:
             self.log('Symlink not found at %s! Creating...' % from_file)
-            self.execute(command, stdout=False, sudo=sudo)
+            self._mutate(command, [to_file], sudo=sudo)
 
     def __extend_context(self, options):
         extended = {}
@@ -825,6 +1289,12 @@ class Role(object):
         '''
         Puts a file to the remote server.
 
+        Files larger than :data:`provy.core.compression.COMPRESS_THRESHOLD` bytes (or the ``compress_threshold`` of the server) are compressed on the fly, unless they don't compress well (refer to :mod:`provy.core.compression`).
+
+        If the blob cache is enabled for the server and the same contents were already uploaded to it, they are copied inside the server instead (refer to :mod:`provy.core.blobs`).
+
+        If the agent is enabled for the server and the file is larger than :data:`provy.core.delta.DELTA_THRESHOLD` bytes (or the ``delta_threshold`` of the server), only the parts of it that differ from the remote file are sent (refer to :mod:`provy.core.delta`). The remote file keeps its owner and mode in this case.
+
         :param from_file: Source file in the local system.
         :type from_file: :class:`str`
         :param to_file: Target path in the remote server.
@@ -842,8 +1312,123 @@ class Role(object):
                     self.put_file('/home/user/my-app', '/etc/init.d/my-app', sudo=True)
         '''
 
+        blobs = self.context.get('blobs')
+        digest = payload_digest(from_file) if blobs is not None else None
+        if digest is not None and blobs.contains(digest, self.__run_as_super_user) and (sudo or self.__writable_by_logged_user(to_file)):
+            owner = self.get_logged_user() if sudo else None
+            self._mutate(blobs.copy_command(digest, to_file, owner), [to_file], sudo=True)
+            return
+
+        self.__forget_queries([to_file])
+        self.__flush_mutations_over([to_file])
         with self.__showing_command_output(stdout):
-            fabric.api.put(from_file, to_file, use_sudo=sudo)
+            if not self.__send_delta(from_file, to_file, sudo) and not self.__send_compressed(from_file, to_file, sudo):
+                self.__measure('put', lambda: self.__send_file(from_file, to_file, sudo), sent=payload_size(from_file))
+
+        if digest is not None:
+            blobs.remember(digest, to_file, self.__run_as_super_user)
+
+    def __run_as_super_user(self, command):
+        return self.execute(command, stdout=False, sudo=True)
+
+    def __send_compressed(self, from_file, to_file, sudo):
+        threshold = self.context.get('compress_threshold', COMPRESS_THRESHOLD)
+        if threshold is None or 'transport' in self.context:
+            return False
+        size = payload_size(from_file)
+        if size is None or size < threshold:
+            return False
+
+        source = open(from_file, 'rb') if isinstance(from_file, basestring) else from_file
+        start = source.tell()
+        try:
+            sample = source.read(SAMPLE_SIZE)
+            if not worth_compressing(sample):
+                source.seek(start)
+                return False
+            upload = CompressedUpload(source, sample, to_file, sudo=sudo)
+            self.__measure('put', upload.send, sent=lambda: upload.sent)
+            return True
+        finally:
+            if source is not from_file:
+                source.close()
+
+    def __send_delta(self, from_file, to_file, sudo):
+        agent = self.__agent()
+        threshold = self.context.get('delta_threshold', DELTA_THRESHOLD)
+        if agent is None or threshold is None or not (isinstance(from_file, basestring) or hasattr(from_file, 'seek')):
+            return False
+        size = payload_size(from_file)
+        if size is None or size < max(threshold, 1):
+            return False
+        if not sudo and not self.__writable_by_logged_user(to_file):
+            return False
+
+        block_size = block_size_for(size)
+        signatures = self.__call_agent('signatures', path=to_file, block_size=block_size)
+        if not signatures:
+            return False
+
+        with TemporaryFile() as delta:
+            scanned = write_delta(from_file, signatures, block_size, delta, max_literal=int(size * MAX_LITERAL_FRACTION))
+            if scanned is None:
+                return False
+            literal_bytes, md5 = scanned
+            delta_size = delta.tell()
+            delta.seek(0)
+            remote_delta = self.create_remote_temp_file(prefix='provy-delta-', cleanup=False)
+            self.__measure('put', lambda: fabric.api.put(delta, remote_delta), sent=delta_size)
+
+        try:
+            self.__call_agent('patch', path=to_file, delta_path=remote_delta, block_size=block_size, md5=md5)
+        except IOError:
+            return False
+        self.log('Sent %d changed bytes to %s.' % (literal_bytes, to_file))
+        return True
+
+    def __writable_by_logged_user(self, path):
+        # The agent patches files as the super-user, so a delta must not
+        # change a file that a plain upload couldn't.
+        return self._query([path], lambda: self.execute('test -w %s; echo $?' % quote(path), stdout=False).strip() == '0')
+
+    def __send_file(self, from_file, to_file, sudo):
+        transport = self.context.get('transport')
+        if transport is not None:
+            return transport.execute('put', to_file, lambda: fabric.api.put(from_file, to_file, use_sudo=sudo))
+        return fabric.api.put(from_file, to_file, use_sudo=sudo)
+
+    def _put_archive(self, members, directory='/', sudo=False, commands=()):
+        # Sends the files as a single tar archive, then extracts it under
+        # ``directory`` and runs the given commands in a single command.
+        # ``members`` are (path, content, mode) tuples, with paths relative
+        # to ``directory`` and contents either as strings or as open files,
+        # which are closed once archived.
+        paths = []
+        with TemporaryFile() as archive:
+            tar = tarfile.open(fileobj=archive, mode='w')
+            now = int(time.time())
+            for path, content, mode in members:
+                info = tarfile.TarInfo(path.lstrip('/'))
+                info.mode = int(str(mode), 8)
+                info.mtime = now
+                if isinstance(content, basestring):
+                    info.size = len(content)
+                    tar.addfile(info, StringIO(content))
+                else:
+                    info.size = os.fstat(content.fileno()).st_size
+                    tar.addfile(info, content)
+                    content.close()
+                paths.append(posixpath.join(directory, path.lstrip('/')))
+            tar.close()
+            archive.seek(0)
+
+            remote_archive = self.create_remote_temp_file(prefix='provy-', suffix='tar')
+            self.put_file(archive, remote_archive, stdout=False)
+
+        command = 'tar -xpf %s -C %s --no-same-owner' % (remote_archive, quote(directory))
+        if directory != '/':
+            command = 'mkdir -p %s && %s' % (quote(directory), command)
+        self._mutate(' && '.join([command] + list(commands)), paths, sudo=sudo)
 
     def update_file(self, from_file, to_file, owner=None, options={}, sudo=None):
         '''
@@ -881,13 +1466,151 @@ class Role(object):
                                      },
                                      sudo=True)
         '''
-        update_data = None
-        try:
-            update_data = self._build_update_data(from_file, options, to_file)
-            return self._update_file_with_data(to_file, update_data, from_file, sudo, owner)
-        finally:
-            if update_data and update_data.local_temp_path and exists(update_data.local_temp_path):
-                os.remove(update_data.local_temp_path)
+        update_data = self._build_update_data(from_file, options, to_file)
+        return self._update_file_with_data(to_file, update_data, from_file, sudo, owner)
+
+    def update_files(self, files, sudo=None):
+        '''
+        Just like :meth:`update_file`, but for many files at once: all the templates are rendered locally, the remote files are hashed with a single command, and only the files that changed are sent, in a single archive, with their owners applied in the same command that extracts them.
+
+        Each file is a tuple with the template file, the target path and, optionally, the template options, the owner and the mode (defaults to ``644``) of the file.
+
+        Returns the target paths of the files that were updated.
+
+        :param files: The files to update.
+        :type files: :class:`list`
+        :param sudo: Indicates whether the files should be created by the super-user. Defaults to :data:`None`, which means the super-user is only used if some file has an owner.
+        :type sudo: :class:`bool`
+
+        :return: The target paths of the files that were updated.
+        :rtype: :class:`list`
+
+        Example:
+        ::
+
+            from provy.core import Role
+
+            class MySampleRole(Role):
+                def provision(self):
+                    self.update_files([
+                        ('my-app.init', '/etc/init.d/my-app', {'port': 8000}, 'my-user', 755),
+                        ('my-app.conf', '/etc/my-app.conf', {'port': 8000}),
+                    ], sudo=True)
+        '''
+        rendered = []
+        for entry in files:
+            from_file, to_file, options, owner, mode = (tuple(entry) + (None, None, None))[:5]
+            content = codecs.encode(self.render(from_file, options or {}), 'utf-8')
+            rendered.append((from_file, to_file, owner, mode or 644, content))
+
+        to_md5s = self.md5_remote_files([entry[1] for entry in rendered])
+
+        changed = []
+        for from_file, to_file, owner, mode, content in rendered:
+            from_md5 = hashlib.md5(content).hexdigest()
+            to_md5 = to_md5s.get(to_file)
+            if to_md5 is not None and not self._contents_differ(to_md5, from_md5):
+                continue
+            if to_md5 is not None:
+                self.log('Hashes differ %s => %s! Copying %s to server %s!' % (from_md5, to_md5, from_file, self.context['host']))
+            changed.append((to_file, owner, mode, content))
+
+        if not changed:
+            return []
+
+        owners = {}
+        for to_file, owner, mode, content in changed:
+            if owner:
+                owners.setdefault(owner, []).append(to_file)
+        if sudo is None:
+            sudo = bool(owners)
+
+        commands = ['chown %s %s' % (user, ' '.join(quote(path) for path in paths)) for user, paths in sorted(owners.items())]
+        self._put_archive([(entry[0], entry[3], entry[2]) for entry in changed], sudo=sudo, commands=commands)
+        return [entry[0] for entry in changed]
+
+    def remote_manifest(self, directory):
+        '''
+        Returns the size, the mode (like ``644``) and the md5 hash of each file in a remote directory, with a single command. Refer to :mod:`provy.core.sync`.
+
+        :param directory: Path of the remote directory.
+        :type directory: :class:`str`
+
+        :return: A tuple with the size, mode and hash of each file, by its path relative to `directory`. Empty if `directory` doesn't exist.
+        :rtype: :class:`dict`
+
+        Example:
+        ::
+
+            from provy.core import Role
+
+            class MySampleRole(Role):
+                def provision(self):
+                    for path, (size, mode, md5) in self.remote_manifest('/srv/my-app').items():
+                        pass
+        '''
+        def fetch():
+            if self.__agent() is not None:
+                return dict((path, tuple(entry)) for path, entry in self.__call_agent('manifest', directory=directory).items())
+            return parse_manifest(self.execute(manifest_command(directory), stdout=False, sudo=True))
+
+        return self._query([directory], fetch, key=('remote_manifest', directory))
+
+    def sync_dir(self, local_dir, remote_dir, delete=False, owner=None, sudo=None):
+        '''
+        Makes a remote directory hold the same files as a local one.
+
+        The files in both directories are compared by their size, mode and hash, and only the files that differ are sent, in a single archive; files that only differ in their mode just have it changed. Directories are created as needed, but empty directories are not synced.
+
+        Returns the paths (relative to the directories) of the files that were sent, changed or removed.
+
+        :param local_dir: Path of the local directory.
+        :type local_dir: :class:`str`
+        :param remote_dir: Path of the remote directory.
+        :type remote_dir: :class:`str`
+        :param delete: If :data:`True`, the remote files that don't exist in the local directory are removed. Defaults to :data:`False`.
+        :type delete: :class:`bool`
+        :param owner: If specified, the remote directory is recursively owned by this user whenever something changes in it. Defaults to :data:`None`.
+        :type owner: :class:`str`
+        :param sudo: Indicates whether the files should be written by the super-user. Defaults to :data:`None`, which means the super-user is only used if `owner` is specified.
+        :type sudo: :class:`bool`
+
+        :return: The paths of the files that were sent, changed or removed.
+        :rtype: :class:`list`
+
+        Example:
+        ::
+
+            from provy.core import Role
+
+            class MySampleRole(Role):
+                def provision(self):
+                    self.sync_dir('static', '/srv/my-app/static', delete=True, owner='www-data')
+        '''
+        if sudo is None:
+            sudo = owner is not None
+
+        local = local_manifest(local_dir, md5=self.md5_local)
+        changed, mode_changed, extraneous = compare(local, self.remote_manifest(remote_dir))
+        if not delete:
+            extraneous = []
+        if not (changed or mode_changed or extraneous):
+            return []
+
+        commands = ['chmod %s %s' % (local[path][1], quote(posixpath.join(remote_dir, path))) for path in mode_changed]
+        if extraneous:
+            commands.append('rm -f %s' % ' '.join(quote(posixpath.join(remote_dir, path)) for path in extraneous))
+        if owner:
+            commands.append(owner_command(remote_dir, owner))
+
+        if changed:
+            members = ((path, open(os.path.join(local_dir, path), 'rb'), local[path][1]) for path in changed)
+            self._put_archive(members, directory=remote_dir, sudo=sudo, commands=commands)
+        else:
+            self._mutate(' && '.join(commands), [remote_dir], sudo=sudo)
+
+        self.log('Synced %s to %s: %d files sent, %d changed mode, %d removed.' % (local_dir, remote_dir, len(changed), len(mode_changed), len(extraneous)))
+        return sorted(changed + mode_changed + extraneous)
 
     def _update_file_with_data(self, to_file, update_data, from_file, sudo, owner):
         should_create = not self.remote_exists(to_file)
@@ -897,17 +1620,21 @@ class Role(object):
             self.log('Hashes differ %s => %s! Copying %s to server %s!' % (update_data.from_md5, update_data.to_md5, from_file, self.context['host']))
 
         if should_create or contents_differ:
-            self._force_update_file(to_file, sudo, update_data.local_temp_path, owner)
+            self._force_update_file(to_file, sudo, update_data.content, owner)
             return True
         return False
 
     def _build_update_data(self, from_file, options, to_file):
-        template = self.render(from_file, options)
-        local_temp_path = self.write_to_temp_file(template)
-        from_md5 = self.md5_local(local_temp_path)
+        content = StringIO()
+        digest = hashlib.md5()
+        for chunk in self.__template(from_file).generate(**self.__extend_context(options)):
+            chunk = codecs.encode(chunk, 'utf-8')
+            digest.update(chunk)
+            content.write(chunk)
+        content.seek(0)
         to_md5 = self.md5_remote(to_file)
 
-        update_data = UpdateData(local_temp_path, from_md5, to_md5)
+        update_data = UpdateData(content, digest.hexdigest(), to_md5)
         return update_data
 
     def _contents_differ(self, to_md5, from_md5):
@@ -918,13 +1645,13 @@ class Role(object):
             return None
         return md5.strip()
 
-    def _force_update_file(self, to_file, sudo, local_temp_path, owner):
+    def _force_update_file(self, to_file, sudo, content, owner):
         if sudo is None and owner is not None:
             sudo = True
         elif sudo is None and owner is None:
             sudo = False
 
-        self.put_file(local_temp_path, to_file, sudo)
+        self.put_file(content, to_file, sudo)
 
         if owner:
             self.change_path_owner(to_file, owner)
@@ -957,9 +1684,10 @@ class Role(object):
 
         return local_temp_path
 
+    @query('path')
     def read_remote_file(self, path, sudo=True):
         '''
-        Returns the contents of a remote file.
+        Returns the contents of a remote file, exactly as they are (refer to :meth:`get_file`).
 
         :param path: File path on the remote server.
         :type path: :class:`str`
@@ -978,8 +1706,75 @@ class Role(object):
                 def provision(self):
                     last_update = self.read_remote_file('/tmp/last-update')
         '''
-        result = self.execute_python("import codecs; print codecs.open('%s', 'r', 'utf-8').read()" % path, stdout=False, sudo=sudo)
-        return result
+        content = StringIO()
+        self.get_file(path, content, sudo=sudo)
+        return content.getvalue()
+
+    def get_file(self, from_file, to_file, sudo=False, offset=0, length=None):
+        '''
+        Downloads a remote file (or a range of its bytes) to a local file or to a file object, streaming it in chunks, without decoding or changing it in any way.
+
+        Aborts if the remote file could not be read.
+
+        :param from_file: File path on the remote server.
+        :type from_file: :class:`str`
+        :param to_file: Path of the local file, or a file object to write to.
+        :type to_file: :class:`str` or :class:`file`
+        :param sudo: Indicates whether the file should be read by a super-user. Defaults to :data:`False`.
+        :type sudo: :class:`bool`
+        :param offset: Position of the first byte to download. Defaults to ``0``.
+        :type offset: :class:`int`
+        :param length: Maximum number of bytes to download. Defaults to :data:`None`, which means up to the end of the file.
+        :type length: :class:`int`
+
+        :return: The number of bytes downloaded.
+        :rtype: :class:`int`
+
+        Example:
+        ::
+
+            from provy.core import Role
+
+            class MySampleRole(Role):
+                def provision(self):
+                    self.get_file('/var/backups/db.dump', '/tmp/db.dump', sudo=True)
+                    self.get_file('/var/log/app.log', '/tmp/app-tail.log', offset=1024 * 1024)
+        '''
+        command = self.__download_command(from_file, offset, length)
+        target = open(to_file, 'wb') if isinstance(to_file, basestring) else to_file
+        try:
+            return self._query([from_file], lambda: self.__measure('get', lambda: self.__receive_file(command, target, sudo)))
+        finally:
+            if target is not to_file:
+                target.close()
+
+    def __download_command(self, path, offset, length):
+        if not offset and length is None:
+            return 'cat %s' % quote(path)
+        command = 'tail -c +%d %s' % (offset + 1, quote(path)) if offset else 'cat %s' % quote(path)
+        if length is not None:
+            command = '%s | head -c %d' % (command, length)
+        return 'test -e {path} && {{ {command}; }}'.format(path=quote(path), command=command)
+
+    def __receive_file(self, command, target, sudo):
+        if 'transport' in self.context:
+            content = str(self.execute(command, stdout=False, sudo=sudo))
+            target.write(content)
+            return len(content)
+
+        received = 0
+        channel = RemoteChannel(command, sudo=sudo).open()
+        try:
+            for chunk in channel.iter_chunks():
+                target.write(chunk)
+                received += len(chunk)
+            return_code = channel.exit_status()
+        finally:
+            channel.close()
+
+        if return_code != 0:
+            error("get_file() received nonzero return code %s while executing!\n\nRequested: %s" % (return_code, command), stderr=channel.stderr)
+        return received
 
     def render(self, template_file, options={}):
         '''
@@ -1008,15 +1803,16 @@ class Role(object):
                     contents = self.render('my-template', { 'user': 'heynemann' })
         '''
 
+        return self.__template(template_file).render(**self.__extend_context(options))
+
+    def __template(self, template_file):
         if isabs(template_file):
             env = Environment(loader=FileSystemLoader(dirname(template_file)))
             template_path = split(template_file)[-1]
         else:
             env = Environment(loader=self.context['loader'])
             template_path = template_file
-        template = env.get_template(template_path)
-
-        return template.render(**self.__extend_context(options))
+        return env.get_template(template_path)
 
     def is_process_running(self, process, sudo=False):
         '''
@@ -1043,6 +1839,7 @@ class Role(object):
         return_code = self.execute('ps aux | egrep %s | egrep -v egrep > /dev/null;echo $?' % process, stdout=False, sudo=sudo)
         return int(return_code) == 0
 
+    @query('file_path')
     def has_line(self, line, file_path):
         '''
         Returns :data:`True` if the given line of text is present in the given file. Returns :data:`False` otherwise (even if the file does not exist).
@@ -1081,6 +1878,8 @@ class Role(object):
         '''
         Ensures that the given line exists in the given file_path. Adds it if it doesn't exist, and creates the file if it doesn't exist.
 
+        To ensure many lines in the same file, use :meth:`ensure_lines`, which takes a single command for all of them.
+
         :param line: Line of text to verify in the given file.
         :type line: :class:`str`
         :param file_path: Complete path of the remote file.
@@ -1099,13 +1898,64 @@ class Role(object):
                 def provision(self):
                     self.ensure_line('127.0.0.1     localhost', '/etc/hosts')
         '''
-        if not self.has_line(line, file_path):
+        self.ensure_lines([line], file_path, owner=owner, sudo=sudo)
 
-            remote_file = self.create_remote_temp_file()
-            self.put_file(StringIO(line), remote_file, bool(sudo or owner), stdout=False)
+    def ensure_lines(self, lines, file_path, owner=None, sudo=False):
+        '''
+        Ensures that the given lines exist in the given file_path, appending the missing ones (in the given order), and creating the file if it doesn't exist.
+
+        Just like :meth:`has_line`, the lines are compared ignoring whitespace. The lines are checked and appended in the remote server, with a single command.
 
-            self.execute('cat {line} >> {target} && echo >> {target}'.format(line=remote_file, target=file_path), stdout=False, sudo=sudo, user=owner)
+        :param lines: Lines of text to verify in the given file.
+        :type lines: :class:`list`
+        :param file_path: Complete path of the remote file.
+        :type file_path: :class:`str`
+        :param owner: The user that owns the file. Defaults to :data:`None` (the context user is used in this case).
+        :type owner: :class:`str`
+        :param sudo: Indicates whether the file should be managed by the super-user. Defaults to :data:`False`.
+        :type sudo: :class:`bool`
+
+        :return: The lines that were appended.
+        :rtype: :class:`list`
+
+        Example:
+        ::
+
+            from provy.core import Role
+
+            class MySampleRole(Role):
+                def provision(self):
+                    self.ensure_lines([
+                        '127.0.0.1     localhost',
+                        '10.0.0.2      db',
+                    ], '/etc/hosts', sudo=True)
+        '''
+        if not lines:
+            return []
+
+        # awk reads the file from its standard input and gets the lines as
+        # arguments (which, unlike -v assignments, are taken literally),
+        # printing the ones it didn't find; they are then appended, after a
+        # line break if the file doesn't end with one.
+        command = (
+            "missing=$({{ cat {path} 2>/dev/null; }} | awk "
+            "'BEGIN {{ for (i = 1; i < ARGC; i++) wanted[i] = ARGV[i]; count = ARGC - 1; ARGC = 1 }} "
+            "{{ gsub(/[ \\t\\r\\f\\v]+/, \"\"); present[$0] = 1 }} "
+            "END {{ for (i = 1; i <= count; i++) {{ line = wanted[i]; gsub(/[ \\t\\r\\f\\v]+/, \"\", line); "
+            "if (!(line in present)) {{ present[line] = 1; print wanted[i] }} }} }}' {lines}) && "
+            "if [ -n \"$missing\" ]; then {{ if [ -s {path} ] && [ -n \"$(tail -c 1 {path})\" ]; then echo; fi; "
+            "printf '%s\\n' \"$missing\"; }} >> {path} && printf '%s\\n' \"$missing\"; fi"
+        ).format(path=quote(file_path), lines=' '.join(quote(line) for line in lines))
+
+        self.__forget_queries([file_path])
+        self.__flush_mutations_over([file_path])
+        with self.__tracked():
+            output = self.execute(command, stdout=False, sudo=sudo, user=owner)
+
+        appended = [line for line in str(output).splitlines() if line.strip()]
+        for line in appended:
             self.log('Line "%s" not found in %s. Adding it.' % (line, file_path))
+        return appended
 
     def using(self, role):
         '''
@@ -1128,9 +1978,10 @@ class Role(object):
         '''
         return UsingRole(role, self.prov, self.context)
 
+    @query()
     def get_distro_info(self):
         '''
-        Returns a :class:`DistroInfo` with valuable information regarding the distribution of the server.
+        Returns a :class:`DistroInfo <provy.core.facts.DistroInfo>` with valuable information regarding the distribution of the server.
 
         In the backgrounds, what it does is to run
 
@@ -1142,7 +1993,7 @@ class Role(object):
 
         .. warning::
 
-            The distribution info is requested to the server only once per Role instance, which means you won't get the new distro info if it changes remotely.
+            The distribution info is requested to the server only once (as part of the server facts - refer to :meth:`gather_facts`), which means you won't get the new distro info if it changes remotely.
 
         Example:
         ::
@@ -1172,40 +2023,49 @@ class Role(object):
                     distro_info.release == '5.8'
                     distro_info.codename == 'Final'
         '''
+        if 'facts' in self.context:
+            return self.gather_facts().distro
+
         if self.__distro_info is None:
-            raw_distro_info = self.execute('lsb_release -a')
-            distro_info_lines = raw_distro_info.split('\n')
-            distro_info = DistroInfo()
+            self.__distro_info = parse_distro_info(self.execute('lsb_release -a'))
 
-            for line in distro_info_lines:
-                if ':' in line:
-                    key, value = line.split(':', 1)
-                    info_property = key.lower().replace(' ', '_')
-                    setattr(distro_info, info_property, value.strip())
+        return self.__distro_info
 
-            self.__distro_info = distro_info
+    def gather_facts(self):
+        '''
+        Returns a :class:`HostFacts <provy.core.facts.HostFacts>` with the distribution, logged user, hostname, temp dir, number of CPUs and memory of the server.
 
-        return self.__distro_info
+        The facts are gathered with a single command the first time any role in the server asks for them, and then shared by all the roles in the server; :meth:`get_distro_info`, :meth:`get_logged_user`, :meth:`get_hostname` and :meth:`remote_temp_dir` read from them.
 
+        Facts gathered in previous runs are reused while they are fresh (refer to :mod:`provy.core.facts`).
 
-class DistroInfo(object):
-    '''
-    Value object used to contain distribution information.
+        :return: The server facts
+        :rtype: :class:`HostFacts <provy.core.facts.HostFacts>`
 
-    Refer to :meth:`Role.get_distro_info` usage.
-    '''
-    lsb_version = None
-    distributor_id = None
-    description = None
-    release = None
-    codename = None
+        Example:
+        ::
+
+            from provy.core import Role
+
+            class MySampleRole(Role):
+                def provision(self):
+                    facts = self.gather_facts()
+                    if facts.cpus > 1:
+                        pass
+        '''
+        facts = self.context.setdefault('facts', HostFacts())
+        if not facts.gathered:
+            with self.__tracked():
+                facts.gather(lambda command: self.execute(command, stdout=False),
+                             self.context.get('fact_store'), fabric.api.env.host_string)
+        return facts
 
 
 class UpdateData(object):
     '''
-    Value object used in the update_file method.
+    Value object used in the update_file method, holding the rendered contents in memory.
     '''
-    def __init__(self, local_temp_path, from_md5, to_md5):
-        self.local_temp_path = local_temp_path
+    def __init__(self, content, from_md5, to_md5):
+        self.content = content
         self.from_md5 = from_md5
         self.to_md5 = to_md5
@@ -11,20 +11,60 @@ from os.path import abspath, dirname, join
 
 from fabric.context_managers import settings as _settings
 
-from provy.core.utils import import_module, AskFor, provyfile_module_from
+from provy.core.agent import RemoteAgent
+from provy.core.background import wait_for_background
+from provy.core.batch import MutationQueue
+from provy.core.blobs import BlobCache
+from provy.core.facts import FactStore, HostFacts
+from provy.core.hashing import LocalHashes
+from provy.core.memo import QueryCache
+from provy.core.replay import Player, Recorder
+from provy.core.sessions import SessionPool
+from provy.core.stats import CallStats
+from provy.core.utils import import_module, AskFor, provyfile_module_from, provy_dir
 from provy.core.errors import ConfigurationError
 from jinja2 import FileSystemLoader, ChoiceLoader
 
 
-def run(provfile_path, server_name, password, extra_options):
+INHERITED_SETTINGS = ('gateway', 'keepalive')
+GATEWAY_KEEPALIVE = 30
+
+
+def run(provfile_path, server_name, password, extra_options, refresh_facts=False, record=None, replay=None, replay_latency=False, stats=False):
     module_name = provyfile_module_from(provfile_path)
     prov = import_module(module_name)
     servers = get_servers_for(prov, server_name)
 
     build_prompt_options(servers, extra_options)
 
-    for server in servers:
-        provision_server(server, provfile_path, password, prov)
+    transport = build_transport(record, replay, replay_latency)
+    # Recorded runs must gather the facts from the servers, so that the
+    # replayed runs ask for them with the very same commands.
+    fact_store = FactStore(provy_dir('facts'), refresh=refresh_facts) if transport is None else None
+    local_hashes = LocalHashes(join(provy_dir(), 'local-hashes.json'))
+    call_stats = CallStats() if stats else None
+
+    try:
+        for server in servers:
+            provision_server(server, provfile_path, password, prov, fact_store=fact_store, transport=transport, stats=call_stats, local_hashes=local_hashes)
+    finally:
+        local_hashes.save()
+        if transport is not None:
+            transport.close()
+
+    if call_stats is not None and len(servers) > 1:
+        print_header("Round trips")
+        print call_stats.report()
+
+
+def build_transport(record, replay, replay_latency):
+    if record and replay:
+        raise ConfigurationError('Cannot record and replay at the same time.')
+    if record:
+        return Recorder(record)
+    if replay:
+        return Player(replay, latency=replay_latency)
+    return None
 
 
 def print_header(msg):
@@ -34,7 +74,7 @@ def print_header(msg):
     print "*" * len(msg)
 
 
-def provision_server(server, provfile_path, password, prov):
+def provision_server(server, provfile_path, password, prov, fact_store=None, transport=None, stats=None, local_hashes=None):
     host_string = "%s@%s" % (server['user'], server['address'].strip())
 
     context = {
@@ -42,11 +82,34 @@ def provision_server(server, provfile_path, password, prov):
         'path': dirname(provfile_path),
         'owner': server['user'],
         'cleanup': [],
-        'registered_loaders': []
+        'registered_loaders': [],
+        'facts': HostFacts()
     }
 
     aggregate_node_options(server, context)
 
+    if transport is not None:
+        context['transport'] = transport
+    elif server.get('agent'):
+        context['agent'] = RemoteAgent()
+    if server.get('sudo_session'):
+        context['sessions'] = SessionPool()
+    if fact_store is not None:
+        context['fact_store'] = fact_store
+    if stats is not None:
+        context['stats'] = stats
+    if local_hashes is not None:
+        context['local_hashes'] = local_hashes
+    if server.get('query_cache', True):
+        context['query_cache'] = QueryCache()
+    if server.get('batch'):
+        context['mutations'] = MutationQueue(automatic=True)
+    if server.get('blob_cache'):
+        context['blobs'] = BlobCache() if server['blob_cache'] is True else BlobCache(server['blob_cache'])
+    for key in ('delta_threshold', 'compress_threshold'):
+        if key in server:
+            context[key] = server[key]
+
     loader = ChoiceLoader([
         FileSystemLoader(join(context['abspath'], 'files'))
     ])
@@ -57,6 +120,7 @@ def provision_server(server, provfile_path, password, prov):
     settings_dict = dict(host_string=host_string, password=password)
     if 'ssh_key' in server and server['ssh_key']:
         settings_dict['key_filename'] = server['ssh_key']
+    settings_dict.update(connection_settings(server))
 
     with _settings(**settings_dict):
         context['host'] = server['address']
@@ -70,15 +134,50 @@ def provision_server(server, provfile_path, password, prov):
                 role_instances.append(instance)
                 instance.provision()
         finally:
-            for role in role_instances:
-                role.cleanup()
-
-            for role in context['cleanup']:
-                role.cleanup()
+            try:
+                wait_for_background(context)
+                store_blobs(context)
+            finally:
+                for role in role_instances:
+                    role.cleanup()
+
+                for role in context['cleanup']:
+                    role.cleanup()
+
+                if 'scratch_dir' in context:
+                    role_instances[0].remove_remote_scratch_dir()
+                if role_instances and 'mutations' in context:
+                    role_instances[0].flush_mutations()
+                close_connections(context)
+
+    if stats is not None:
+        print
+        print stats.report(host_string)
 
     print_header("%s provisioned!" % host_string)
 
 
+def connection_settings(server):
+    settings_dict = {}
+    if server.get('gateway'):
+        settings_dict['gateway'] = server['gateway']
+        settings_dict['keepalive'] = GATEWAY_KEEPALIVE
+    if server.get('keepalive'):
+        settings_dict['keepalive'] = server['keepalive']
+    return settings_dict
+
+
+def store_blobs(context):
+    if 'blobs' in context:
+        context['blobs'].flush()
+
+
+def close_connections(context):
+    for key in ('agent', 'sessions'):
+        if key in context:
+            context[key].close()
+
+
 def aggregate_node_options(server, context):
     for key, value in server.get('options', {}).iteritems():
         context[key] = value
@@ -104,24 +203,43 @@ def get_items(prov, item_name, item_key, test_func):
         raise ConfigurationError('The %s collection was not found in the provyfile file.' % item_key)
 
     items = getattr(prov, item_key)
+    inherited = {}
 
     for item_part in item_name.split('.'):
+        inherited = group_settings(items, inherited)
         items = items[item_part]
 
     found_items = []
-    recurse_items(items, test_func, found_items)
+    recurse_items(items, test_func, found_items, inherited)
     return found_items
 
 
-def recurse_items(col, test_func, found_items):
+def group_settings(col, inherited):
+    settings = dict(inherited or {})
+    for key in INHERITED_SETTINGS:
+        if key in col and not isinstance(col[key], dict):
+            settings[key] = col[key]
+    return settings
+
+
+def inherit_settings(item, inherited):
+    if isinstance(item, dict) and inherited:
+        for key, value in inherited.iteritems():
+            item.setdefault(key, value)
+
+
+def recurse_items(col, test_func, found_items, inherited=None):
     if not isinstance(col, dict):
         return
 
     if test_func(col):
+        inherit_settings(col, inherited)
         found_items.append(col)
     else:
+        inherited = group_settings(col, inherited)
         for key, val in col.iteritems():
             if test_func(val):
+                inherit_settings(val, inherited)
                 found_items.append(val)
             else:
-                recurse_items(val, test_func, found_items)
+                recurse_items(val, test_func, found_items, inherited)
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for persistent privileged sessions in the remote server.
+
+Instead of paying a separate ``sudo`` invocation (with its password prompt, PAM and environment setup) for each command, a :class:`SessionPool` keeps one long-lived shell per user and sends commands to it one after the other.
+
+Sessions are enabled per server, with the ``sudo_session`` key in the ``servers`` dictionary:
+::
+
+    servers = {
+        'frontend': {
+            'address': '33.33.33.33',
+            'user': 'vagrant',
+            'sudo_session': True,
+            'roles': [
+                FrontEnd
+            ]
+        }
+    }
+'''
+
+import uuid
+
+import fabric.api
+from fabric.operations import _prefix_commands, _prefix_env_vars, _shell_wrap
+from fabric.state import output
+from fabric.utils import error
+
+from provy.core.channels import RemoteChannel
+
+
+def wrap_command(command):
+    '''
+    Wraps a command just like `fabric's run <https://fabric.readthedocs.org/en/latest/api/core/operations.html#fabric.operations.run>`_ does: with the ``cd``, ``prefix``, ``path`` and ``shell_env`` context managers in effect, and run by fabric's ``shell``.
+    '''
+    return _shell_wrap(_prefix_env_vars(_prefix_commands(command, 'remote')), fabric.api.env.get('shell_escape', True))
+
+
+class CommandResult(str):
+    '''
+    Value object with the output of a command run in a :class:`PrivilegedSession`.
+
+    Just like fabric's results, it is the output string itself, with ``return_code``, ``succeeded``, ``failed`` and ``stderr`` attributes.
+    '''
+    def __new__(cls, stdout, stderr, return_code, command):
+        result = str.__new__(cls, stdout)
+        result.stderr = stderr
+        result.return_code = return_code
+        result.succeeded = return_code == 0
+        result.failed = not result.succeeded
+        result.command = command
+        return result
+
+
+class PrivilegedSession(object):
+    '''
+    A shell running in the remote server as the super-user (or as another user), that receives commands one after the other.
+
+    Each command runs in a subshell with its standard input closed, so it can't change the directory or the state of the session, nor consume the commands that follow it. Its output, error and exit code are delimited by a random marker.
+
+    :param user: If specified, the shell runs as this user instead of the super-user. Defaults to :data:`None`.
+    :type user: :class:`str`
+    '''
+    def __init__(self, user=None):
+        self.user = user
+        self.channel = None
+
+    def run(self, command):
+        '''
+        Runs a command in the session, starting the session first if needed.
+
+        Honors fabric's ``cd``, ``prefix``, ``path`` and ``shell_env`` context managers, ``shell``, output settings and ``warn_only`` setting, just like `fabric's sudo <https://fabric.readthedocs.org/en/latest/api/core/operations.html#fabric.operations.sudo>`_ does.
+
+        :param command: The command to be executed.
+        :type command: :class:`str`
+
+        :return: The execution result
+        :rtype: :class:`CommandResult`
+        '''
+        if self.channel is None:
+            self.channel = RemoteChannel('/bin/sh', sudo=True, user=self.user).open()
+
+        env = fabric.api.env
+        if output.running:
+            print "[%s] sudo: %s" % (env.host_string, command)
+
+        full_command = wrap_command(command)
+        marker = 'provy-session-%s' % uuid.uuid4().hex
+        self.channel.write("( %s ) < /dev/null\nprintf '\\n%s %%d\\n' $?\nprintf '\\n%s\\n' >&2\n" % (full_command, marker, marker))
+        stdout, stderr, return_code = self.channel.read_until(marker)
+        result = CommandResult(stdout.strip(), stderr.strip(), int(return_code), command)
+
+        if output.stdout:
+            for line in result.splitlines():
+                print "[%s] out: %s" % (env.host_string, line)
+
+        if result.failed:
+            error("sudo() received nonzero return code %s while executing!\n\nRequested: %s" % (result.return_code, command),
+                  stdout=result, stderr=result.stderr)
+        return result
+
+    def close(self):
+        '''
+        Ends the session, if it was started.
+        '''
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+
+
+class SessionPool(object):
+    '''
+    Keeps one :class:`PrivilegedSession` per user in the current server.
+    '''
+    def __init__(self):
+        self.sessions = {}
+
+    def run(self, command, user=None):
+        '''
+        Runs a command in the session for the given user (or the super-user, if no user is given).
+
+        :param command: The command to be executed.
+        :type command: :class:`str`
+        :param user: If specified, will be the user with which the command will be executed. Defaults to :data:`None`.
+        :type user: :class:`str`
+
+        :return: The execution result
+        :rtype: :class:`CommandResult`
+        '''
+        if user not in self.sessions:
+            self.sessions[user] = PrivilegedSession(user)
+        return self.sessions[user].run(command)
+
+    def close(self):
+        '''
+        Ends all the sessions in the pool.
+        '''
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
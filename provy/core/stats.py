@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for accounting the calls that roles make to the servers (and to the local machine): how many, how long they took, and how many bytes went each way.
+
+Each call is attributed to the role class and method that made it - the innermost method in the call stack that is not one of the base :class:`Role <provy.core.roles.Role>` helpers. Use the ``--stats`` option of the console runner to get a summary of the top consumers per server, and for all the servers.
+'''
+
+import os
+import time
+from collections import defaultdict
+
+
+UNITS = ('B', 'KB', 'MB', 'GB')
+
+
+def find_caller(frame, base_class):
+    '''
+    Returns a tuple with the class name and the method name of the innermost method of a ``base_class`` instance in the stack, starting at ``frame``, that is not defined in the module of ``base_class``. If there's none, the outermost method of a ``base_class`` instance is returned instead.
+    '''
+    caller = None
+    while frame is not None:
+        instance = frame.f_locals.get('self')
+        if isinstance(instance, base_class):
+            caller = (instance.__class__.__name__, frame.f_code.co_name)
+            if frame.f_globals.get('__name__') != base_class.__module__:
+                return caller
+        frame = frame.f_back
+    return caller or ('?', '?')
+
+
+def payload_size(data):
+    '''
+    Returns the size of a local file (given by its path), or what is left to read of a file object, or :data:`None` if unknown.
+    '''
+    if isinstance(data, basestring):
+        try:
+            with open(data, 'rb') as f:
+                f.seek(0, 2)
+                return f.tell()
+        except IOError:
+            return None
+    if hasattr(data, 'getvalue'):
+        return len(data.getvalue())
+    if hasattr(data, 'fileno') and hasattr(data, 'tell'):
+        try:
+            return os.fstat(data.fileno()).st_size - data.tell()
+        except (IOError, OSError):
+            return None
+    return None
+
+
+def human_size(size):
+    for unit in UNITS:
+        if size < 1024 or unit == UNITS[-1]:
+            break
+        size /= 1024.0
+    return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+
+
+class CallTotals(object):
+    def __init__(self):
+        self.count = 0
+        self.elapsed = 0.0
+        self.sent = 0
+        self.received = 0
+
+    def add(self, elapsed, sent, received):
+        self.count += 1
+        self.elapsed += elapsed
+        self.sent += sent or 0
+        self.received += received or 0
+
+    def merge(self, other):
+        self.count += other.count
+        self.elapsed += other.elapsed
+        self.sent += other.sent
+        self.received += other.received
+
+
+class CallStats(object):
+    '''
+    Totals of the calls made to the servers, per server, kind of call (``execute``, ``local``, ``put``, ``get`` or ``agent``, for the operations run by the agent - refer to :mod:`provy.core.agent`) and caller.
+    '''
+    def __init__(self):
+        self.totals = defaultdict(CallTotals)
+
+    def add(self, host, kind, caller, elapsed, sent=0, received=0):
+        '''
+        Accounts a call.
+
+        :param caller: Tuple with the role class name and the method name that made the call (refer to :func:`find_caller`).
+        :type caller: :class:`tuple`
+        '''
+        self.totals[(host, kind, caller)].add(elapsed, sent, received)
+
+    def measure(self, host, kind, caller, call, sent=0):
+        '''
+        Runs ``call`` and accounts it, using the length of its result (if it's a string) as the received bytes.
+
+        ``sent`` can also be a callable, to be called once ``call`` is done, for calls that only know how many bytes they sent at the end.
+        '''
+        start = time.time()
+        result = None
+        try:
+            result = call()
+            return result
+        finally:
+            received = len(result) if isinstance(result, basestring) else 0
+            if callable(sent):
+                sent = sent()
+            self.add(host, kind, caller, time.time() - start, sent, received)
+
+    def grouped(self, host=None):
+        grouped = defaultdict(CallTotals)
+        for (call_host, kind, caller), totals in self.totals.items():
+            if host is not None and call_host != host:
+                continue
+            grouped[('%s.%s' % caller, kind)].merge(totals)
+        return grouped
+
+    def report(self, host=None, top=10):
+        '''
+        Returns a summary, as text, of the callers that made the most calls - in the given server, or in all of them.
+        '''
+        grouped = self.grouped(host)
+        overall = CallTotals()
+        for totals in grouped.values():
+            overall.merge(totals)
+
+        title = 'in %s' % host if host is not None else 'in all servers'
+        lines = ['%d calls %s, taking %.2fs (%s sent, %s received)' % (
+            overall.count, title, overall.elapsed, human_size(overall.sent), human_size(overall.received))]
+        lines.append('%7s %9s %10s %10s  %-7s %s' % ('calls', 'time', 'sent', 'received', 'kind', 'caller'))
+        ranked = sorted(grouped.items(), key=lambda item: (-item[1].count, -item[1].elapsed, item[0]))
+        for (caller, kind), totals in ranked[:top]:
+            lines.append('%7d %8.2fs %10s %10s  %-7s %s' % (
+                totals.count, totals.elapsed, human_size(totals.sent), human_size(totals.received), kind, caller))
+        return '\n'.join(lines)
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Module responsible for the manifests used by :meth:`Role.sync_dir <provy.core.roles.Role.sync_dir>` to find out which files differ between a local directory and a remote one.
+
+A manifest is a dictionary with the size, the mode (like ``644``) and the md5 hash of each regular file in a directory, by its path relative to the directory. The remote manifest is built with a single command (or a single call to the agent).
+'''
+
+import os
+from pipes import quote
+
+from provy.core.hashing import md5_file
+
+
+MANIFEST_MARKER = 'provy-manifest-hashes'
+
+
+def local_manifest(directory, md5=md5_file):
+    '''
+    Returns the manifest of a local directory, hashing each file with ``md5``. Symbolic links are not followed.
+    '''
+    manifest = {}
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            relative_path = os.path.relpath(path, directory).replace(os.sep, '/')
+            manifest[relative_path] = (stat.st_size, int('%o' % (stat.st_mode & 0o7777)), md5(path))
+    return manifest
+
+
+def manifest_command(directory):
+    '''
+    Returns the shell command that prints the manifest of a remote directory: the path, size and mode of each file, then a marker line, then their md5 hashes.
+    '''
+    return "if [ -d {directory} ]; then cd {directory} && find . -type f -printf '%P\\t%s\\t%m\\n' && echo {marker} && find . -type f -exec md5sum {{}} +; fi".format(
+        directory=quote(directory), marker=MANIFEST_MARKER)
+
+
+def parse_manifest(output):
+    '''
+    Builds a manifest from the output of :func:`manifest_command`.
+    '''
+    stats = {}
+    hashes = {}
+    in_hashes = False
+    for line in output.splitlines():
+        line = line.rstrip('\r')
+        if line == MANIFEST_MARKER:
+            in_hashes = True
+        elif in_hashes and len(line) > 34:
+            hashes[line[34:].replace('./', '', 1)] = line[:32]
+        elif not in_hashes and line.count('\t') >= 2:
+            path, size, mode = line.rsplit('\t', 2)
+            stats[path] = (int(size), int(mode))
+    return dict((path, (size, mode, hashes.get(path))) for path, (size, mode) in stats.items())
+
+
+def compare(local, remote):
+    '''
+    Compares two manifests.
+
+    :return: A tuple with the paths whose contents differ (or that are missing in the remote manifest), the paths that only differ in their mode, and the paths that only exist in the remote manifest, each one sorted.
+    :rtype: :class:`tuple`
+    '''
+    changed = []
+    mode_changed = []
+    for path, (size, mode, md5) in local.items():
+        remote_entry = remote.get(path)
+        if remote_entry is None or remote_entry[0] != size or remote_entry[2] != md5:
+            changed.append(path)
+        elif remote_entry[1] != mode:
+            mode_changed.append(path)
+    extraneous = [path for path in remote if path not in local]
+    return sorted(changed), sorted(mode_changed), sorted(extraneous)
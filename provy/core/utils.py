@@ -32,6 +32,16 @@ def provyfile_module_from(path):
     return base
 
 
+def provy_dir(*path):
+    '''
+    Returns the path of a directory under ``~/.provy``, where provy keeps its local state between runs, creating it if needed.
+    '''
+    directory = os.path.join(os.path.expanduser('~'), '.provy', *path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+
 def import_module(module_name):
     module = __import__(module_name)
     if '.' in module_name:
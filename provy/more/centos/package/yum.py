@@ -175,7 +175,7 @@ class YumRole(Role):
         if not self.remote_exists(self.update_date_file):
             return None
 
-        date = datetime.strptime(self.read_remote_file(self.update_date_file), self.time_format)
+        date = datetime.strptime(self.read_remote_file(self.update_date_file).strip(), self.time_format)
         return date
 
     def ensure_up_to_date(self):
@@ -44,9 +44,8 @@ class UserRole(Role):
         return group_name in values
 
     def __first_values_from(self, basename):
-        values = self.execute("cat /etc/%s | cut -d ':' -f 1" % basename, stdout=False, sudo=True)
-        values = values.strip().split()
-        return values
+        lines = self.execute_iter("cat /etc/%s | cut -d ':' -f 1" % basename, stdout=False, sudo=True)
+        return set(line.strip() for line in lines)
 
     def user_exists(self, username):
         '''
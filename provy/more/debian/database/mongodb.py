@@ -150,21 +150,22 @@ class MongoDBRole(Role):
 
         config = self.__config_from_remote(mongodb_config_path)
         self.__set_config_items(configuration, config)
-        tmp_file = self.__tmp_file_with_config(config)
+        config_buffer = self.__buffer_with_config(config)
 
-        self.put_file(from_file=tmp_file, to_file=mongodb_config_path, sudo=True)
+        self.put_file(from_file=config_buffer, to_file=mongodb_config_path, sudo=True)
 
-    def __tmp_file_with_config(self, config):
+    def __buffer_with_config(self, config):
 
         output_buffer = StringIO()
         config.write(output_buffer)
-        tmp_file = self.write_to_temp_file(output_buffer.getvalue())
-        return tmp_file
+        output_buffer.seek(0)
+        return output_buffer
 
     def __config_from_remote(self, mongodb_config_path):
 
-        config_content = self.read_remote_file(mongodb_config_path, sudo=True)
-        config_buffer = StringIO(config_content)
+        config_buffer = StringIO()
+        self.get_file(mongodb_config_path, config_buffer, sudo=True)
+        config_buffer.seek(0)
         config = ConfigObj(infile=config_buffer)
         return config
 
@@ -73,16 +73,16 @@ class MySQLRole(Role):
         if self.mysql_root_pass:
             pass_string = '--password="%s" ' % self.mysql_root_pass
 
-        result = self.execute('mysql -u %s %s-E -e "%s" mysql' % (self.mysql_root_user, pass_string, query), stdout=False, sudo=True)
-        rows = self.__get_rows(result)
+        lines = self.execute_iter('mysql -u %s %s-E -e "%s" mysql' % (self.mysql_root_user, pass_string, query), stdout=False, sudo=True)
+        rows = self.__get_rows(lines)
 
         return rows
 
-    def __get_rows(self, result):
+    def __get_rows(self, lines):
         index_re = re.compile('(\d+)[.]')
         items = []
         item = None
-        for line in result.split('\n'):
+        for line in lines:
             if not line.strip():
                 continue
             if line.startswith('*'):
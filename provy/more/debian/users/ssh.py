@@ -67,7 +67,7 @@ class SSHRole(Role):
         pub_path = join(ssh_path, 'id_rsa.pub')
         priv_path = join(ssh_path, 'id_rsa')
 
-        host = self.execute_python('import os; print os.uname()[1]', stdout=False)
+        host = self.get_hostname()
         host_str = "%s@%s" % (user, host)
 
         pub_text = "%s %s" % (public_key, host_str)
@@ -247,7 +247,7 @@ class DjangoRole(Role):
         return result
 
     def _update_init_script(self, website):
-        at_least_one_updated = False
+        scripts = []
         for process_number in range(website.processes):
             port = website.starting_port + process_number
             options = {
@@ -262,12 +262,12 @@ class DjangoRole(Role):
                 'settings_directory': dirname(website.settings_path)
             }
             script_name = '%s-%d' % (website.name, port)
-            result = self.update_file('website.init.template', '/etc/init.d/%s' % script_name, owner=website.user, options=options, sudo=True)
+            scripts.append(('website.init.template', '/etc/init.d/%s' % script_name, options, website.user, 755))
 
-            if result:
-                at_least_one_updated = True
-                self.execute('chmod +x /etc/init.d/%s' % script_name, stdout=False, sudo=True)
-                if website.auto_start:
-                    self.execute('update-rc.d %s defaults' % script_name, stdout=False, sudo=True)
+        updated = self.update_files(scripts, sudo=True)
 
-        return at_least_one_updated
+        if website.auto_start:
+            for script_path in updated:
+                self.execute('update-rc.d %s defaults' % split(script_path)[-1], stdout=False, sudo=True)
+
+        return bool(updated)
@@ -33,4 +33,27 @@ class HostsRole(Role):
         :param ip: The IP to which the :data:`host_name` will point to.
         :type ip: :class:`str`
         '''
-        self.ensure_line('%s        %s' % (ip, host_name), '/etc/hosts', sudo=True)
+        self.ensure_hosts([(host_name, ip)])
+
+    def ensure_hosts(self, hosts):
+        '''
+        Makes sure that many hosts are configured in the hosts file, with a single command.
+
+        :param hosts: The hosts, as ``(host_name, ip)`` tuples.
+        :type hosts: :class:`list`
+
+        Example:
+        ::
+
+            from provy.core import Role
+            from provy.more.linux import HostsRole
+
+            class MySampleRole(Role):
+                def provision(self):
+                    with self.using(HostsRole) as role:
+                        role.ensure_hosts([
+                            ('db', '10.0.0.2'),
+                            ('cache', '10.0.0.3'),
+                        ])
+        '''
+        self.ensure_lines(['%s        %s' % (ip, host_name) for host_name, ip in hosts], '/etc/hosts', sudo=True)
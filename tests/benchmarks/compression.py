@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark for the compressed uploads of put_file (refer to provy.core.compression).
+
+Compresses a compressible payload (a generated configuration file) and an incompressible one (random bytes) the way put_file does, and shows the local compression throughput and the time each upload would take over a link of the given bandwidth, with and without compression.
+
+Usage: python tests/benchmarks/compression.py [megabits per second] [megabytes per payload]
+'''
+
+import os
+import sys
+import time
+from StringIO import StringIO
+
+from provy.core.compression import SAMPLE_SIZE, compressed_chunks, read_chunks, worth_compressing
+
+
+def compressible_payload(size):
+    lines = []
+    total = 0
+    number = 0
+    while total < size:
+        line = 'server {\n    listen %d;\n    server_name app-%d.example.com;\n    root /srv/app-%d/public;\n}\n' % (8000 + number % 1000, number, number)
+        lines.append(line)
+        total += len(line)
+        number += 1
+    return ''.join(lines)[:size]
+
+
+def measure(name, payload, bandwidth):
+    megabytes = len(payload) / 1024.0 / 1024.0
+    link_speed = bandwidth * 1024 * 1024 / 8.0
+    plain_time = len(payload) / link_speed
+
+    source = StringIO(payload)
+    sample = source.read(SAMPLE_SIZE)
+    if not worth_compressing(sample):
+        print '%-14s %7.1f MB  not compressed  upload %6.2fs' % (name, megabytes, plain_time)
+        return
+
+    start = time.time()
+    sent = sum(len(chunk) for chunk in compressed_chunks(read_chunks(source, sample)))
+    elapsed = time.time() - start
+    compressed_time = max(elapsed, sent / link_speed)
+    print '%-14s %7.1f MB  -> %7.2f MB  compressing at %6.1f MB/s  upload %6.2fs instead of %6.2fs (%.1fx)' % (
+        name, megabytes, sent / 1024.0 / 1024.0, megabytes / elapsed, compressed_time, plain_time, plain_time / compressed_time)
+
+
+def main():
+    bandwidth = float(sys.argv[1]) if len(sys.argv) > 1 else 20.0
+    size = int(float(sys.argv[2] if len(sys.argv) > 2 else 16) * 1024 * 1024)
+
+    print 'Uploads over a %.0f Mbit/s link:' % bandwidth
+    measure('compressible', compressible_payload(size), bandwidth)
+    measure('incompressible', os.urandom(size), bandwidth)
+
+
+if __name__ == '__main__':
+    main()
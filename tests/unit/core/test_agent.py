@@ -0,0 +1,94 @@
+import json
+
+from mock import patch, ANY
+from nose.tools import istest
+
+from provy.core.agent import RemoteAgent, agent_source
+from provy.core.errors import RemoteAgentError
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+class FakeChannel(object):
+    def __init__(self, *responses):
+        self.written = []
+        self.output = ''.join('%d\n%s' % (len(data), data) for data in map(json.dumps, responses))
+        self.closed = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def readline(self):
+        line, self.output = self.output.split('\n', 1)
+        return line + '\n'
+
+    def read(self, size):
+        data, self.output = self.output[:size], self.output[size:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class RemoteAgentTest(ProvyTestCase):
+    def setUp(self):
+        super(RemoteAgentTest, self).setUp()
+        self.agent = RemoteAgent()
+
+    @istest
+    def uploads_and_starts_the_agent_as_super_user_on_first_call(self):
+        with patch('fabric.api.put') as put, patch('provy.core.agent.RemoteChannel') as RemoteChannel:
+            RemoteChannel.return_value.open.return_value = FakeChannel({'ok': True, 'result': True})
+
+            self.assertTrue(self.agent.call('exists', path='/some/path'))
+
+            put.assert_called_once_with(ANY, ANY)
+            script, script_path = put.call_args[0]
+            self.assertEqual(script.getvalue(), agent_source())
+            RemoteChannel.assert_called_once_with('python %s --remove' % script_path, sudo=True)
+
+    @istest
+    def doesnt_start_the_agent_twice(self):
+        with patch('fabric.api.put') as put, patch('provy.core.agent.RemoteChannel') as RemoteChannel:
+            RemoteChannel.return_value.open.return_value = FakeChannel({'ok': True, 'result': True}, {'ok': True, 'result': 644})
+
+            self.agent.call('exists', path='/some/path')
+            self.assertEqual(self.agent.call('mode', path='/some/path'), 644)
+
+            self.assertEqual(put.call_count, 1)
+            self.assertEqual(RemoteChannel.call_count, 1)
+
+    @istest
+    def sends_framed_requests(self):
+        self.agent.channel = FakeChannel({'ok': True, 'result': None})
+
+        self.agent.call('md5', path='/some/path')
+
+        header, data = self.agent.channel.written[0].split('\n', 1)
+        self.assertEqual(int(header), len(data))
+        self.assertEqual(json.loads(data), {'operation': 'md5', 'arguments': {'path': '/some/path'}})
+
+    @istest
+    def raises_io_error_for_io_failures_in_the_server(self):
+        self.agent.channel = FakeChannel({'ok': False, 'type': 'IOError', 'error': 'no such file'})
+
+        self.assertRaises(IOError, self.agent.call, 'mode', path='/some/path')
+
+    @istest
+    def raises_agent_error_for_other_failures_in_the_server(self):
+        self.agent.channel = FakeChannel({'ok': False, 'type': 'KeyError', 'error': 'format_disk'})
+
+        self.assertRaises(RemoteAgentError, self.agent.call, 'format_disk')
+
+    @istest
+    def closes_the_channel(self):
+        channel = FakeChannel()
+        self.agent.channel = channel
+
+        self.agent.close()
+
+        self.assertTrue(channel.closed)
+        self.assertIsNone(self.agent.channel)
+
+    @istest
+    def can_be_closed_without_being_started(self):
+        self.agent.close()
@@ -0,0 +1,156 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from StringIO import StringIO
+
+from nose.tools import istest
+
+from provy.core import agent_script
+from provy.core.pathinfo import parse_stat, path_info, stat_command
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+class AgentScriptTest(ProvyTestCase):
+    def setUp(self):
+        super(AgentScriptTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.directory, 'some-file')
+        with open(self.file_path, 'w') as f:
+            f.write('some content\n')
+        os.chmod(self.file_path, 0o640)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def call(self, operation, **arguments):
+        return agent_script.handle({'operation': operation, 'arguments': arguments})
+
+    @istest
+    def checks_if_a_file_exists(self):
+        self.assertEqual(self.call('exists', path=self.file_path), {'ok': True, 'result': True})
+        self.assertEqual(self.call('exists', path=self.directory), {'ok': True, 'result': False})
+
+    @istest
+    def checks_if_a_directory_exists(self):
+        self.assertEqual(self.call('exists_dir', path=self.directory), {'ok': True, 'result': True})
+        self.assertEqual(self.call('exists_dir', path=self.file_path), {'ok': True, 'result': False})
+
+    @istest
+    def hashes_a_file(self):
+        self.assertEqual(self.call('md5', path=self.file_path)['result'], 'eb9c2bf0eb63f3a7bc0ea37ef18aeba5')
+
+    @istest
+    def doesnt_hash_a_file_that_doesnt_exist(self):
+        self.assertIsNone(self.call('md5', path='/some/sneaky.file')['result'])
+
+    @istest
+    def hashes_many_files_at_once(self):
+        self.assertEqual(self.call('md5_files', paths=[self.file_path, '/some/sneaky.file'])['result'], {
+            self.file_path: 'eb9c2bf0eb63f3a7bc0ea37ef18aeba5',
+            '/some/sneaky.file': None,
+        })
+
+    @istest
+    def gets_the_block_signatures_of_a_file(self):
+        self.assertEqual(self.call('signatures', path=self.file_path, block_size=8)['result'], [
+            [237306645, '05769e518e729817e95a283469b2635b'],
+            [102302150, '9d83f33ea3ce295f295b5980af20daec'],
+        ])
+        self.assertIsNone(self.call('signatures', path='/some/sneaky.file', block_size=8)['result'])
+
+    @istest
+    def doesnt_patch_a_file_if_the_result_doesnt_match(self):
+        delta_path = os.path.join(self.directory, 'delta')
+        with open(delta_path, 'wb') as f:
+            f.write(b'D\x00\x00\x00\x03foo')
+
+        response = self.call('patch', path=self.file_path, delta_path=delta_path, block_size=8, md5='some other hash')
+
+        self.assertEqual(response['type'], 'IOError')
+        self.assertEqual(os.listdir(self.directory), ['some-file'])
+        with open(self.file_path) as f:
+            self.assertEqual(f.read(), 'some content\n')
+
+    @istest
+    def builds_the_manifest_of_a_directory(self):
+        os.mkdir(os.path.join(self.directory, 'sub'))
+        with open(os.path.join(self.directory, 'sub', 'other-file'), 'w') as f:
+            f.write('other content')
+        os.chmod(os.path.join(self.directory, 'sub', 'other-file'), 0o644)
+
+        self.assertEqual(self.call('manifest', directory=self.directory)['result'], {
+            'some-file': [13, 640, 'eb9c2bf0eb63f3a7bc0ea37ef18aeba5'],
+            'sub/other-file': [13, 644, '0c84751f0ca9c6886bb09f2dd1a66faa'],
+        })
+
+    @istest
+    def gets_the_mode_of_a_file(self):
+        self.assertEqual(self.call('mode', path=self.file_path)['result'], 640)
+
+    @istest
+    def gets_the_same_information_about_paths_as_the_stat_command(self):
+        link_path = os.path.join(self.directory, 'some-link')
+        os.symlink(self.file_path, link_path)
+        paths = [self.file_path, link_path, self.directory, os.path.join(self.directory, 'missing')]
+
+        result = self.call('stat', paths=paths, hashes=True)['result']
+
+        output = subprocess.check_output(['sh', '-c', stat_command(paths, hashes=True)])
+        self.assertEqual(dict((path, path_info(path, fields)) for path, fields in zip(paths, result)), parse_stat(output, paths))
+        self.assertEqual(result[0][:2], ['81a0', '640'])
+        self.assertEqual(result[1][-1], self.file_path)
+        self.assertIsNone(result[3])
+
+    @istest
+    def reports_errors_with_their_type(self):
+        response = self.call('mode', path='/some/sneaky.file')
+
+        self.assertFalse(response['ok'])
+        self.assertEqual(response['type'], 'IOError')
+        self.assertIn('/some/sneaky.file', response['error'])
+
+    @istest
+    def reports_unknown_operations(self):
+        response = self.call('format_disk')
+
+        self.assertFalse(response['ok'])
+        self.assertEqual(response['type'], 'KeyError')
+
+    @istest
+    def lists_and_reads_files(self):
+        self.assertEqual(self.call('list_directory', path=self.directory)['result'], ['some-file'])
+        self.assertEqual(self.call('read', path=self.file_path)['result'], 'some content\n')
+
+    @istest
+    def gets_the_temp_dir(self):
+        self.assertEqual(self.call('temp_dir')['result'], tempfile.gettempdir())
+
+    @istest
+    def serves_framed_requests_until_input_ends(self):
+        stdin = StringIO()
+        agent_script.write_frame(stdin, {'operation': 'exists', 'arguments': {'path': self.file_path}})
+        agent_script.write_frame(stdin, {'operation': 'exists_dir', 'arguments': {'path': self.file_path}})
+        stdin.seek(0)
+        stdout = StringIO()
+
+        agent_script.serve(stdin, stdout)
+
+        stdout.seek(0)
+        self.assertEqual(agent_script.read_frame(stdout), {'ok': True, 'result': True})
+        self.assertEqual(agent_script.read_frame(stdout), {'ok': True, 'result': False})
+        self.assertIsNone(agent_script.read_frame(stdout))
+
+    @istest
+    def runs_as_a_standalone_script_and_removes_itself(self):
+        script_path = os.path.join(self.directory, 'agent.py')
+        shutil.copy(agent_script.__file__.replace('.pyc', '.py'), script_path)
+        request = json.dumps({'operation': 'exists', 'arguments': {'path': self.file_path}})
+
+        process = subprocess.Popen([sys.executable, script_path, '--remove'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        output = process.communicate('%d\n%s' % (len(request), request))[0]
+
+        self.assertEqual(agent_script.read_frame(StringIO(output)), {'ok': True, 'result': True})
+        self.assertFalse(os.path.exists(script_path))
@@ -0,0 +1,110 @@
+import shutil
+import subprocess
+import tempfile
+import time
+
+from mock import ANY, MagicMock, patch
+from nose.tools import istest
+
+from provy.core.background import BackgroundCommand, wait_for_background
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+class LocalShell(object):
+    def __init__(self):
+        self.commands = []
+
+    def execute(self, command, stdout=True, sudo=False, user=None):
+        self.commands.append(command)
+        return subprocess.Popen(['sh', '-c', command], stdout=subprocess.PIPE).communicate()[0].strip()
+
+
+class BackgroundCommandTest(ProvyTestCase):
+    def setUp(self):
+        super(BackgroundCommandTest, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.shell = LocalShell()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def start(self, command):
+        return BackgroundCommand(self.shell, command, '%s/job' % self.temp_dir).start()
+
+    @istest
+    def runs_the_command_detached(self):
+        background = self.start('sleep 0.2; echo finished')
+
+        self.assertIsNone(background.poll())
+        self.assertFalse(background.done)
+        self.assertEqual(background.wait(interval=0.1), 0)
+        self.assertTrue(background.done)
+        self.assertEqual(background.output(), 'finished')
+
+    @istest
+    def polls_the_exit_code_of_a_finished_command(self):
+        background = self.start('exit 3')
+
+        while background.poll() is None:
+            time.sleep(0.05)
+
+        self.assertEqual(background.return_code, 3)
+        self.assertTrue(background.done)
+
+    @istest
+    def doesnt_read_the_exit_code_while_it_is_being_written(self):
+        background = self.start('sleep 0.3')
+        open('%s/job/status.tmp' % self.temp_dir, 'w').close()
+
+        self.assertIsNone(background.poll())
+        self.assertEqual(background.wait(interval=0.1), 0)
+        self.assertIn('> %s/job/status.tmp && mv %s/job/status.tmp %s/job/status' % ((self.temp_dir,) * 3), background.start_command())
+
+    @istest
+    def aborts_when_the_command_fails(self):
+        background = self.start('echo broken; exit 2')
+
+        with patch('provy.core.background.error') as error:
+            self.assertEqual(background.wait(interval=0.1), 2)
+
+            error.assert_called_once_with("execute_async() received nonzero return code 2 while executing!\n\nRequested: echo broken; exit 2", stdout='broken')
+
+    @istest
+    def reports_commands_that_were_killed(self):
+        background = self.start('sleep 5')
+
+        subprocess.call('kill -9 $(cat %s/job/pid)' % self.temp_dir, shell=True)
+
+        with patch('provy.core.background.error'):
+            self.assertEqual(background.wait(interval=0.1), -1)
+
+    @istest
+    def doesnt_check_the_server_again_after_finishing(self):
+        background = self.start('true')
+        background.wait(interval=0.1)
+        commands = len(self.shell.commands)
+
+        background.wait()
+        background.poll()
+
+        self.assertEqual(len(self.shell.commands), commands)
+
+    @istest
+    def runs_the_checks_with_the_same_user(self):
+        role = MagicMock()
+        role.execute.return_value = '0'
+        background = BackgroundCommand(role, 'make', '/tmp/job', user='app')
+
+        background.wait()
+
+        role.execute.assert_called_with(ANY, stdout=False, sudo=False, user='app')
+
+    @istest
+    def waits_for_all_the_commands_in_the_server(self):
+        first, second = MagicMock(), MagicMock()
+
+        wait_for_background({'background': [first, second]})
+        wait_for_background({})
+
+        first.wait.assert_called_once_with()
+        second.wait.assert_called_once_with()
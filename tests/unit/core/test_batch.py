@@ -0,0 +1,156 @@
+import subprocess
+
+from mock import MagicMock, patch
+from nose.tools import istest
+
+import fabric.api
+
+from provy.core.batch import MutationQueue, paths_overlap
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+class PathsOverlapTest(ProvyTestCase):
+    @istest
+    def overlaps_with_the_same_path_or_a_parent(self):
+        self.assertTrue(paths_overlap('/srv/app', '/srv/app/'))
+        self.assertTrue(paths_overlap('/srv/app/logs', '/srv/app'))
+        self.assertTrue(paths_overlap('/srv', '/srv/app/logs'))
+
+    @istest
+    def doesnt_overlap_with_siblings(self):
+        self.assertFalse(paths_overlap('/srv/app', '/srv/application'))
+        self.assertFalse(paths_overlap('/srv/app', '/etc/app'))
+
+    @istest
+    def relative_paths_overlap_with_anything(self):
+        self.assertTrue(paths_overlap('app', '/etc/app'))
+
+
+class MutationQueueTest(ProvyTestCase):
+    def setUp(self):
+        super(MutationQueueTest, self).setUp()
+        self.queue = MutationQueue()
+
+    def run_script(self, command, sudo=False):
+        return subprocess.Popen(['sh', '-c', command], stdout=subprocess.PIPE).communicate()[0].strip()
+
+    @istest
+    def is_active_when_automatic_or_deferring(self):
+        self.assertFalse(self.queue.active)
+        self.queue.deferring = 1
+        self.assertTrue(self.queue.active)
+        self.assertTrue(MutationQueue(automatic=True).active)
+
+    @istest
+    def depends_on_overlapping_paths_only(self):
+        self.queue.add('mkdir -p /srv/app', paths=['/srv/app'])
+
+        self.assertTrue(self.queue.depends_on(['/srv/app/logs']))
+        self.assertFalse(self.queue.depends_on(['/etc/app']))
+        self.assertFalse(self.queue.depends_on([]))
+
+    @istest
+    def depends_on_anything_if_a_command_has_unknown_paths(self):
+        self.queue.add('touch /srv/app/ready')
+
+        self.assertTrue(self.queue.depends_on(['/etc/app']))
+
+    @istest
+    def runs_all_commands_in_a_single_script(self):
+        run = MagicMock(return_value='')
+        self.queue.add('mkdir -p /srv/app', paths=['/srv/app'])
+        self.queue.add('chown -R app /srv/app', sudo=True, paths=['/srv/app'])
+
+        self.queue.flush(run)
+
+        self.assertEqual(run.call_count, 1)
+        command = run.call_args[0][0]
+        self.assertTrue(command.startswith("sh -c 'set -e\n"))
+        self.assertIn('mkdir -p /srv/app', command)
+        self.assertIn('chown -R app /srv/app', command)
+        self.assertEqual(run.call_args[1], {'sudo': True})
+        self.assertEqual(self.queue.pending, [])
+
+    @istest
+    def runs_plain_commands_as_the_logged_user_in_a_super_user_script(self):
+        self.queue.add('mkdir -p /srv/app')
+        self.queue.add('chown -R app /srv/app', sudo=True)
+        self.queue.add('touch /srv/app/ready', user='app')
+
+        script = self.queue.build_script('marker', sudo=True)
+
+        self.assertIn('sudo -u "$SUDO_USER" sh -c \'mkdir -p /srv/app\'', script)
+        self.assertIn('( chown -R app /srv/app )', script)
+        self.assertIn('sudo -u app sh -c \'touch /srv/app/ready\'', script)
+
+    @istest
+    def runs_each_command_with_the_fabric_context_it_was_queued_in(self):
+        with fabric.api.cd('/srv/app'), fabric.api.prefix('. /srv/venv/bin/activate'):
+            self.queue.add('pip install django')
+        self.queue.add('touch /srv/app/ready')
+
+        script = self.queue.build_script('marker', sudo=False)
+
+        self.assertIn('( cd /srv/app >/dev/null && . /srv/venv/bin/activate && pip install django )', script)
+        self.assertIn('( touch /srv/app/ready )', script)
+
+    @istest
+    def runs_commands_with_the_shell_environment_they_were_queued_with(self):
+        with fabric.api.shell_env(GREETING='hello'):
+            first = self.queue.add('echo $GREETING')
+        second = self.queue.add('echo "[$GREETING]"')
+
+        self.queue.flush(self.run_script)
+
+        self.assertEqual(first.output, 'hello')
+        self.assertEqual(second.output, '[]')
+
+    @istest
+    def doesnt_run_anything_if_nothing_is_queued(self):
+        run = MagicMock()
+
+        self.queue.flush(run)
+
+        self.assertFalse(run.called)
+
+    @istest
+    def maps_output_and_exit_code_back_to_each_command(self):
+        first = self.queue.add('echo foo')
+        with fabric.api.cd('/'):
+            second = self.queue.add('echo bar; echo baz')
+
+        self.queue.flush(self.run_script)
+
+        self.assertTrue(first.done)
+        self.assertEqual(str(first), 'foo')
+        self.assertEqual(second.output, 'bar\nbaz')
+        self.assertTrue(second.succeeded)
+
+    @istest
+    def stops_at_the_first_failure_and_aborts(self):
+        first = self.queue.add('echo foo; exit 3')
+        second = self.queue.add('echo bar')
+
+        with patch('provy.core.batch.error') as error:
+            self.queue.flush(self.run_script)
+
+            self.assertEqual(error.call_count, 1)
+        self.assertEqual(first.return_code, 3)
+        self.assertTrue(first.failed)
+        self.assertEqual(first.output, 'foo')
+        self.assertTrue(second.done)
+        self.assertIsNone(second.return_code)
+        self.assertFalse(second.failed)
+
+    @istest
+    def keeps_going_after_commands_queued_with_warn_only(self):
+        with fabric.api.settings(warn_only=True):
+            first = self.queue.add('exit 1')
+        second = self.queue.add('echo bar')
+
+        with patch('provy.core.batch.error') as error:
+            self.queue.flush(self.run_script)
+
+            self.assertFalse(error.called)
+        self.assertEqual(first.return_code, 1)
+        self.assertEqual(second.output, 'bar')
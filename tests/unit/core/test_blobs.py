@@ -0,0 +1,120 @@
+import hashlib
+import os
+import pwd
+import shutil
+import subprocess
+import tempfile
+from StringIO import StringIO
+
+from mock import MagicMock, patch
+from nose import SkipTest
+from nose.tools import istest
+
+from provy.core.blobs import BlobCache, payload_digest
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+SOME_DIGEST = hashlib.sha256('some content').hexdigest()
+
+
+class PayloadDigestTest(ProvyTestCase):
+    @istest
+    def hashes_local_files_and_in_memory_files(self):
+        with open(__file__.replace('.pyc', '.py'), 'rb') as f:
+            self.assertEqual(payload_digest(__file__.replace('.pyc', '.py')), hashlib.sha256(f.read()).hexdigest())
+        self.assertEqual(payload_digest(StringIO('some content')), SOME_DIGEST)
+
+    @istest
+    def doesnt_hash_what_it_cant_read_twice(self):
+        self.assertIsNone(payload_digest('/some/inexistent/file'))
+        self.assertIsNone(payload_digest(object()))
+
+
+class BlobCacheTest(ProvyTestCase):
+    def setUp(self):
+        super(BlobCacheTest, self).setUp()
+        self.cache = BlobCache('/var/cache/blobs')
+        self.run = MagicMock()
+
+    @istest
+    def lists_the_cached_blobs_only_once(self):
+        self.run.return_value = '%s\r\nother-digest' % SOME_DIGEST
+
+        self.assertTrue(self.cache.contains(SOME_DIGEST, self.run))
+        self.assertFalse(self.cache.contains('unknown-digest', self.run))
+
+        self.run.assert_called_once_with('ls -1 /var/cache/blobs 2>/dev/null; true')
+
+    @istest
+    def copies_cached_blobs_in_place(self):
+        self.assertEqual(self.cache.copy_command(SOME_DIGEST, '/etc/app.conf'), 'cat /var/cache/blobs/%s > /etc/app.conf' % SOME_DIGEST)
+
+    @istest
+    def replaces_the_file_with_a_copy_owned_by_the_given_owner(self):
+        with patch('uuid.uuid4') as uuid4:
+            uuid4.return_value.hex = 'abc'
+
+            self.assertEqual(self.cache.copy_command(SOME_DIGEST, '/etc/app.conf', owner='foo'), (
+                'cat /var/cache/blobs/{0} > /etc/app.conf.provy-abc && chown foo: /etc/app.conf.provy-abc && '
+                'mv -f /etc/app.conf.provy-abc /etc/app.conf || {{ rm -f /etc/app.conf.provy-abc; false; }}').format(SOME_DIGEST))
+
+    @istest
+    def gives_the_copies_the_owners_an_upload_would_give(self):
+        if os.getuid() != 0:
+            raise SkipTest('Changing the owner of a file needs the super-user.')
+        nobody = pwd.getpwnam('nobody')
+        directory = tempfile.mkdtemp()
+        try:
+            self.cache.directory = directory
+            with open(self.cache.path(SOME_DIGEST), 'w') as f:
+                f.write('some content')
+            kept = os.path.join(directory, 'kept.conf')
+            replaced = os.path.join(directory, 'replaced.conf')
+            created = os.path.join(directory, 'created.conf')
+            for path in (kept, replaced):
+                open(path, 'w').close()
+                os.chown(path, 12345, 12345)
+                os.chmod(path, 0600)
+
+            for path, owner in ((kept, None), (replaced, 'nobody'), (created, 'nobody')):
+                subprocess.check_call(['sh', '-c', self.cache.copy_command(SOME_DIGEST, path, owner)])
+                with open(path) as f:
+                    self.assertEqual(f.read(), 'some content')
+
+            self.assertEqual((os.stat(kept).st_uid, os.stat(kept).st_mode & 0777), (12345, 0600))
+            self.assertEqual((os.stat(replaced).st_uid, os.stat(replaced).st_gid), (nobody.pw_uid, nobody.pw_gid))
+            self.assertEqual((os.stat(created).st_uid, os.stat(created).st_gid), (nobody.pw_uid, nobody.pw_gid))
+        finally:
+            shutil.rmtree(directory)
+
+    @istest
+    def stores_the_uploads_before_copying_them(self):
+        self.run.return_value = ''
+        self.cache.remember(SOME_DIGEST, '/etc/app.conf', self.run)
+
+        self.assertTrue(self.cache.contains(SOME_DIGEST, self.run))
+        self.assertEqual(self.cache.copy_command(SOME_DIGEST, '/etc/other.conf'), (
+            'mkdir -p /var/cache/blobs && chmod 700 /var/cache/blobs; '
+            "{{ echo '{0}  /etc/app.conf' | sha256sum -c --status && cp -f /etc/app.conf /var/cache/blobs/{0}; }}; true && "
+            'cat /var/cache/blobs/{0} > /etc/other.conf').format(SOME_DIGEST))
+        self.assertEqual(self.cache.pending, {})
+        self.assertIn(SOME_DIGEST, self.cache.blobs)
+
+    @istest
+    def stores_all_the_pending_uploads_at_once(self):
+        self.cache.remember(SOME_DIGEST, '/etc/app.conf', self.run)
+        self.cache.remember('other-digest', '/etc/other.conf', self.run)
+
+        self.cache.flush()
+        self.cache.flush()
+
+        self.assertEqual(self.run.call_count, 1)
+        command = self.run.call_args[0][0]
+        self.assertIn('cp -f /etc/app.conf /var/cache/blobs/%s' % SOME_DIGEST, command)
+        self.assertIn('cp -f /etc/other.conf /var/cache/blobs/other-digest', command)
+
+    @istest
+    def doesnt_store_anything_without_uploads(self):
+        self.cache.flush()
+
+        self.assertIsNone(self.cache.store_command())
@@ -0,0 +1,172 @@
+from mock import MagicMock, patch
+from nose.tools import istest
+
+import fabric.api
+
+from provy.core.channels import CONNECTION_LOCK, RemoteChannel, iter_lines, spooled
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+class RemoteChannelTest(ProvyTestCase):
+    def setUp(self):
+        super(RemoteChannelTest, self).setUp()
+        self.ssh_channel = MagicMock()
+        self.connections = {'foo@bar': MagicMock()}
+        self.connections['foo@bar'].get_transport.return_value.open_session.return_value = self.ssh_channel
+
+    def feed(self, stdout='', stderr=''):
+        self.ssh_channel.recv_ready.side_effect = lambda: bool(stdout_chunks)
+        self.ssh_channel.recv_stderr_ready.side_effect = lambda: bool(stderr_chunks)
+        self.ssh_channel.recv.side_effect = lambda size: stdout_chunks.pop(0)
+        self.ssh_channel.recv_stderr.side_effect = lambda size: stderr_chunks.pop(0)
+        stdout_chunks = [stdout] if stdout else []
+        stderr_chunks = [stderr] if stderr else []
+
+    @istest
+    def builds_a_plain_command(self):
+        channel = RemoteChannel('python agent.py', host_string='foo@bar')
+
+        self.assertEqual(channel.build_command('MARK'), "sh -c 'echo MARK && python agent.py'")
+
+    @istest
+    def builds_a_sudo_command(self):
+        channel = RemoteChannel('python agent.py', sudo=True, host_string='foo@bar')
+
+        with fabric.api.settings(sudo_prompt='sudo password:'):
+            self.assertEqual(channel.build_command('MARK'), "sudo -S -p 'sudo password:' sh -c 'echo MARK && python agent.py'")
+
+    @istest
+    def builds_a_command_for_another_user(self):
+        channel = RemoteChannel('/bin/sh', user='foo', host_string='foo@bar')
+
+        with fabric.api.settings(sudo_prompt='sudo password:'):
+            self.assertEqual(channel.build_command('MARK'), "sudo -S -p 'sudo password:' -u foo sh -c 'echo MARK && /bin/sh'")
+
+    @istest
+    def opens_the_channel_and_waits_for_the_marker(self):
+        with patch('provy.core.channels.connections', self.connections), patch('uuid.uuid4') as uuid4:
+            uuid4.return_value.hex = 'abc'
+            self.feed(stdout='provy-channel-abc\nsome output\n')
+
+            channel = RemoteChannel('cat', host_string='foo@bar').open()
+
+            self.ssh_channel.exec_command.assert_called_once_with("sh -c 'echo provy-channel-abc && cat'")
+            self.assertEqual(channel.readline(), 'some output\n')
+
+    @istest
+    def forwards_the_agent_to_the_command(self):
+        with patch('provy.core.channels.connections', self.connections), patch('provy.core.channels.AgentRequestHandler') as AgentRequestHandler, \
+                patch('uuid.uuid4') as uuid4:
+            uuid4.return_value.hex = 'abc'
+            self.feed(stdout='provy-channel-abc\n')
+
+            RemoteChannel('ssh other-server true', host_string='foo@bar', forward_agent=True).open()
+
+            AgentRequestHandler.assert_called_once_with(self.ssh_channel)
+
+    @istest
+    def looks_up_the_connection_one_thread_at_a_time(self):
+        locked = []
+        connection = self.connections['foo@bar']
+        connection.get_transport.side_effect = lambda: locked.append(CONNECTION_LOCK.locked()) or transport
+        transport = connection.get_transport.return_value
+        transport.open_session.side_effect = lambda: locked.append(CONNECTION_LOCK.locked()) or self.ssh_channel
+        with patch('provy.core.channels.connections', self.connections), patch('uuid.uuid4') as uuid4:
+            uuid4.return_value.hex = 'abc'
+            self.feed(stdout='provy-channel-abc\n')
+
+            RemoteChannel('cat', host_string='foo@bar').open()
+
+            self.assertEqual(locked, [True, False])
+
+    @istest
+    def answers_the_sudo_prompt_with_the_password(self):
+        with patch('provy.core.channels.connections', self.connections), patch('uuid.uuid4') as uuid4, \
+                fabric.api.settings(sudo_prompt='sudo password:', password='some-pass', passwords={}):
+            uuid4.return_value.hex = 'abc'
+            self.feed(stderr='sudo password:')
+            self.ssh_channel.sendall.side_effect = lambda data: self.feed(stdout='provy-channel-abc\n')
+
+            RemoteChannel('cat', sudo=True, host_string='foo@bar').open()
+
+            self.ssh_channel.sendall.assert_called_once_with('some-pass\n')
+
+    @istest
+    def fails_if_the_command_exits_before_starting(self):
+        with patch('provy.core.channels.connections', self.connections):
+            self.feed()
+            self.ssh_channel.exit_status_ready.return_value = True
+
+            self.assertRaises(IOError, RemoteChannel('cat', host_string='foo@bar').open)
+
+    @istest
+    def reads_exact_sizes_across_chunks(self):
+        channel = RemoteChannel('cat', host_string='foo@bar')
+        channel.channel = self.ssh_channel
+        self.ssh_channel.recv.side_effect = ['abc', 'def\n', 'ghi']
+
+        self.assertEqual(channel.read(5), 'abcde')
+        self.assertEqual(channel.readline(), 'f\n')
+        self.assertEqual(channel.read(3), 'ghi')
+
+    @istest
+    def fails_to_read_when_the_output_is_closed(self):
+        channel = RemoteChannel('cat', host_string='foo@bar')
+        channel.channel = self.ssh_channel
+        self.ssh_channel.recv.return_value = ''
+
+        self.assertRaises(EOFError, channel.read, 1)
+
+    @istest
+    def reads_output_and_error_until_the_marker(self):
+        channel = RemoteChannel('/bin/sh', host_string='foo@bar')
+        channel.channel = self.ssh_channel
+        stdout_chunks = ['some out', 'put\nMARK 3\nnext']
+        stderr_chunks = ['some error\nMARK\n']
+        self.ssh_channel.recv_ready.side_effect = lambda: bool(stdout_chunks)
+        self.ssh_channel.recv_stderr_ready.side_effect = lambda: bool(stderr_chunks)
+        self.ssh_channel.recv.side_effect = lambda size: stdout_chunks.pop(0)
+        self.ssh_channel.recv_stderr.side_effect = lambda size: stderr_chunks.pop(0)
+
+        self.assertEqual(channel.read_until('MARK'), ('some output', 'some error', ' 3'))
+        self.assertEqual(channel._buffer, 'next')
+
+    @istest
+    def iterates_over_output_chunks_keeping_the_error(self):
+        channel = RemoteChannel('ls', host_string='foo@bar')
+        channel.channel = self.ssh_channel
+        channel._buffer = 'left'
+        self.feed(stdout='over', stderr='some error')
+        self.ssh_channel.exit_status_ready.return_value = True
+
+        self.assertEqual(list(channel.iter_chunks()), ['left', 'over'])
+        self.assertEqual(channel.stderr, 'some error')
+
+    @istest
+    def finishes_the_command_keeping_its_error(self):
+        channel = RemoteChannel('gzip -dc > /tmp/foo', host_string='foo@bar')
+        channel.channel = self.ssh_channel
+        self.feed(stderr='some warning\n')
+        self.ssh_channel.exit_status_ready.return_value = True
+        self.ssh_channel.recv_exit_status.return_value = 2
+
+        self.assertEqual(channel.finish(), 2)
+
+        self.ssh_channel.shutdown_write.assert_called_once_with()
+        self.assertEqual(channel.stderr, 'some warning\n')
+
+
+class LinesTest(ProvyTestCase):
+    @istest
+    def splits_chunks_into_lines(self):
+        self.assertEqual(list(iter_lines(['foo\nb', 'ar\r\n', '\nbaz'])), ['foo', 'bar', '', 'baz'])
+
+    @istest
+    def doesnt_yield_trailing_empty_line(self):
+        self.assertEqual(list(iter_lines(['foo\n'])), ['foo'])
+
+    @istest
+    def spools_chunks_beyond_memory_limit_to_disk(self):
+        chunks = ['a' * 10, 'b' * 10]
+
+        self.assertEqual(''.join(spooled(iter(chunks), max_memory=5)), 'a' * 10 + 'b' * 10)
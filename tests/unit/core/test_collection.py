@@ -0,0 +1,160 @@
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+from StringIO import StringIO
+
+from mock import patch
+from nose.tools import istest
+
+from provy.core.collection import ChunkReader, Collection, collect, collect_command, is_safe_member, quote_pattern
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+class LocalChannel(object):
+    '''
+    Stands in for a :class:`RemoteChannel <provy.core.channels.RemoteChannel>`, running the command locally, in a directory named after the host.
+    '''
+    root = None
+
+    def __init__(self, command, sudo=False, host_string=None):
+        self.command = command
+        self.host = host_string.split('@')[-1]
+        self.stderr = ''
+
+    def open(self):
+        self.process = subprocess.Popen(['sh', '-c', self.command], cwd=os.path.join(self.root, self.host), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return self
+
+    def iter_chunks(self):
+        return iter(lambda: self.process.stdout.read(1000), '')
+
+    def finish(self):
+        self.process.stdout.read()
+        self.stderr = self.process.stderr.read()
+        return self.process.wait()
+
+    def close(self):
+        pass
+
+
+class LocalCollection(Collection):
+    channel_class = LocalChannel
+
+
+class CollectionTest(ProvyTestCase):
+    def setUp(self):
+        super(CollectionTest, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.local_dir = os.path.join(self.root, 'collected')
+        LocalChannel.root = self.root
+
+    def tearDown(self):
+        super(CollectionTest, self).tearDown()
+        shutil.rmtree(self.root)
+
+    def remote_file(self, host, path, content):
+        full_path = os.path.join(self.root, host, path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, 'wb') as f:
+            f.write(content)
+
+    def collected(self, host, path):
+        with open(os.path.join(self.local_dir, host, path), 'rb') as f:
+            return f.read()
+
+    @istest
+    def quotes_paths_keeping_their_wildcards(self):
+        self.assertEqual(quote_pattern('/var/log/my app/*.log'), "'/var/log/my app/'*.log")
+        self.assertEqual(quote_pattern('/var/log/syslog.[0-9]'), '/var/log/syslog.[0-9]')
+        self.assertEqual(quote_pattern('/etc/app.conf'), '/etc/app.conf')
+
+    @istest
+    def archives_the_matching_files_with_a_single_command(self):
+        self.assertEqual(collect_command(['/var/log/*.log', '/etc/app.conf'], max_size=1024),
+                         'find /var/log/*.log /etc/app.conf -type f -size -1025c -print0 2>/dev/null | tar -czf - --null -T -')
+        self.assertEqual(collect_command(['/etc']), 'find /etc -type f -print0 2>/dev/null | tar -czf - --null -T -')
+
+    @istest
+    def reads_chunks_as_a_file(self):
+        reader = ChunkReader(['ab', 'cde', 'f'])
+
+        self.assertEqual(reader.read(3), 'abc')
+        self.assertEqual(reader.read(), 'def')
+        self.assertEqual(reader.read(3), '')
+
+    @istest
+    def extracts_only_files_and_directories_inside_the_target(self):
+        def member(name, type=tarfile.REGTYPE):
+            info = tarfile.TarInfo(name)
+            info.type = type
+            return info
+
+        self.assertTrue(is_safe_member(member('var/log/app.log')))
+        self.assertTrue(is_safe_member(member('var/log', tarfile.DIRTYPE)))
+        self.assertFalse(is_safe_member(member('../.ssh/authorized_keys')))
+        self.assertFalse(is_safe_member(member('/etc/passwd')))
+        self.assertFalse(is_safe_member(member('var/log/link', tarfile.SYMTYPE)))
+
+    @istest
+    def collects_files_from_many_servers_into_a_directory_per_server(self):
+        for host in ('host1', 'host2'):
+            self.remote_file(host, 'logs/app.log', 'log of %s' % host)
+            self.remote_file(host, 'logs/app.log.1', 'older log')
+            self.remote_file(host, 'logs/huge.log', 'x' * 5000)
+            self.remote_file(host, 'conf/app.conf', 'conf of %s' % host)
+        collection = LocalCollection(['logs/*.log', 'conf'], self.local_dir, ['deploy@host1', 'deploy@host2'], max_size=1000)
+
+        collection.run()
+
+        self.assertEqual(collection.failed, {})
+        for host in ('host1', 'host2'):
+            self.assertEqual(self.collected('deploy@' + host, 'logs/app.log'), 'log of %s' % host)
+            self.assertEqual(self.collected('deploy@' + host, 'conf/app.conf'), 'conf of %s' % host)
+            self.assertFalse(os.path.exists(os.path.join(self.local_dir, 'deploy@' + host, 'logs', 'app.log.1')))
+            self.assertFalse(os.path.exists(os.path.join(self.local_dir, 'deploy@' + host, 'logs', 'huge.log')))
+            self.assertEqual(sorted(collection.collected['deploy@' + host]), [
+                os.path.join(self.local_dir, 'deploy@' + host, 'conf/app.conf'),
+                os.path.join(self.local_dir, 'deploy@' + host, 'logs/app.log'),
+            ])
+
+    @istest
+    def keeps_collecting_from_other_servers_when_one_fails(self):
+        self.remote_file('host1', 'app.log', 'log')
+        collection = LocalCollection(['app.log'], self.local_dir, ['host1', 'missing-host'], parallel=1)
+
+        collection.run()
+
+        self.assertEqual(collection.collected.keys(), ['host1'])
+        self.assertEqual(collection.failed.keys(), ['missing-host'])
+
+    @istest
+    def aborts_if_some_server_couldnt_be_read(self):
+        with patch('provy.core.collection.Collection') as MockCollection, patch('provy.core.collection.error') as error:
+            MockCollection.return_value.failed = {'host2': 'return code 2: tar: error'}
+            MockCollection.return_value.collected = {'host1': []}
+
+            self.assertEqual(collect(['/var/log/*.log'], self.local_dir, ['host1', 'host2']), {'host1': []})
+
+            error.assert_called_once_with('Could not collect files from host2 (return code 2: tar: error)')
+
+    @istest
+    def streams_the_archive_from_the_channel(self):
+        archive = StringIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            info = tarfile.TarInfo('etc/app.conf')
+            info.size = 4
+            tar.addfile(info, StringIO('conf'))
+
+        with patch.object(Collection, 'channel_class') as channel_class:
+            channel = channel_class.return_value.open.return_value
+            channel.iter_chunks.return_value = iter([archive.getvalue()[:10], archive.getvalue()[10:]])
+            channel.finish.return_value = 0
+            collection = Collection(['/etc/app.conf'], self.local_dir, ['host1'], sudo=True)
+
+            self.assertEqual(collection.collect_from('host1'), [os.path.join(self.local_dir, 'host1', 'etc/app.conf')])
+
+            channel_class.assert_called_once_with(collection.command, sudo=True, host_string='host1')
+            channel.close.assert_called_once_with()
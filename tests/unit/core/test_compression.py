@@ -0,0 +1,99 @@
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+from StringIO import StringIO
+
+from mock import patch
+from nose import SkipTest
+from nose.tools import istest
+
+from provy.core.compression import CompressedUpload, compressed_chunks, upload_command, worth_compressing
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+def decompress(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+class CompressionTest(ProvyTestCase):
+    @istest
+    def compresses_only_what_compresses_well(self):
+        self.assertTrue(worth_compressing('server_name example.com;\n' * 1000))
+        self.assertFalse(worth_compressing(os.urandom(10000)))
+        self.assertFalse(worth_compressing(''))
+
+    @istest
+    def compresses_chunks_to_gzip(self):
+        chunks = ['some content\n' * 100, 'more content\n' * 100]
+
+        self.assertEqual(decompress(''.join(compressed_chunks(chunks))), ''.join(chunks))
+
+    @istest
+    def decompresses_in_place_without_sudo(self):
+        self.assertEqual(upload_command('/home/foo/my app.conf', sudo=False), "gzip -dc > '/home/foo/my app.conf'")
+
+    @istest
+    def decompresses_to_a_temporary_file_with_sudo(self):
+        with patch('uuid.uuid4') as uuid4:
+            uuid4.return_value.hex = 'abc'
+
+            self.assertEqual(upload_command('/etc/app.conf', sudo=True),
+                             'gzip -dc > /etc/app.conf.provy-abc && chown ${SUDO_UID:-$(id -u)}:${SUDO_GID:-$(id -g)} /etc/app.conf.provy-abc && '
+                             'mv -f /etc/app.conf.provy-abc /etc/app.conf || { rm -f /etc/app.conf.provy-abc; exit 1; }')
+
+    @istest
+    def leaves_the_file_owned_by_the_logged_user_with_sudo(self):
+        if os.getuid() != 0:
+            raise SkipTest('Changing the owner of a file needs the super-user.')
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'app.conf')
+            open(path, 'w').close()
+            env = dict(os.environ, SUDO_UID='65534', SUDO_GID='65533')
+            process = subprocess.Popen(['sh', '-c', upload_command(path, sudo=True)], stdin=subprocess.PIPE, env=env)
+            process.communicate(''.join(compressed_chunks(['some content'])))
+
+            self.assertEqual(process.returncode, 0)
+            with open(path) as f:
+                self.assertEqual(f.read(), 'some content')
+            self.assertEqual((os.stat(path).st_uid, os.stat(path).st_gid), (65534, 65533))
+        finally:
+            shutil.rmtree(directory)
+
+
+class CompressedUploadTest(ProvyTestCase):
+    def setUp(self):
+        super(CompressedUploadTest, self).setUp()
+        self.content = 'some content\n' * 10000
+        self.source = StringIO(self.content)
+        self.upload = CompressedUpload(self.source, self.source.read(100), '/etc/app.conf', sudo=True)
+
+    @istest
+    def streams_the_compressed_file_to_the_server(self):
+        with patch('provy.core.compression.RemoteChannel') as RemoteChannel:
+            channel = RemoteChannel.return_value.open.return_value
+            channel.finish.return_value = 0
+
+            self.upload.send()
+
+            sent = ''.join(call[0][0] for call in channel.write.call_args_list)
+            self.assertEqual(decompress(sent), self.content)
+            self.assertEqual(self.upload.sent, len(sent))
+            self.assertLess(self.upload.sent, len(self.content) / 10)
+            self.assertEqual(RemoteChannel.call_args[1], {'sudo': True})
+            self.assertIn('gzip -dc > /etc/app.conf.provy-', RemoteChannel.call_args[0][0])
+            channel.close.assert_called_once_with()
+
+    @istest
+    def fails_if_the_server_couldnt_write_the_file(self):
+        with patch('provy.core.compression.RemoteChannel') as RemoteChannel, patch('provy.core.compression.error') as error:
+            channel = RemoteChannel.return_value.open.return_value
+            channel.finish.return_value = 1
+            channel.stderr = 'No space left on device'
+
+            self.upload.send()
+
+            error.assert_called_once_with('put_file() received nonzero return code 1 while uploading /etc/app.conf!', stderr='No space left on device')
+            channel.close.assert_called_once_with()
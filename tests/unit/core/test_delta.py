@@ -0,0 +1,137 @@
+import os
+import random
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from nose.tools import istest
+
+from provy.core import agent_script
+from provy.core.delta import DeltaWriter, MAX_BLOCK_SIZE, MIN_BLOCK_SIZE, block_size_for, roll, weak_checksum, write_delta
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+class DeltaTest(ProvyTestCase):
+    def setUp(self):
+        super(DeltaTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.random = random.Random(42)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def random_bytes(self, size):
+        return ''.join(chr(self.random.randint(0, 255)) for i in range(size))
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def sync(self, old, new, block_size=MIN_BLOCK_SIZE):
+        remote_path = self.write('remote', old)
+        local_path = self.write('local', new)
+        delta_path = os.path.join(self.directory, 'delta')
+
+        with open(delta_path, 'wb') as delta:
+            literal_bytes, md5 = write_delta(local_path, agent_script.signatures(remote_path, block_size), block_size, delta)
+        agent_script.patch(remote_path, delta_path, block_size, md5)
+
+        with open(remote_path, 'rb') as f:
+            self.assertEqual(f.read(), new)
+        return literal_bytes
+
+    @istest
+    def rolls_the_weak_checksum(self):
+        data = self.random_bytes(100)
+        checksum = weak_checksum(data[:10])
+
+        for position in range(90):
+            checksum = roll(checksum, ord(data[position]), ord(data[position + 10]), 10)
+
+            self.assertEqual(checksum, weak_checksum(data[position + 1:position + 11]))
+
+    @istest
+    def picks_block_sizes_around_the_square_root_of_the_file_size(self):
+        self.assertEqual(block_size_for(1000), MIN_BLOCK_SIZE)
+        self.assertEqual(block_size_for(100 * 1024 * 1024), 10 * 1024)
+        self.assertEqual(block_size_for(100 * 1024 * 1024 * 1024), MAX_BLOCK_SIZE)
+
+    @istest
+    def merges_consecutive_block_copies(self):
+        output = StringIO()
+        writer = DeltaWriter(output)
+
+        writer.copy(3)
+        writer.copy(4)
+        writer.data('foo')
+        writer.copy(0)
+        writer.flush()
+
+        self.assertEqual(output.getvalue(), 'C\x00\x00\x00\x03\x00\x00\x00\x02D\x00\x00\x00\x03fooC\x00\x00\x00\x00\x00\x00\x00\x01')
+        self.assertEqual(writer.literal_bytes, 3)
+
+    @istest
+    def sends_only_the_changed_bytes(self):
+        old = self.random_bytes(20 * MIN_BLOCK_SIZE + 100)
+        new = old[:5000] + 'some inserted text' + old[5000:30000] + old[31000:]
+
+        literal_bytes = self.sync(old, new)
+
+        self.assertLess(literal_bytes, 3 * MIN_BLOCK_SIZE)
+
+    @istest
+    def sends_appended_and_truncated_files(self):
+        old = self.random_bytes(10 * MIN_BLOCK_SIZE)
+
+        self.assertEqual(self.sync(old, old + 'some appended text'), len('some appended text'))
+        self.assertEqual(self.sync(old + 'some appended text', old[:3 * MIN_BLOCK_SIZE]), 0)
+
+    @istest
+    def sends_the_whole_file_if_nothing_matches(self):
+        self.assertEqual(self.sync(self.random_bytes(5000), 'completely different content'), len('completely different content'))
+
+    @istest
+    def reads_file_objects_from_their_current_position(self):
+        old = self.random_bytes(4 * MIN_BLOCK_SIZE)
+        new = old + 'some appended text'
+        remote_path = self.write('remote', old)
+        source = StringIO('some header' + new)
+        source.seek(len('some header'))
+
+        delta = StringIO()
+        literal_bytes, md5 = write_delta(source, agent_script.signatures(remote_path, MIN_BLOCK_SIZE), MIN_BLOCK_SIZE, delta)
+
+        self.assertEqual(literal_bytes, len('some appended text'))
+        self.assertEqual(source.tell(), len('some header'))
+        self.assertEqual(source.read(), new)
+
+    @istest
+    def gives_up_when_too_many_bytes_changed(self):
+        old = self.random_bytes(10 * MIN_BLOCK_SIZE)
+        new = old[:MIN_BLOCK_SIZE] + self.random_bytes(9 * MIN_BLOCK_SIZE)
+        remote_path = self.write('remote', old)
+        local_path = self.write('local', new)
+
+        signatures = agent_script.signatures(remote_path, MIN_BLOCK_SIZE)
+        self.assertIsNone(write_delta(local_path, signatures, MIN_BLOCK_SIZE, StringIO(), max_literal=len(new) // 2))
+        self.assertIsNotNone(write_delta(local_path, signatures, MIN_BLOCK_SIZE, StringIO(), max_literal=len(new)))
+
+    @istest
+    def patches_the_file_a_symbolic_link_points_to(self):
+        old = self.random_bytes(4 * MIN_BLOCK_SIZE)
+        new = old + 'some appended text'
+        remote_path = self.write('remote', old)
+        link_path = os.path.join(self.directory, 'link')
+        os.symlink(remote_path, link_path)
+        local_path = self.write('local', new)
+        delta_path = os.path.join(self.directory, 'delta')
+
+        with open(delta_path, 'wb') as delta:
+            literal_bytes, md5 = write_delta(local_path, agent_script.signatures(link_path, MIN_BLOCK_SIZE), MIN_BLOCK_SIZE, delta)
+        agent_script.patch(link_path, delta_path, MIN_BLOCK_SIZE, md5)
+
+        self.assertTrue(os.path.islink(link_path))
+        with open(remote_path, 'rb') as f:
+            self.assertEqual(f.read(), new)
@@ -0,0 +1,169 @@
+import hashlib
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+
+from mock import patch
+from nose.tools import istest
+
+from provy.core.distribution import Distribution, distribute, receive_command, relay_command
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+FAKE_SSH = '''#!/bin/sh
+while [ $# -gt 2 ]; do shift; done
+host=${1#*@}
+[ -d "$PROVY_HOSTS/bin-$host" ] && PATH="$PROVY_HOSTS/bin-$host:$PATH"
+cd "$PROVY_HOSTS/$host" && exec sh -c "$2"
+'''
+
+
+class LocalChannel(object):
+    '''
+    Stands in for a :class:`RemoteChannel <provy.core.channels.RemoteChannel>`, running the command locally, in a directory named after the host, with a fake ``ssh`` that does the same for the relays.
+    '''
+    root = None
+    opened = []
+
+    def __init__(self, command, sudo=False, host_string=None, forward_agent=False):
+        self.command = command
+        self.host = host_string.split('@')[-1]
+        self.process = None
+
+    def open(self):
+        env = dict(os.environ, PROVY_HOSTS=self.root)
+        env['PATH'] = '%s:%s' % (os.path.join(self.root, 'bin'), env['PATH'])
+        if os.path.isdir(os.path.join(self.root, 'bin-%s' % self.host)):
+            env['PATH'] = '%s:%s' % (os.path.join(self.root, 'bin-%s' % self.host), env['PATH'])
+        self.process = subprocess.Popen(['sh', '-c', self.command], cwd=os.path.join(self.root, self.host), stdin=subprocess.PIPE, env=env)
+        self.opened.append(self)
+        return self
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def finish(self):
+        self.process.stdin.close()
+        return self.process.wait()
+
+    def close(self):
+        self.closed = True
+
+
+class LocalDistribution(Distribution):
+    channel_class = LocalChannel
+
+
+class DistributionTest(ProvyTestCase):
+    def setUp(self):
+        super(DistributionTest, self).setUp()
+        self.root = tempfile.mkdtemp()
+        LocalChannel.root = self.root
+        LocalChannel.opened = []
+        self.write_script('bin', 'ssh', FAKE_SSH)
+        self.content = os.urandom(300 * 1024)
+        self.local_path = os.path.join(self.root, 'app.tar.gz')
+        with open(self.local_path, 'wb') as f:
+            f.write(self.content)
+        self.digest = hashlib.sha256(self.content).hexdigest()
+
+    def tearDown(self):
+        super(DistributionTest, self).tearDown()
+        shutil.rmtree(self.root)
+
+    def write_script(self, directory, name, content):
+        path = os.path.join(self.root, directory)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        path = os.path.join(path, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        os.chmod(path, stat.S_IRWXU)
+
+    def hosts(self, count):
+        hosts = ['deploy@host%d' % i for i in range(count)]
+        for host in hosts:
+            os.mkdir(os.path.join(self.root, host.split('@')[1]))
+        return hosts
+
+    def received(self, host):
+        path = os.path.join(self.root, host.split('@')[1], 'releases', 'app.tar.gz')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    @istest
+    def plans_rounds_where_every_holder_sends_the_file(self):
+        distribution = Distribution(self.local_path, '/srv/app.tar.gz', ['host%d' % i for i in range(20)], fanout=2)
+
+        self.assertEqual(distribution.plan(), [(None, 'host0'), (None, 'host1')])
+
+        distribution.holders = ['host0', 'host1']
+        self.assertEqual(distribution.plan(), [(None, 'host2'), (None, 'host3'), ('host0', 'host4'), ('host0', 'host5'), ('host1', 'host6'), ('host1', 'host7')])
+
+    @istest
+    def receives_the_file_only_if_it_matches_the_hash(self):
+        self.assertEqual(receive_command('/srv/releases/app.tar.gz', self.digest),
+                         "mkdir -p /srv/releases && cat > /srv/releases/app.tar.gz.provy-{short} && echo '{digest}  /srv/releases/app.tar.gz.provy-{short}' | sha256sum -c --status && "
+                         "mv -f /srv/releases/app.tar.gz.provy-{short} /srv/releases/app.tar.gz || {{ rm -f /srv/releases/app.tar.gz.provy-{short}; exit 1; }}".format(
+                             digest=self.digest, short=self.digest[:16]))
+
+    @istest
+    def relays_the_file_to_another_server_through_ssh(self):
+        command = relay_command('/srv/app.tar.gz', self.digest, 'deploy@10.0.0.2:2222', sudo=True)
+
+        self.assertTrue(command.startswith("ssh -o BatchMode=yes -o StrictHostKeyChecking=no -p 2222 deploy@10.0.0.2 'sudo -n sh -c '"))
+        self.assertTrue(command.endswith(' < /srv/app.tar.gz'))
+
+    @istest
+    def distributes_the_file_to_all_servers_in_logarithmic_rounds(self):
+        hosts = self.hosts(40)
+        distribution = LocalDistribution(self.local_path, 'releases/app.tar.gz', hosts, fanout=3)
+
+        self.assertEqual(distribution.run(), 3)
+
+        self.assertEqual(sorted(distribution.holders), sorted(hosts))
+        self.assertEqual(distribution.failed, [])
+        for host in hosts:
+            self.assertEqual(self.received(host), self.content)
+
+    @istest
+    def doesnt_keep_corrupted_copies(self):
+        hosts = self.hosts(6)
+        self.write_script('bin-host4', 'cat', '#!/bin/sh\n/bin/cat "$@"\necho corrupted\n')
+        distribution = LocalDistribution(self.local_path, 'releases/app.tar.gz', hosts, fanout=2)
+
+        distribution.run()
+
+        self.assertEqual(distribution.failed, ['deploy@host4'])
+        self.assertEqual(distribution.attempts['deploy@host4'], 3)
+        self.assertIsNone(self.received('deploy@host4'))
+        self.assertEqual(os.listdir(os.path.join(self.root, 'host4', 'releases')), [])
+        for host in hosts:
+            if host != 'deploy@host4':
+                self.assertEqual(self.received(host), self.content)
+
+    @istest
+    def keeps_distributing_when_a_server_cant_be_connected_to(self):
+        hosts = self.hosts(5) + ['deploy@unreachable']
+        distribution = LocalDistribution(self.local_path, 'releases/app.tar.gz', hosts, fanout=6)
+
+        distribution.run()
+
+        self.assertEqual(distribution.failed, ['deploy@unreachable'])
+        self.assertEqual(distribution.attempts['deploy@unreachable'], 3)
+        self.assertEqual(sorted(distribution.holders), sorted(hosts[:5]))
+        self.assertTrue(all(getattr(channel, 'closed', False) for channel in LocalChannel.opened))
+
+    @istest
+    def aborts_if_some_server_didnt_get_the_file(self):
+        with patch('provy.core.distribution.Distribution') as MockDistribution, patch('provy.core.distribution.error') as error:
+            MockDistribution.return_value.failed = ['host2']
+            MockDistribution.return_value.holders = ['host1']
+
+            self.assertEqual(distribute(self.local_path, '/srv/app.tar.gz', ['host1', 'host2']), ['host1'])
+
+            error.assert_called_once_with('Could not distribute %s to host2' % self.local_path)
@@ -0,0 +1,149 @@
+import shutil
+import tempfile
+
+from mock import MagicMock, call, patch
+from nose.tools import istest
+
+from provy.core.facts import FACT_MARKER, FACT_NAMES, FactStore, HostFacts, facts_command, parse_distro_info
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+FACTS_OUTPUT = '\r\n'.join([
+    'provy-fact:distro',
+    'Distributor ID:\tUbuntu',
+    'Description:\tUbuntu 12.04.1 LTS',
+    'Release:\t12.04',
+    'Codename:\tprecise',
+    'provy-fact:user',
+    'vagrant',
+    'provy-fact:hostname',
+    'precise64',
+    'provy-fact:temp_dir',
+    '/tmp',
+    'provy-fact:cpus',
+    '2',
+    'provy-fact:memory',
+    '1048576000',
+])
+
+
+class FactsTest(ProvyTestCase):
+    @istest
+    def gathers_all_facts_in_a_single_command(self):
+        command = facts_command()
+
+        for name in ('distro', 'user', 'hostname', 'temp_dir', 'cpus', 'memory'):
+            self.assertIn('echo %s%s;' % (FACT_MARKER, name), command)
+        self.assertIn('lsb_release -a', command)
+        self.assertIn('whoami', command)
+
+    @istest
+    def parses_lsb_release_output(self):
+        distro_info = parse_distro_info('No LSB modules are available.\nDistributor ID:\tDebian\nRelease:\t6.0.5')
+
+        self.assertEqual(distro_info.distributor_id, 'Debian')
+        self.assertEqual(distro_info.release, '6.0.5')
+        self.assertIsNone(distro_info.codename)
+
+    @istest
+    def parses_all_facts(self):
+        facts = HostFacts()
+
+        facts.parse(FACTS_OUTPUT)
+
+        self.assertTrue(facts.gathered)
+        self.assertEqual(facts.distro.distributor_id, 'Ubuntu')
+        self.assertEqual(facts.distro.codename, 'precise')
+        self.assertEqual(facts.user, 'vagrant')
+        self.assertEqual(facts.hostname, 'precise64')
+        self.assertEqual(facts.temp_dir, '/tmp')
+        self.assertEqual(facts.cpus, 2)
+        self.assertEqual(facts.memory, 1048576000)
+
+    @istest
+    def leaves_missing_facts_empty(self):
+        facts = HostFacts()
+
+        facts.parse('provy-fact:distro\nprovy-fact:user\nvagrant\nprovy-fact:cpus\n')
+
+        self.assertEqual(facts.user, 'vagrant')
+        self.assertIsNone(facts.distro.distributor_id)
+        self.assertIsNone(facts.hostname)
+        self.assertIsNone(facts.cpus)
+        self.assertIsNone(facts.memory)
+
+
+class FactStoreTest(ProvyTestCase):
+    def setUp(self):
+        super(FactStoreTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.store = FactStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_commands(self, *outputs):
+        run = MagicMock()
+        run.side_effect = list(outputs)
+        return run
+
+    @istest
+    def keeps_facts_between_instances(self):
+        self.store.save('vagrant@33.33.33.33', 'boot-1', {'user': 'vagrant', 'cpus': '2'})
+
+        fingerprint, values = FactStore(self.directory).load('vagrant@33.33.33.33')
+
+        self.assertEqual(fingerprint, 'boot-1')
+        self.assertEqual(values, {'user': 'vagrant', 'cpus': '2'})
+
+    @istest
+    def forgets_facts_older_than_their_ttl(self):
+        with patch('time.time') as now:
+            now.return_value = 1000
+            self.store.save('vagrant@33.33.33.33', 'boot-1', {'user': 'vagrant', 'cpus': '2'})
+            now.return_value = 1000 + FactStore.ttls['cpus']
+
+            fingerprint, values = self.store.load('vagrant@33.33.33.33')
+
+        self.assertEqual(values, {'user': 'vagrant'})
+
+    @istest
+    def ignores_kept_facts_when_refreshing(self):
+        self.store.save('vagrant@33.33.33.33', 'boot-1', {'user': 'vagrant'})
+
+        self.assertEqual(FactStore(self.directory, refresh=True).load('vagrant@33.33.33.33'), (None, {}))
+
+    @istest
+    def gathers_and_keeps_all_facts_in_a_cold_run(self):
+        facts = HostFacts()
+        run = self.run_commands('provy-fact:fingerprint\nboot-1\n' + FACTS_OUTPUT)
+
+        facts.gather(run, self.store, 'vagrant@33.33.33.33')
+
+        run.assert_called_once_with(facts_command(FACT_NAMES, fingerprint=True))
+        self.assertEqual(facts.user, 'vagrant')
+        self.assertEqual(self.store.load('vagrant@33.33.33.33')[0], 'boot-1')
+
+    @istest
+    def only_checks_the_fingerprint_in_a_warm_run(self):
+        HostFacts().gather(self.run_commands('provy-fact:fingerprint\nboot-1\n' + FACTS_OUTPUT), self.store, 'vagrant@33.33.33.33')
+        facts = HostFacts()
+        run = self.run_commands('provy-fact:fingerprint\nboot-1\n')
+
+        facts.gather(run, self.store, 'vagrant@33.33.33.33')
+
+        run.assert_called_once_with(facts_command([], fingerprint=True))
+        self.assertEqual(facts.hostname, 'precise64')
+        self.assertEqual(facts.memory, 1048576000)
+
+    @istest
+    def gathers_everything_again_if_the_fingerprint_changed(self):
+        self.store.save('vagrant@33.33.33.33', 'boot-1', {'user': 'old-user'})
+        facts = HostFacts()
+        run = self.run_commands('provy-fact:fingerprint\nboot-2\nprovy-fact:distro\nprovy-fact:hostname\nprecise64', 'provy-fact:user\nvagrant')
+
+        facts.gather(run, self.store, 'vagrant@33.33.33.33')
+
+        self.assertEqual(run.call_args_list[1], call(facts_command(['user'])))
+        self.assertEqual(facts.user, 'vagrant')
+        self.assertEqual(self.store.load('vagrant@33.33.33.33'), ('boot-2', {'distro': '', 'hostname': 'precise64', 'user': 'vagrant'}))
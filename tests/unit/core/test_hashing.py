@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from mock import patch
+from nose.tools import istest
+
+from provy.core.hashing import LocalHashes, md5_file
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+class LocalHashesTest(ProvyTestCase):
+    def setUp(self):
+        super(LocalHashesTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.directory, 'app.conf')
+        self.write('some content')
+        self.store_path = os.path.join(self.directory, 'local-hashes.json')
+
+    def tearDown(self):
+        super(LocalHashesTest, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def write(self, content, mtime=1000):
+        with open(self.file_path, 'w') as f:
+            f.write(content)
+        os.utime(self.file_path, (mtime, mtime))
+
+    @istest
+    def hashes_files_in_chunks(self):
+        with patch('provy.core.hashing.CHUNK_SIZE', 5):
+            self.assertEqual(md5_file(self.file_path), hashlib.md5('some content').hexdigest())
+
+    @istest
+    def doesnt_hash_unchanged_files_again(self):
+        hashes = LocalHashes()
+
+        with patch('provy.core.hashing.md5_file') as mock_md5_file:
+            mock_md5_file.return_value = 'some-hash'
+
+            self.assertEqual(hashes.md5(self.file_path), 'some-hash')
+            self.assertEqual(hashes.md5(self.file_path), 'some-hash')
+
+            self.assertEqual(mock_md5_file.call_count, 1)
+
+    @istest
+    def hashes_changed_files_again(self):
+        hashes = LocalHashes()
+        hashes.md5(self.file_path)
+
+        self.write('other content', mtime=2000)
+
+        self.assertEqual(hashes.md5(self.file_path), hashlib.md5('other content').hexdigest())
+
+    @istest
+    def doesnt_remember_files_that_just_changed(self):
+        hashes = LocalHashes()
+        os.utime(self.file_path, None)
+
+        self.assertEqual(hashes.md5(self.file_path), hashlib.md5('some content').hexdigest())
+        self.assertEqual(hashes.entries, {})
+
+    @istest
+    def returns_none_for_missing_files(self):
+        self.assertIsNone(LocalHashes().md5(os.path.join(self.directory, 'missing')))
+
+    @istest
+    def keeps_the_hashes_between_runs(self):
+        hashes = LocalHashes(self.store_path)
+        hashes.md5(self.file_path)
+        hashes.save()
+
+        with patch('provy.core.hashing.md5_file') as mock_md5_file:
+            self.assertEqual(LocalHashes(self.store_path).md5(self.file_path), hashlib.md5('some content').hexdigest())
+            self.assertFalse(mock_md5_file.called)
+
+    @istest
+    def forgets_files_that_no_longer_exist_when_saving(self):
+        hashes = LocalHashes(self.store_path)
+        hashes.md5(self.file_path)
+        os.remove(self.file_path)
+
+        hashes.save()
+
+        with open(self.store_path) as f:
+            self.assertEqual(json.load(f), {})
+
+    @istest
+    def ignores_an_unreadable_store(self):
+        with open(self.store_path, 'w') as f:
+            f.write('not json')
+
+        self.assertEqual(LocalHashes(self.store_path).md5(self.file_path), hashlib.md5('some content').hexdigest())
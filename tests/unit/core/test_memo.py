@@ -0,0 +1,50 @@
+from nose.tools import istest
+
+from provy.core.memo import QueryCache
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+class QueryCacheTest(ProvyTestCase):
+    def setUp(self):
+        super(QueryCacheTest, self).setUp()
+        self.cache = QueryCache()
+
+    @istest
+    def returns_a_copy_of_stored_results(self):
+        self.cache.store('listing', ['/srv'], ['foo'])
+
+        self.cache.get('listing').append('bar')
+
+        self.assertEqual(self.cache.get('listing'), ['foo'])
+
+    @istest
+    def raises_key_error_for_unknown_queries(self):
+        with self.assertRaises(KeyError):
+            self.cache.get('listing')
+
+    @istest
+    def forgets_queries_over_overlapping_paths(self):
+        self.cache.store('app', ['/srv/app/app.conf'], True)
+        self.cache.store('other', ['/srv/other'], True)
+
+        self.cache.invalidate(['/srv/app'])
+
+        self.assertNotIn('app', self.cache.entries)
+        self.assertIn('other', self.cache.entries)
+
+    @istest
+    def forgets_all_path_queries_but_keeps_the_others(self):
+        self.cache.store('app', ['/srv/app'], True)
+        self.cache.store('user', [], 'vagrant')
+
+        self.cache.invalidate()
+
+        self.assertEqual(list(self.cache.entries.keys()), ['user'])
+
+    @istest
+    def clears_everything(self):
+        self.cache.store('user', [], 'vagrant')
+
+        self.cache.clear()
+
+        self.assertEqual(self.cache.entries, {})
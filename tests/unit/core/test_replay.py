@@ -0,0 +1,143 @@
+import json
+import os
+import tempfile
+
+from mock import MagicMock, patch
+from nose.tools import istest
+
+import fabric.api
+
+from provy.core.errors import ReplayError
+from provy.core.replay import Player, Recorder, normalize
+from provy.core.sessions import CommandResult
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+class ReplayTestCase(ProvyTestCase):
+    def setUp(self):
+        super(ReplayTestCase, self).setUp()
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def entries(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def record(self, *entries):
+        with open(self.path, 'w') as f:
+            for entry in entries:
+                recorded = {'host': 'vagrant@33.33.33.33', 'kind': 'execute', 'output': '', 'stderr': '', 'return_code': 0, 'latency': 0.5}
+                recorded.update(entry)
+                f.write(json.dumps(recorded) + '\n')
+
+
+class RecorderTest(ReplayTestCase):
+    def setUp(self):
+        super(RecorderTest, self).setUp()
+        self.recorder = Recorder(self.path)
+
+    @istest
+    def records_commands_with_their_results(self):
+        with fabric.api.settings(host_string='vagrant@33.33.33.33'):
+            result = self.recorder.execute('execute', 'ls /', lambda: CommandResult('bin\netc', 'some warning', 0, 'ls /'))
+        self.recorder.close()
+
+        self.assertEqual(result, 'bin\netc')
+        entry = self.entries()[0]
+        self.assertEqual(entry['host'], 'vagrant@33.33.33.33')
+        self.assertEqual(entry['command'], 'ls /')
+        self.assertEqual(entry['output'], 'bin\netc')
+        self.assertEqual(entry['stderr'], 'some warning')
+        self.assertEqual(entry['return_code'], 0)
+        self.assertIn('latency', entry)
+
+    @istest
+    def records_uploads(self):
+        self.recorder.execute('put', '/etc/app.conf', lambda: ['/etc/app.conf'])
+        self.recorder.close()
+
+        self.assertEqual(self.entries()[0]['kind'], 'put')
+        self.assertIsNone(self.entries()[0]['output'])
+
+    @istest
+    def records_aborted_commands(self):
+        def run():
+            raise SystemExit(1)
+
+        with self.assertRaises(SystemExit):
+            self.recorder.execute('execute', 'false', run)
+        self.recorder.close()
+
+        self.assertTrue(self.entries()[0]['aborted'])
+
+
+class PlayerTest(ReplayTestCase):
+    def replay(self, kind, command, latency=False):
+        run = MagicMock()
+        with fabric.api.settings(host_string='vagrant@33.33.33.33'):
+            result = Player(self.path, latency=latency).execute(kind, command, run)
+        self.assertFalse(run.called)
+        return result
+
+    @istest
+    def normalizes_random_ids(self):
+        self.assertEqual(normalize('rm /tmp/script2f1c1b9e-3f2a-4c41-9f0e-1b7a1f0a2b3c.py'), 'rm /tmp/script<id>.py')
+        self.assertEqual(normalize("printf 'provy-batch-0123456789abcdef0123456789abcdef'"), "printf 'provy-batch-<id>'")
+
+    @istest
+    def answers_with_the_recorded_result(self):
+        self.record({'command': 'ls /', 'output': 'bin\netc', 'stderr': 'some warning'})
+
+        result = self.replay('execute', 'ls /')
+
+        self.assertEqual(result, 'bin\netc')
+        self.assertEqual(result.stderr, 'some warning')
+        self.assertTrue(result.succeeded)
+
+    @istest
+    def matches_commands_with_different_random_ids(self):
+        self.record({'kind': 'put', 'command': '/tmp/script2f1c1b9e-3f2a-4c41-9f0e-1b7a1f0a2b3c.py', 'output': None})
+
+        self.assertIsNone(self.replay('put', '/tmp/script7d6c1b9e-3f2a-4c41-9f0e-1b7a1f0a2b3c.py'))
+
+    @istest
+    def answers_repeated_commands_in_order_and_then_with_the_last_result(self):
+        self.record({'command': 'cat /etc/app.conf', 'output': 'first'}, {'command': 'cat /etc/app.conf', 'output': 'second'})
+        player = Player(self.path)
+
+        with fabric.api.settings(host_string='vagrant@33.33.33.33'):
+            results = [player.execute('execute', 'cat /etc/app.conf', None) for i in range(3)]
+
+        self.assertEqual(results, ['first', 'second', 'second'])
+
+    @istest
+    def fails_for_commands_that_were_not_recorded(self):
+        self.record({'command': 'ls /'})
+
+        with self.assertRaises(ReplayError):
+            self.replay('execute', 'ls /srv')
+
+    @istest
+    def sleeps_for_the_recorded_latency(self):
+        self.record({'command': 'ls /'})
+
+        with patch('time.sleep') as sleep:
+            self.replay('execute', 'ls /')
+            self.assertFalse(sleep.called)
+
+            self.replay('execute', 'ls /', latency=True)
+            sleep.assert_called_once_with(0.5)
+
+    @istest
+    def fails_like_the_recorded_command(self):
+        self.record({'command': 'false', 'output': 'oops', 'return_code': 1}, {'command': 'crash', 'aborted': True})
+
+        with patch('provy.core.replay.error') as error, patch('provy.core.replay.abort') as abort:
+            self.assertEqual(self.replay('execute', 'false').return_code, 1)
+            self.replay('execute', 'crash')
+
+            self.assertEqual(error.call_count, 1)
+            self.assertEqual(abort.call_count, 1)
@@ -2,36 +2,32 @@
 from StringIO import StringIO
 
 from contextlib import contextmanager
+import hashlib
 import os
+import shutil
+import subprocess
+import tarfile
 import tempfile
 
+import fabric.api
 from jinja2 import ChoiceLoader, FileSystemLoader
 from mock import MagicMock, patch, call, ANY, Mock, DEFAULT
 from nose.tools import istest
 
+from provy.core.batch import MutationQueue
+from provy.core.blobs import BlobCache
+from provy.core.delta import weak_checksum
+from provy.core.facts import HostFacts, facts_command
+from provy.core.memo import QueryCache
+from provy.core.pathinfo import PathInfo, mode_command, owner_command, parse_stat, stat_command
 from provy.core.roles import Role, UsingRole, UpdateData
+from provy.core.sessions import SessionPool
+from provy.core.stats import CallStats
+from provy.core.sync import manifest_command
+from tests.unit.core.test_facts import FACTS_OUTPUT
 from tests.unit.tools.helpers import PROJECT_ROOT, ProvyTestCase
 
 
-class FileContentMatcher(object):
-
-    """
-    Can be used to match first argument of put_file if we expected call like::
-
-        role.put_file(StringIO("foobar"), "/tmp/foo")
-
-    """
-
-    def __init__(self, test, file_contents):
-        self.test = test
-        self.file_contents = file_contents
-
-    def __eq__(self, other):
-        self.test.assertIsInstance(other, StringIO)
-        self.test.assertEqual(other.read(), self.file_contents)
-        return True
-
-
 class RoleTest(ProvyTestCase):
     def setUp(self):
         loader = ChoiceLoader([
@@ -45,7 +41,7 @@ class RoleTest(ProvyTestCase):
             'host': 'localhost',
         }
         self.role = Role(prov=None, context=context)
-        self.update_data = UpdateData('/tmp/some-file.ext', 'some local md5', 'some remote md5')
+        self.update_data = UpdateData(StringIO('some content'), 'some local md5', 'some remote md5')
 
     @contextmanager
     def mock_update_data(self):
@@ -71,16 +67,27 @@ class RoleTest(ProvyTestCase):
 
     @istest
     def doesnt_create_directory_if_it_already_exists(self):
-        with self.mock_role_method('remote_exists_dir') as remote_exists_dir, self.execute_mock() as execute:
-            remote_exists_dir.return_value = True
+        with self.mock_role_method('remote_stat') as remote_stat, self.execute_mock() as execute:
+            remote_stat.return_value = {'/some_path': PathInfo('/some_path', type='directory', owner='foo')}
             self.role.ensure_dir('/some_path')
             self.assertFalse(execute.called)
 
+    @istest
+    def fixes_the_owner_of_the_contents_of_an_existing_directory(self):
+        with self.mock_role_method('remote_stat') as remote_stat, self.execute_mock() as execute:
+            remote_stat.return_value = {'/some_path': PathInfo('/some_path', type='directory', owner='foo')}
+            execute.return_value = '0'
+
+            self.role.ensure_dir('/some_path', owner='foo')
+
+            execute.assert_called_once_with(owner_command('/some_path', 'foo'), stdout=False, sudo=True)
+
     @istest
     def creates_the_directory_if_it_doesnt_exist(self):
-        with self.mock_role_method('remote_exists_dir') as remote_exists_dir, self.execute_mock() as execute:
-            remote_exists_dir.return_value = False
+        with self.mock_role_method('remote_stat') as remote_stat, self.execute_mock() as execute:
+            remote_stat.return_value = {'/some_path': PathInfo('/some_path')}
             self.role.ensure_dir('/some_path')
+            remote_stat.assert_called_once_with(['/some_path'])
             execute.assert_called_with('mkdir -p /some_path', stdout=False, sudo=False)
 
     @istest
@@ -128,52 +135,72 @@ class RoleTest(ProvyTestCase):
             execute.assert_called_once_with('lsb_release -a')
             self.assertEqual(distro_info1, distro_info2)
 
+    def run_locally(self, command, stdout=False, sudo=False, user=None):
+        return subprocess.check_output(['sh', '-c', command])
+
+    @contextmanager
+    def remote_text_file(self, content):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'some file')
+            if content is not None:
+                with open(path, 'w') as f:
+                    f.write(content)
+            yield path
+        finally:
+            shutil.rmtree(directory)
+
     @istest
-    def ignores_line_if_already_exists_in_file(self):
-        with self.mock_role_methods("has_line", "put_file", "execute") as mocked:
-            has_line, _, execute = mocked
-            has_line.return_value = True
-            self.role.ensure_line('this line in', '/some/file')
-            self.assertFalse(execute.called)
+    def ensures_many_lines_with_a_single_command(self):
+        with self.remote_text_file('127.0.0.1   localhost\nlast line without break') as path, self.execute_mock() as execute:
+            execute.side_effect = self.run_locally
+
+            appended = self.role.ensure_lines(['127.0.0.1 localhost', "10.0.0.2\tdb   $HOME 'quoted'", 'a\\tb', 'a\\tb'], path, sudo=True)
+
+            self.assertEqual(appended, ["10.0.0.2\tdb   $HOME 'quoted'", 'a\\tb'])
+            self.assertEqual(execute.call_count, 1)
+            self.assertEqual(execute.call_args[1], {'stdout': False, 'sudo': True, 'user': None})
+            with open(path) as f:
+                self.assertEqual(f.read(), "127.0.0.1   localhost\nlast line without break\n10.0.0.2\tdb   $HOME 'quoted'\na\\tb\n")
 
     @istest
-    def inserts_line_if_it_doesnt_exist_yet(self):
+    def ignores_lines_that_already_exist_in_file(self):
+        with self.remote_text_file('127.0.0.1   localhost\n') as path, self.execute_mock() as execute:
+            execute.side_effect = self.run_locally
+
+            self.assertEqual(self.role.ensure_lines(['127.0.0.1 localhost'], path), [])
 
-        LINE_CONTENTS = 'this line in'
-        REMOTE_TMP_FILE = "/tmp/foo"
-        with self.mock_role_methods("has_line", "put_file", "execute", "create_remote_temp_file") as mocked:
-            has_line, put_file, execute, create_remote_temp_file = mocked
-            create_remote_temp_file.return_value = REMOTE_TMP_FILE
-            has_line.return_value = False
-            self.role.ensure_line(LINE_CONTENTS, "/some/file")
-            put_file.assert_called_with(FileContentMatcher(self, LINE_CONTENTS), REMOTE_TMP_FILE, False, stdout=False)
-            execute.assert_called_with('cat {} >> /some/file && echo >> /some/file'.format(REMOTE_TMP_FILE), stdout=False, sudo=False, user=None)
+            with open(path) as f:
+                self.assertEqual(f.read(), '127.0.0.1   localhost\n')
 
     @istest
-    def inserts_line_if_it_doesnt_exist_yet_with_sudo(self):
+    def creates_the_file_when_ensuring_lines(self):
+        with self.remote_text_file(None) as path, self.execute_mock() as execute:
+            execute.side_effect = self.run_locally
+
+            self.assertEqual(self.role.ensure_lines(['this line in'], path), ['this line in'])
 
-        LINE_CONTENTS = 'this line in'
-        REMOTE_TMP_FILE = "/tmp/foo"
-        with self.mock_role_methods("has_line", "put_file", "execute", "create_remote_temp_file") as mocked:
-            has_line, put_file, execute, create_remote_temp_file = mocked
-            create_remote_temp_file.return_value = REMOTE_TMP_FILE
-            has_line.return_value = False
-            self.role.ensure_line(LINE_CONTENTS, "/some/file", sudo=True)
-            put_file.assert_called_with(FileContentMatcher(self, LINE_CONTENTS), REMOTE_TMP_FILE, True, stdout=False)
-            execute.assert_called_with('cat {} >> /some/file && echo >> /some/file'.format(REMOTE_TMP_FILE), stdout=False, sudo=True, user=None)
+            with open(path) as f:
+                self.assertEqual(f.read(), 'this line in\n')
 
     @istest
-    def inserts_line_if_it_doesnt_exist_yet_with_user(self):
+    def inserts_line_as_another_user(self):
+        with self.mock_role_method('ensure_lines') as ensure_lines:
+            self.role.ensure_line('this line in', '/some/file', owner='foo')
 
-        LINE_CONTENTS = 'this line in'
-        REMOTE_TMP_FILE = "/tmp/foo"
-        with self.mock_role_methods("has_line", "put_file", "execute", "create_remote_temp_file") as mocked:
-            has_line, put_file, execute, create_remote_temp_file = mocked
-            create_remote_temp_file.return_value = REMOTE_TMP_FILE
-            has_line.return_value = False
-            self.role.ensure_line(LINE_CONTENTS, "/some/file", owner="foo")
-            put_file.assert_called_with(FileContentMatcher(self, LINE_CONTENTS), REMOTE_TMP_FILE, True, stdout=False)
-            execute.assert_called_with('cat {} >> /some/file && echo >> /some/file'.format(REMOTE_TMP_FILE), stdout=False, sudo=False, user="foo")
+            ensure_lines.assert_called_once_with(['this line in'], '/some/file', owner='foo', sudo=False)
+
+    @istest
+    def forgets_queries_over_the_file_when_ensuring_lines(self):
+        self.role.context['query_cache'] = QueryCache()
+        with self.execute_mock() as execute:
+            execute.side_effect = ['0', '', '0']
+
+            self.role.remote_exists('/some/file')
+            self.role.ensure_lines(['this line in'], '/some/file')
+            self.role.remote_exists('/some/file')
+
+            self.assertEqual(execute.call_count, 3)
 
     @istest
     def registers_a_template_loader(self):
@@ -292,6 +319,206 @@ class RoleTest(ProvyTestCase):
             sudo.assert_called_with('some command', user='foo')
             hide.assert_called_with('warnings', 'running', 'stdout', 'stderr')
 
+    @istest
+    def executes_sudo_commands_in_the_persistent_session(self):
+        self.role.context['sessions'] = MagicMock()
+        with patch('fabric.api.sudo') as sudo:
+            self.role.context['sessions'].run.return_value = 'some result'
+
+            self.assertEqual(self.role.execute('some command', sudo=True), 'some result')
+            self.role.execute('other command', user='foo')
+
+            self.assertEqual(self.role.context['sessions'].run.mock_calls, [
+                call('some command', user=None),
+                call('other command', user='foo'),
+            ])
+            self.assertFalse(sudo.called)
+
+    @istest
+    def keeps_fabric_prefixes_in_the_persistent_session(self):
+        pool = SessionPool()
+        self.role.context['sessions'] = pool
+        with patch('provy.core.sessions.RemoteChannel') as RemoteChannel:
+            channel = RemoteChannel.return_value.open.return_value
+            channel.read_until.return_value = ('', '', '0')
+
+            with fabric.api.prefix('source /srv/venv/bin/activate'):
+                self.role.execute('pip install django', stdout=False, user='app')
+
+            self.assertIn('source /srv/venv/bin/activate && pip install django', channel.write.call_args[0][0])
+
+    @istest
+    def executes_plain_commands_outside_the_persistent_session(self):
+        self.role.context['sessions'] = MagicMock()
+        with patch('fabric.api.run') as run:
+            self.role.execute('some command')
+
+            run.assert_called_with('some command')
+            self.assertFalse(self.role.context['sessions'].run.called)
+
+    @istest
+    def starts_a_background_command(self):
+        with self.execute_mock() as execute, patch('uuid.uuid4') as uuid4:
+            self.role.context['scratch_dir'] = '/tmp/provy-scratch'
+            uuid4.return_value.hex = 'abc'
+
+            background = self.role.execute_async('make install', cwd='/srv/src', sudo=True)
+
+            self.assertEqual(background.command, 'cd /srv/src && make install')
+            self.assertEqual(background.directory, '/tmp/provy-scratch/provy-async-abc')
+            execute.assert_called_once_with(background.start_command(), stdout=False, sudo=True, user=None)
+            self.assertIn('nohup sh -c', background.start_command())
+            self.assertEqual(self.role.context['background'], [background])
+
+    @istest
+    def executes_commands_through_the_replay_transport(self):
+        transport = self.role.context['transport'] = MagicMock()
+        with patch('fabric.api.sudo') as sudo:
+            transport.execute.side_effect = lambda kind, command, run: run()
+            sudo.return_value = 'some result'
+
+            self.assertEqual(self.role.execute('some command', sudo=True), 'some result')
+
+            transport.execute.assert_called_once_with('execute', 'some command', ANY)
+            sudo.assert_called_once_with('some command', user=None)
+
+    @istest
+    def uploads_files_through_the_replay_transport(self):
+        transport = self.role.context['transport'] = MagicMock()
+        with patch('fabric.api.put') as put:
+            self.role.put_file('/local/app.conf', '/etc/app.conf', sudo=True, stdout=False)
+
+            transport.execute.assert_called_once_with('put', '/etc/app.conf', ANY)
+            self.assertFalse(put.called)
+
+    @istest
+    def iterates_over_command_output_through_the_replay_transport(self):
+        transport = self.role.context['transport'] = MagicMock()
+        transport.execute.return_value = 'foo\nbar'
+        with patch('provy.core.roles.RemoteChannel') as RemoteChannel:
+            self.assertEqual(list(self.role.execute_iter('ls /')), ['foo', 'bar'])
+
+            self.assertFalse(RemoteChannel.called)
+
+    @istest
+    def accounts_calls_to_the_server_per_caller(self):
+        stats = self.role.context['stats'] = CallStats()
+        with patch('fabric.api.run') as run, patch('fabric.api.put'), patch('fabric.api.local') as local, fabric.api.settings(host_string='vagrant@33.33.33.33'):
+            run.return_value = 'some output'
+            local.return_value = 'local output'
+
+            self.role.execute('some command')
+            self.role.execute_local('some local command')
+            self.role.put_file(StringIO('some content'), '/etc/app.conf', stdout=False)
+
+        execute = stats.totals[('vagrant@33.33.33.33', 'execute', ('Role', 'execute'))]
+        local = stats.totals[('vagrant@33.33.33.33', 'local', ('Role', 'execute_local'))]
+        put = stats.totals[('vagrant@33.33.33.33', 'put', ('Role', 'put_file'))]
+        self.assertEqual((execute.count, execute.sent, execute.received), (1, len('some command'), len('some output')))
+        self.assertEqual((local.count, local.received), (1, len('local output')))
+        self.assertEqual((put.count, put.sent), (1, len('some content')))
+
+    @istest
+    def accounts_compressed_uploads_and_persistent_sessions(self):
+        stats = self.role.context['stats'] = CallStats()
+        self.role.context['sessions'] = SessionPool()
+        content = 'some compressible content\n' * 5000
+        with patch('provy.core.compression.RemoteChannel') as UploadChannel, patch('provy.core.sessions.RemoteChannel') as SessionChannel, \
+                fabric.api.settings(host_string='vagrant@33.33.33.33'):
+            UploadChannel.return_value.open.return_value.finish.return_value = 0
+            SessionChannel.return_value.open.return_value.read_until.return_value = ('some output', '', '0')
+
+            self.role.put_file(StringIO(content), '/etc/app.conf', sudo=True, stdout=False)
+            self.role.execute('some command', stdout=False, sudo=True)
+
+        report = stats.report('vagrant@33.33.33.33')
+        self.assertIn('2 calls in vagrant@33.33.33.33', report)
+        self.assertIn('put     Role.put_file', report)
+        self.assertIn('execute Role.execute', report)
+        put = stats.totals[('vagrant@33.33.33.33', 'put', ('Role', 'put_file'))]
+        self.assertTrue(0 < put.sent < len(content))
+
+    @istest
+    def compresses_large_uploads(self):
+        content = 'some compressible content\n' * 5000
+        with patch('provy.core.roles.CompressedUpload') as CompressedUpload, patch('fabric.api.put') as put:
+            self.role.put_file(StringIO(content), '/etc/app.conf', sudo=True, stdout=False)
+
+            source, sample, to_file = CompressedUpload.call_args[0]
+            self.assertEqual((sample, to_file), (content[:65536], '/etc/app.conf'))
+            self.assertEqual(CompressedUpload.call_args[1], {'sudo': True})
+            CompressedUpload.return_value.send.assert_called_once_with()
+            self.assertFalse(put.called)
+
+    @istest
+    def doesnt_compress_uploads_that_dont_compress_well(self):
+        content = StringIO(os.urandom(100000))
+        with patch('provy.core.roles.CompressedUpload') as CompressedUpload, patch('fabric.api.put') as put:
+            self.role.put_file(content, '/etc/app.tar.gz', stdout=False)
+
+            self.assertFalse(CompressedUpload.called)
+            put.assert_called_once_with(content, '/etc/app.tar.gz', use_sudo=False)
+            self.assertEqual(content.tell(), 0)
+
+    @istest
+    def doesnt_compress_uploads_below_the_threshold(self):
+        self.role.context['compress_threshold'] = None
+        with patch('provy.core.roles.CompressedUpload') as CompressedUpload, patch('fabric.api.put'):
+            self.role.put_file(StringIO('some compressible content\n' * 5000), '/etc/app.conf', stdout=False)
+
+            self.assertFalse(CompressedUpload.called)
+
+    @istest
+    def copies_uploads_already_in_the_blob_cache_as_the_logged_user_with_sudo(self):
+        blobs = self.role.context['blobs'] = BlobCache('/var/cache/blobs')
+        blobs.blobs = set([hashlib.sha256('some content').hexdigest()])
+        with self.mock_role_methods('_mutate', 'get_logged_user'), patch('fabric.api.put') as put, patch('uuid.uuid4') as uuid4:
+            uuid4.return_value.hex = 'abc'
+            self.role.get_logged_user.return_value = 'foo'
+
+            self.role.put_file(StringIO('some content'), '/etc/app.conf', sudo=True)
+
+            self.assertFalse(put.called)
+            self.role._mutate.assert_called_once_with(
+                blobs.copy_command(hashlib.sha256('some content').hexdigest(), '/etc/app.conf', 'foo'), ['/etc/app.conf'], sudo=True)
+
+    @istest
+    def copies_uploads_already_in_the_blob_cache_in_place_without_sudo(self):
+        blobs = self.role.context['blobs'] = BlobCache('/var/cache/blobs')
+        blobs.blobs = set([hashlib.sha256('some content').hexdigest()])
+        with self.mock_role_methods('_mutate', 'execute'), patch('fabric.api.put') as put:
+            self.role.execute.return_value = '0'
+
+            self.role.put_file(StringIO('some content'), '/home/foo/app.conf')
+
+            self.assertFalse(put.called)
+            self.role.execute.assert_called_once_with('test -w /home/foo/app.conf; echo $?', stdout=False)
+            self.role._mutate.assert_called_once_with(
+                blobs.copy_command(hashlib.sha256('some content').hexdigest(), '/home/foo/app.conf'), ['/home/foo/app.conf'], sudo=True)
+
+    @istest
+    def uploads_files_the_logged_user_cant_write_even_if_in_the_blob_cache(self):
+        blobs = self.role.context['blobs'] = BlobCache('/var/cache/blobs')
+        blobs.blobs = set([hashlib.sha256('some content').hexdigest()])
+        content = StringIO('some content')
+        with self.mock_role_methods('_mutate', 'execute'), patch('fabric.api.put') as put:
+            self.role.execute.return_value = '1'
+
+            self.role.put_file(content, '/etc/app.conf', stdout=False)
+
+            put.assert_called_once_with(content, '/etc/app.conf', use_sudo=False)
+            self.assertFalse(self.role._mutate.called)
+
+    @istest
+    def remembers_new_uploads_for_the_blob_cache(self):
+        blobs = self.role.context['blobs'] = BlobCache('/var/cache/blobs')
+        blobs.blobs = set()
+        with patch('fabric.api.put') as put:
+            self.role.put_file(StringIO('some content'), '/etc/app.conf', sudo=True, stdout=False)
+
+            self.assertTrue(put.called)
+            self.assertEqual(blobs.pending, {hashlib.sha256('some content').hexdigest(): '/etc/app.conf'})
+
     @istest
     def execute_command_check_cd_called_if_cwd_arg(self):
         with patch('fabric.api.run'):
@@ -306,6 +533,57 @@ class RoleTest(ProvyTestCase):
                 self.role.execute("some command")
         self.assertFalse(cd.called)
 
+    @contextmanager
+    def remote_channel(self, chunks, return_code=0):
+        with patch('provy.core.roles.RemoteChannel') as RemoteChannel:
+            channel = RemoteChannel.return_value.open.return_value
+            channel.iter_chunks.return_value = iter(chunks)
+            channel.exit_status.return_value = return_code
+            channel.stderr = ''
+            yield RemoteChannel
+
+    @istest
+    def iterates_over_command_output_lines(self):
+        with self.remote_channel(['foo\nb', 'ar\n']) as RemoteChannel:
+            lines = self.role.execute_iter('dpkg -l', sudo=True)
+
+            self.assertEqual(list(lines), ['foo', 'bar'])
+            RemoteChannel.assert_called_once_with('dpkg -l', sudo=True, user=None)
+            RemoteChannel.return_value.open.return_value.close.assert_called_once_with()
+
+    @istest
+    def accounts_each_iteration_over_command_output(self):
+        stats = self.role.context['stats'] = CallStats()
+        with self.remote_channel(['foo\nb', 'ar\n']), fabric.api.settings(host_string='vagrant@33.33.33.33'):
+            list(self.role.execute_iter('ls /'))
+
+        self.assertIn('execute Role.execute_iter', stats.report())
+        totals = stats.totals[('vagrant@33.33.33.33', 'execute', ('Role', 'execute_iter'))]
+        self.assertEqual((totals.count, totals.sent, totals.received), (1, len('ls /'), len('foo\nbar\n')))
+
+    @istest
+    def iterates_over_command_output_lines_in_a_directory(self):
+        with self.remote_channel([]) as RemoteChannel:
+            list(self.role.execute_iter('ls', cwd='/some/dir', user='foo'))
+
+            RemoteChannel.assert_called_once_with('cd /some/dir && ls', sudo=False, user='foo')
+
+    @istest
+    def spools_command_output_when_memory_is_limited(self):
+        with self.remote_channel(['foo\n', 'bar\n']), patch('provy.core.roles.spooled') as spooled:
+            spooled.return_value = iter(['spooled\n'])
+
+            self.assertEqual(list(self.role.execute_iter('ls', max_memory=1024)), ['spooled'])
+            self.assertEqual(spooled.call_args[0][1], 1024)
+
+    @istest
+    def aborts_iteration_when_command_fails(self):
+        with self.remote_channel(['foo\n'], return_code=1), fabric.api.settings(fabric.api.hide('everything', 'aborts')):
+            lines = self.role.execute_iter('ls')
+
+            self.assertEqual(next(lines), 'foo')
+            self.assertRaises(SystemExit, next, lines)
+
     @istest
     def executes_a_local_command_with_stdout_and_same_user(self):
         with patch('fabric.api.local') as local:
@@ -396,14 +674,42 @@ class RoleTest(ProvyTestCase):
     @istest
     def changes_the_owner_of_a_path(self):
         with self.execute_mock() as execute:
-            self.role.change_path_owner('/some/path', 'foo')
+            execute.return_value = '3'
+
+            self.assertEqual(self.role.change_path_owner('/some/path', 'foo'), 3)
 
-            execute.assert_called_with('chown -R foo /some/path', stdout=False, sudo=True)
+            execute.assert_called_with(owner_command('/some/path', 'foo'), stdout=False, sudo=True)
+
+    @istest
+    def changes_only_the_entries_with_a_different_owner(self):
+        self.assertEqual(owner_command('/some/path', 'foo'),
+                         'changed=$(find /some/path ! -user foo -exec chown -h foo {} + -printf .) && echo ${#changed}')
+        self.assertEqual(owner_command('/some path', 'foo:bar'),
+                         "changed=$(find '/some path' \\( ! -user foo -o ! -group bar \\) -exec chown -h foo:bar {} + -printf .) && echo ${#changed}")
+
+    @istest
+    def counts_the_entries_whose_mode_is_changed(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ('a', 'b', 'c'):
+                open(os.path.join(directory, name), 'w').close()
+                os.chmod(os.path.join(directory, name), 0644)
+            os.chmod(directory, 0755)
+            os.chmod(os.path.join(directory, 'c'), 0755)
+            os.symlink('a', os.path.join(directory, 'link'))
+
+            with patch.object(self.role, 'execute', side_effect=self.run_locally):
+                self.assertEqual(self.role.change_path_mode(directory, 755, recursive=True), 2)
+                self.assertEqual(self.role.change_path_mode(directory, 755, recursive=True), 0)
+
+            self.assertEqual(oct(os.stat(os.path.join(directory, 'b')).st_mode & 0777), '0755')
+        finally:
+            shutil.rmtree(directory)
 
     @istest
     def creates_a_directory_when_it_doesnt_exist_yet(self):
-        with self.execute_mock() as execute, self.mock_role_method('remote_exists_dir') as remote_exists_dir:
-            remote_exists_dir.return_value = False
+        with self.execute_mock() as execute, self.mock_role_method('remote_stat') as remote_stat:
+            remote_stat.return_value = {'/some/dir': PathInfo('/some/dir')}
 
             self.role.ensure_dir('/some/dir')
 
@@ -411,8 +717,8 @@ class RoleTest(ProvyTestCase):
 
     @istest
     def creates_a_directory_with_sudo_when_it_doesnt_exist_yet(self):
-        with self.execute_mock() as execute, self.mock_role_method('remote_exists_dir') as remote_exists_dir:
-            remote_exists_dir.return_value = False
+        with self.execute_mock() as execute, self.mock_role_method('remote_stat') as remote_stat:
+            remote_stat.return_value = {'/some/dir': PathInfo('/some/dir')}
 
             self.role.ensure_dir('/some/dir', sudo=True)
 
@@ -420,28 +726,68 @@ class RoleTest(ProvyTestCase):
 
     @istest
     def creates_a_directory_with_specific_user_when_it_doesnt_exist_yet(self):
-        with self.execute_mock() as execute, self.mock_role_method('remote_exists_dir') as remote_exists_dir, self.mock_role_method('change_path_owner') as change_path_owner:
-            remote_exists_dir.return_value = False
+        with self.execute_mock() as execute, self.mock_role_method('remote_stat') as remote_stat, self.mock_role_method('change_path_owner') as change_path_owner:
+            remote_stat.return_value = {'/some/dir': PathInfo('/some/dir')}
 
             self.role.ensure_dir('/some/dir', owner='foo')
 
             execute.assert_called_with('mkdir -p /some/dir', stdout=False, sudo=True)
             change_path_owner.assert_called_with('/some/dir', 'foo')
 
+    @istest
+    def changes_the_owner_of_an_existing_directory_owned_by_someone_else(self):
+        with self.execute_mock() as execute, self.mock_role_method('remote_stat') as remote_stat:
+            remote_stat.return_value = {'/some/dir': PathInfo('/some/dir', type='directory', owner='root')}
+            execute.return_value = '1'
+
+            self.role.ensure_dir('/some/dir', owner='foo')
+
+            execute.assert_called_once_with(owner_command('/some/dir', 'foo'), stdout=False, sudo=True)
+
     @istest
     def gets_object_mode_from_remote_file(self):
-        with self.execute_mock() as execute, self.mock_role_method('remote_exists') as remote_exists:
-            remote_exists.return_value = True
-            execute.return_value = '755\n'
+        with self.execute_mock() as execute:
+            execute.return_value = '81ed|755|0|0|root|root|12|1380000000||\r\n'
 
             self.assertEqual(self.role.get_object_mode('/some/file.ext'), 755)
-            execute.assert_called_with('stat -c %a /some/file.ext', stdout=False, sudo=True)
+            execute.assert_called_once_with(stat_command(['/some/file.ext']), stdout=False, sudo=True)
+
+    @istest
+    def gets_information_about_many_paths_with_a_single_command(self):
+        with self.execute_mock() as execute:
+            execute.return_value = '\r\n'.join([
+                '81a0|640|0|33|root|www-data|12|1380000000|764efa883dda1e11db47671c4a3bbd9e|',
+                'a1ff|777|0|0|root|root|9|1380000001|764efa883dda1e11db47671c4a3bbd9e|/etc/app.conf',
+                'missing',
+            ])
+
+            infos = self.role.remote_stat(['/etc/app.conf', '/srv/app.conf', '/etc/missing.conf'], hashes=True)
+
+            execute.assert_called_once_with(stat_command(['/etc/app.conf', '/srv/app.conf', '/etc/missing.conf'], hashes=True), stdout=False, sudo=True)
+            self.assertEqual(infos, {
+                '/etc/app.conf': PathInfo('/etc/app.conf', type='file', mode=640, uid=0, gid=33, owner='root', group='www-data', size=12, mtime=1380000000,
+                                          md5='764efa883dda1e11db47671c4a3bbd9e'),
+                '/srv/app.conf': PathInfo('/srv/app.conf', type='link', mode=777, uid=0, gid=0, owner='root', group='root', size=9, mtime=1380000001,
+                                          target='/etc/app.conf', md5='764efa883dda1e11db47671c4a3bbd9e'),
+                '/etc/missing.conf': PathInfo('/etc/missing.conf'),
+            })
+            self.assertFalse(infos['/etc/missing.conf'].exists)
+
+    @istest
+    def tells_path_types_from_their_raw_mode_instead_of_their_localized_names(self):
+        self.assertEqual(stat_command(['/etc/app.conf']), (
+            "for p in /etc/app.conf; do if s=$(stat -c '%f|%a|%u|%g|%U|%G|%s|%Y' -- \"$p\" 2>/dev/null); then "
+            "printf '%s|%s|%s\\n' \"$s\" \"\" \"$(readlink -- \"$p\")\"; else echo missing; fi; done"))
+
+        infos = parse_stat('41ed|755|0|0|root|root|4096|1380000000||\n2190|620|0|5|root|tty|0|1380000000||', ['/etc', '/dev/tty1'])
+
+        self.assertEqual((infos['/etc'].type, infos['/etc'].mode), ('directory', 755))
+        self.assertEqual((infos['/dev/tty1'].type, infos['/dev/tty1'].mode), ('other', 620))
 
     @istest
     def cannot_get_mode_if_file_doesnt_exist(self):
-        with self.execute_mock(), self.mock_role_method('remote_exists') as remote_exists, self.mock_role_method('remote_exists_dir') as remote_exists_dir:
-            remote_exists.return_value = False
-            remote_exists_dir.return_value = False
+        with self.execute_mock() as execute:
+            execute.return_value = 'missing'
 
             self.assertRaises(IOError, self.role.get_object_mode, '/some/file.ext')
 
@@ -455,48 +801,51 @@ class RoleTest(ProvyTestCase):
             execute.assert_called_with('chmod 755 /some/path', stdout=False, sudo=True)
 
     @istest
-    def recursively_changes_the_mode_of_a_path_if_its_different(self):
+    def recursively_changes_the_mode_of_the_entries_that_are_different(self):
         with self.execute_mock() as execute, self.mock_role_method('get_object_mode') as get_object_mode:
-            get_object_mode.return_value = 644
+            execute.return_value = '2'
 
-            self.role.change_path_mode('/some/path', 755, recursive=True)
+            self.assertEqual(self.role.change_path_mode('/some/path', 755, recursive=True), 2)
 
-            execute.assert_called_with('chmod -R 755 /some/path', stdout=False, sudo=True)
+            execute.assert_called_with(mode_command('/some/path', 755), stdout=False, sudo=True)
+            self.assertEqual(mode_command('/some/path', 755),
+                             'changed=$(find /some/path ! -type l ! -perm 755 -exec chmod 755 {} + -printf .) && echo ${#changed}')
+            self.assertFalse(get_object_mode.called)
 
     @istest
     def doesnt_change_path_mode_if_its_the_same(self):
         with self.execute_mock() as execute, self.mock_role_method('get_object_mode') as get_object_mode:
             get_object_mode.return_value = 755
 
-            self.role.change_path_mode('/some/path', 755)
+            self.assertEqual(self.role.change_path_mode('/some/path', 755), 0)
 
             self.assertFalse(execute.called)
 
     @istest
-    def recursively_changes_the_mode_of_a_path_even_if_the_mode_of_the_parent_path_is_the_same(self):
-        with self.execute_mock() as execute, self.mock_role_method('get_object_mode') as get_object_mode:
-            get_object_mode.return_value = 755
-
-            self.role.change_path_mode('/some/path', 755, recursive=True)
+    def gets_the_md5_hash_of_a_local_file(self):
+        with self.mock_role_method('execute_local') as execute_local:
+            path = os.path.join(PROJECT_ROOT, 'tests', 'unit', 'fixtures', 'for_testing.txt')
+            with open(path, 'rb') as f:
+                expected = hashlib.md5(f.read()).hexdigest()
 
-            execute.assert_called_with('chmod -R 755 /some/path', stdout=False, sudo=True)
+            self.assertEqual(self.role.md5_local(path), expected)
+            self.assertFalse(execute_local.called)
 
     @istest
-    def gets_the_md5_hash_of_a_local_file(self):
-        with self.mock_role_method('execute_local') as execute_local, self.mock_role_method('local_exists') as local_exists:
-            local_exists.return_value = True
-            execute_local.return_value = 'some-hash\n'
+    def remembers_local_hashes_in_the_context(self):
+        with patch('provy.core.hashing.md5_file') as md5_file:
+            md5_file.return_value = 'some-hash'
+            path = os.path.join(PROJECT_ROOT, 'tests', 'unit', 'fixtures', 'for_testing.txt')
+
+            self.assertEqual(self.role.md5_local(path), 'some-hash')
+            self.assertEqual(self.role.md5_local(path), 'some-hash')
 
-            self.assertEqual(self.role.md5_local('/some/path'), 'some-hash')
-            execute_local.assert_called_with('md5sum /some/path | cut -d " " -f 1', stdout=False, sudo=True)
+            md5_file.assert_called_once_with(path)
+            self.assertEqual(self.role.context['local_hashes'].entries[path][3], 'some-hash')
 
     @istest
     def returns_none_if_local_file_doesnt_exist_for_md5_hash(self):
-        with self.mock_role_method('execute_local') as execute_local, self.mock_role_method('local_exists') as local_exists:
-            local_exists.return_value = False
-
-            self.assertIsNone(self.role.md5_local('/some/path'))
-            self.assertFalse(execute_local.called)
+        self.assertIsNone(self.role.md5_local('/some/path/that/doesnt/exist'))
 
     @istest
     def gets_the_md5_hash_of_a_remote_file(self):
@@ -617,98 +966,57 @@ class RoleTest(ProvyTestCase):
 
             put.assert_called_with('/from/file', '/to/file', use_sudo=True)
 
+    def symlink_infos(self, to_type=None, target=None):
+        return {
+            '/from/file': PathInfo('/from/file', type='file'),
+            '/to/file': PathInfo('/to/file', type=to_type, target=target),
+        }
+
     @istest
     def creates_a_remote_symbolic_link_if_it_doesnt_exist_yet(self):
-        with self.execute_mock() as execute, self.mock_role_method('remote_exists') as remote_exists:
-            from_file = '/from/file'
-            to_file = '/to/file'
-            remote_from_exists = True
-            remote_to_exists = False
+        with self.execute_mock() as execute, self.mock_role_method('remote_stat') as remote_stat:
             sudo = 'is it sudo?'
-            remote_exists.side_effect = (remote_from_exists, remote_to_exists)
+            remote_stat.return_value = self.symlink_infos()
 
-            self.role.remote_symlink(from_file, to_file, sudo=sudo)
+            self.role.remote_symlink('/from/file', '/to/file', sudo=sudo)
 
-            self.assertEqual(remote_exists.mock_calls, [
-                call(from_file),
-                call(to_file),
-            ])
-            execute.assert_called_with('ln -sf %s %s' % (from_file, to_file), sudo=sudo, stdout=False)
+            remote_stat.assert_called_once_with(['/from/file', '/to/file'])
+            execute.assert_called_once_with('ln -sf /from/file /to/file', sudo=sudo, stdout=False)
 
     @istest
     def creates_a_remote_symbolic_link_if_it_exists_but_with_different_path(self):
-        with self.execute_mock() as execute, self.mock_role_method('remote_exists') as remote_exists:
-            from_file = '/from/file'
-            to_file = '/to/file'
-            another_from_file = '/another/from/file'
-            remote_from_exists = True
-            remote_to_exists = True
+        with self.execute_mock() as execute, self.mock_role_method('remote_stat') as remote_stat:
             sudo = 'is it sudo?'
-            remote_exists.side_effect = (remote_from_exists, remote_to_exists)
-            execute.side_effect = ('-rw-rw-r-- 1 foo foo 4490 Dez 11 22:24 %s -> %s' % (to_file, another_from_file), None)
+            remote_stat.return_value = self.symlink_infos('link', '/another/from/file')
 
-            self.role.remote_symlink(from_file, to_file, sudo=sudo)
+            self.role.remote_symlink('/from/file', '/to/file', sudo=sudo)
 
-            self.assertEqual(remote_exists.mock_calls, [
-                call(from_file),
-                call(to_file),
-            ])
-            self.assertEqual(execute.mock_calls, [
-                call('ls -la %s' % to_file, stdout=False, sudo=sudo),
-                call('ln -sf %s %s' % (from_file, to_file), sudo=sudo, stdout=False),
-            ])
+            execute.assert_called_once_with('ln -sf /from/file /to/file', sudo=sudo, stdout=False)
 
     @istest
     def doesnt_create_symlink_if_file_with_same_name_already_exists(self):
-        with self.execute_mock() as execute, self.mock_role_method('remote_exists') as remote_exists:
-            from_file = '/from/file'
-            to_file = '/to/file'
-            remote_from_exists = True
-            remote_to_exists = True
-            sudo = 'is it sudo?'
-            remote_exists.side_effect = (remote_from_exists, remote_to_exists)
-            execute.side_effect = ('-rw-rw-r-- 1 foo foo 4490 Dez 11 22:24 %s' % to_file, None)
+        with self.execute_mock() as execute, self.mock_role_method('remote_stat') as remote_stat:
+            remote_stat.return_value = self.symlink_infos('file')
 
-            self.role.remote_symlink(from_file, to_file, sudo=sudo)
+            self.role.remote_symlink('/from/file', '/to/file')
 
-            self.assertEqual(remote_exists.mock_calls, [
-                call(from_file),
-                call(to_file),
-            ])
-            self.assertEqual(execute.mock_calls, [
-                call('ls -la %s' % to_file, stdout=False, sudo=sudo),
-            ])
+            self.assertFalse(execute.called)
 
     @istest
     def doesnt_create_symlink_if_symlink_with_same_name_already_exists(self):
-        with self.execute_mock() as execute, self.mock_role_method('remote_exists') as remote_exists:
-            from_file = '/from/file'
-            to_file = '/to/file'
-            remote_from_exists = True
-            remote_to_exists = True
-            sudo = 'is it sudo?'
-            remote_exists.side_effect = (remote_from_exists, remote_to_exists)
-            execute.side_effect = ('-rw-rw-r-- 1 foo foo 4490 Dez 11 22:24 %s -> %s' % (to_file, from_file), None)
+        with self.execute_mock() as execute, self.mock_role_method('remote_stat') as remote_stat:
+            remote_stat.return_value = self.symlink_infos('link', '/from/file')
 
-            self.role.remote_symlink(from_file, to_file, sudo=sudo)
+            self.role.remote_symlink('/from/file', '/to/file')
 
-            self.assertEqual(remote_exists.mock_calls, [
-                call(from_file),
-                call(to_file),
-            ])
-            self.assertEqual(execute.mock_calls, [
-                call('ls -la %s' % to_file, stdout=False, sudo=sudo),
-            ])
+            self.assertFalse(execute.called)
 
     @istest
     def raises_exception_if_remote_file_doesnt_exist(self):
-        with self.mock_role_method('remote_exists') as remote_exists:
-            from_file = '/from/file'
-            to_file = '/to/file'
-            remote_from_exists = False
-            remote_exists.side_effect = (remote_from_exists, )
+        with self.mock_role_method('remote_stat') as remote_stat:
+            remote_stat.return_value = {'/from/file': PathInfo('/from/file'), '/to/file': PathInfo('/to/file')}
 
-            self.assertRaises(RuntimeError, self.role.remote_symlink, from_file, to_file)
+            self.assertRaises(RuntimeError, self.role.remote_symlink, '/from/file', '/to/file')
 
     @istest
     def renders_a_template_based_on_absolute_path(self):
@@ -771,7 +1079,7 @@ class RoleTest(ProvyTestCase):
             self.role.remote_exists.return_value = False
 
             self.assertTrue(self.role.update_file('some template', to_file, options='some options', sudo=sudo, owner=owner))
-            self.role._force_update_file.assert_called_with(to_file, sudo, self.update_data.local_temp_path, owner)
+            self.role._force_update_file.assert_called_with(to_file, sudo, self.update_data.content, owner)
 
     @istest
     def updates_file_with_sudo_when_user_is_passed_but_sudo_not(self):
@@ -782,7 +1090,7 @@ class RoleTest(ProvyTestCase):
             self.role.remote_exists.return_value = False
 
             self.assertTrue(self.role.update_file('some template', to_file, options='some options', owner=owner))
-            self.role.put_file.assert_called_with(self.update_data.local_temp_path, to_file, True)
+            self.role.put_file.assert_called_with(self.update_data.content, to_file, True)
 
     @istest
     def doesnt_use_sudo_implicitly_if_owner_not_passed(self):
@@ -792,7 +1100,7 @@ class RoleTest(ProvyTestCase):
             self.role.remote_exists.return_value = False
 
             self.assertTrue(self.role.update_file('some template', to_file, options='some options'))
-            self.role.put_file.assert_called_with(self.update_data.local_temp_path, to_file, False)
+            self.role.put_file.assert_called_with(self.update_data.content, to_file, False)
 
     @istest
     def updates_file_when_remote_exists_but_is_different(self):
@@ -806,23 +1114,7 @@ class RoleTest(ProvyTestCase):
             self.update_data.to_md5 = 'some remote md5'
 
             self.assertTrue(self.role.update_file('some template', to_file, options='some options', sudo=sudo, owner=owner))
-            self.role._force_update_file.assert_called_with(to_file, sudo, self.update_data.local_temp_path, owner)
-
-    @istest
-    def cleans_temp_file_after_updating(self):
-        to_file = '/etc/foo.conf'
-        sudo = 'is it sudo?'
-        owner = 'foo'
-
-        with open(self.update_data.local_temp_path, 'w') as f:
-            f.write('foo')
-
-        with self.mock_update_data(), self.mock_role_methods('_force_update_file', 'remote_exists'):
-            self.role.remote_exists.return_value = True
-
-            self.role.update_file('some template', to_file, options='some options', sudo=sudo, owner=owner)
-
-            self.assertFalse(os.path.exists(self.update_data.local_temp_path))
+            self.role._force_update_file.assert_called_with(to_file, sudo, self.update_data.content, owner)
 
     @istest
     def doesnt_update_file_when_content_is_the_same(self):
@@ -841,50 +1133,186 @@ class RoleTest(ProvyTestCase):
             self.assertFalse(self.role._force_update_file.called)
 
     @istest
-    def builds_update_data(self):
+    def builds_update_data_in_memory(self):
         from_file = os.path.join(PROJECT_ROOT, 'tests', 'unit', 'fixtures', 'some_template.txt')
         to_file = '/etc/foo.conf'
-        options = {'foo': 'FOO!'}
-        local_temp_path = '/tmp/template-to-update'
-        md5_local = 'some local md5'
+        options = {'foo': u'FO\xd5!'}
         md5_remote = 'some remote md5'
 
         with self.mock_role_methods('write_to_temp_file', 'md5_local', 'md5_remote'):
-            self.role.write_to_temp_file.return_value = local_temp_path
-            self.role.md5_local.return_value = md5_local
             self.role.md5_remote.return_value = md5_remote
 
             update_data = self.role._build_update_data(from_file, options, to_file)
 
-            self.assertEqual(update_data.local_temp_path, local_temp_path)
-            self.assertEqual(update_data.from_md5, md5_local)
+            self.assertEqual(update_data.content.read(), 'foo=FO\xc3\x95!')
+            self.assertEqual(update_data.from_md5, hashlib.md5('foo=FO\xc3\x95!').hexdigest())
             self.assertEqual(update_data.to_md5, md5_remote)
+            self.assertFalse(self.role.write_to_temp_file.called)
+            self.assertFalse(self.role.md5_local.called)
 
     @istest
     def really_updates_file_without_owner(self):
         to_file = '/etc/foo.conf'
-        local_temp_path = '/tmp/template-to-update'
+        content = StringIO('some content')
         sudo = 'is it sudo?'
         owner = None
 
         with self.mock_role_method('put_file'):
-            self.role._force_update_file(to_file, sudo, local_temp_path, owner)
+            self.role._force_update_file(to_file, sudo, content, owner)
 
-            self.role.put_file.assert_called_with(local_temp_path, to_file, sudo)
+            self.role.put_file.assert_called_with(content, to_file, sudo)
 
     @istest
     def really_updates_file_with_owner(self):
         to_file = '/etc/foo.conf'
-        local_temp_path = '/tmp/template-to-update'
+        content = StringIO('some content')
         sudo = 'is it sudo?'
         owner = 'foo'
 
         with self.mock_role_methods('put_file', 'change_path_owner'):
-            self.role._force_update_file(to_file, sudo, local_temp_path, owner)
+            self.role._force_update_file(to_file, sudo, content, owner)
 
-            self.role.put_file.assert_called_with(local_temp_path, to_file, sudo)
+            self.role.put_file.assert_called_with(content, to_file, sudo)
             self.role.change_path_owner.assert_called_with(to_file, owner)
 
+    @istest
+    def hashes_many_remote_files_with_a_single_command(self):
+        with self.execute_mock() as execute:
+            execute.return_value = 'd41d8cd98f00b204e9800998ecf8427e  /etc/foo.conf\r\nb1946ac92492d2347c6235b4d2611184  /etc/my app.conf'
+
+            hashes = self.role.md5_remote_files(['/etc/foo.conf', '/etc/my app.conf', '/etc/missing.conf'])
+
+            self.assertEqual(hashes, {
+                '/etc/foo.conf': 'd41d8cd98f00b204e9800998ecf8427e',
+                '/etc/my app.conf': 'b1946ac92492d2347c6235b4d2611184',
+                '/etc/missing.conf': None,
+            })
+            execute.assert_called_once_with("md5sum /etc/foo.conf '/etc/my app.conf' /etc/missing.conf 2>/dev/null; true", stdout=False, sudo=True)
+
+    @istest
+    def updates_many_files_with_a_single_archive(self):
+        template_file = os.path.join(PROJECT_ROOT, 'tests', 'unit', 'fixtures', 'some_template.txt')
+        archives = []
+        self.role.context['host'] = 'some-host'
+
+        with self.mock_role_methods('md5_remote_files', 'put_file', '_mutate'):
+            self.role.md5_remote_files.return_value = {
+                '/etc/same.conf': hashlib.md5('foo=same').hexdigest(),
+                '/etc/changed.conf': 'some old hash',
+                '/etc/new.conf': None,
+            }
+            self.role.context['scratch_dir'] = '/tmp'
+            self.role.put_file.side_effect = lambda archive, to_file, stdout: archives.append(tarfile.open(fileobj=StringIO(archive.read())))
+
+            updated = self.role.update_files([
+                (template_file, '/etc/same.conf', {'foo': 'same'}, 'foo'),
+                (template_file, '/etc/changed.conf', {'foo': 'changed'}, 'foo', 755),
+                (template_file, '/etc/new.conf'),
+            ])
+
+            self.assertEqual(updated, ['/etc/changed.conf', '/etc/new.conf'])
+            self.role.md5_remote_files.assert_called_once_with(['/etc/same.conf', '/etc/changed.conf', '/etc/new.conf'])
+            archive_path = self.role.put_file.call_args[0][1]
+            self.assertTrue(archive_path.startswith('/tmp/provy-') and archive_path.endswith('.tar'))
+            self.assertEqual([(member.name, member.mode) for member in archives[0].getmembers()], [('etc/changed.conf', 0o755), ('etc/new.conf', 0o644)])
+            self.assertEqual(archives[0].extractfile('etc/changed.conf').read(), 'foo=changed')
+            self.role._mutate.assert_called_once_with(
+                'tar -xpf %s -C / --no-same-owner && chown foo /etc/changed.conf' % archive_path, ['/etc/changed.conf', '/etc/new.conf'], sudo=True)
+
+    @istest
+    def extracts_the_modes_of_the_files_regardless_of_the_umask(self):
+        template_file = os.path.join(PROJECT_ROOT, 'tests', 'unit', 'fixtures', 'some_template.txt')
+        self.role.context['scratch_dir'] = '/tmp'
+
+        with self.mock_role_methods('md5_remote_files', 'put_file', '_mutate'):
+            self.role.md5_remote_files.return_value = {'/home/foo/run.sh': None}
+
+            self.role.update_files([(template_file, '/home/foo/run.sh', {'foo': 'bar'}, None, 755)])
+
+            archive_path = self.role.put_file.call_args[0][1]
+            self.role._mutate.assert_called_once_with('tar -xpf %s -C / --no-same-owner' % archive_path, ['/home/foo/run.sh'], sudo=False)
+
+    @istest
+    def doesnt_send_anything_when_no_file_changed(self):
+        template_file = os.path.join(PROJECT_ROOT, 'tests', 'unit', 'fixtures', 'some_template.txt')
+
+        with self.mock_role_methods('md5_remote_files', 'put_file', '_mutate'):
+            self.role.md5_remote_files.return_value = {'/etc/same.conf': hashlib.md5('foo=same').hexdigest()}
+
+            self.assertEqual(self.role.update_files([(template_file, '/etc/same.conf', {'foo': 'same'})]), [])
+            self.assertFalse(self.role.put_file.called)
+            self.assertFalse(self.role._mutate.called)
+
+    @istest
+    def gets_the_manifest_of_a_remote_directory_with_a_single_command(self):
+        with self.execute_mock() as execute:
+            execute.return_value = 'app.conf\t13\t644\nprovy-manifest-hashes\neb9c2bf0eb63f3a7bc0ea37ef18aeba5  ./app.conf'
+
+            self.assertEqual(self.role.remote_manifest('/srv/app'), {'app.conf': (13, 644, 'eb9c2bf0eb63f3a7bc0ea37ef18aeba5')})
+
+            execute.assert_called_once_with(manifest_command('/srv/app'), stdout=False, sudo=True)
+
+    @contextmanager
+    def local_dir(self, files):
+        directory = tempfile.mkdtemp()
+        try:
+            for path, (content, mode) in files.items():
+                full_path = os.path.join(directory, path)
+                with open(full_path, 'w') as f:
+                    f.write(content)
+                os.chmod(full_path, mode)
+            yield directory
+        finally:
+            shutil.rmtree(directory)
+
+    @istest
+    def syncs_only_the_files_that_differ(self):
+        files = {'same.conf': ('same', 0o644), 'changed.conf': ('changed', 0o644), 'run.sh': ('run', 0o755)}
+        archives = []
+
+        with self.local_dir(files) as local_dir, self.mock_role_methods('remote_manifest', 'put_file', '_mutate'):
+            self.role.remote_manifest.return_value = {
+                'same.conf': (4, 644, hashlib.md5('same').hexdigest()),
+                'changed.conf': (7, 644, 'some old hash'),
+                'run.sh': (3, 644, hashlib.md5('run').hexdigest()),
+                'old.conf': (3, 644, 'some hash'),
+            }
+            self.role.context['scratch_dir'] = '/tmp'
+            self.role.put_file.side_effect = lambda archive, to_file, stdout: archives.append(tarfile.open(fileobj=StringIO(archive.read())))
+
+            changed = self.role.sync_dir(local_dir, '/srv/app', delete=True, owner='www-data')
+
+            self.assertEqual(changed, ['changed.conf', 'old.conf', 'run.sh'])
+            self.assertEqual([(member.name, member.mode) for member in archives[0].getmembers()], [('changed.conf', 0o644)])
+            archive_path = self.role.put_file.call_args[0][1]
+            self.role._mutate.assert_called_once_with(
+                'mkdir -p /srv/app && tar -xpf %s -C /srv/app --no-same-owner && chmod 755 /srv/app/run.sh && rm -f /srv/app/old.conf && %s' % (archive_path, owner_command('/srv/app', 'www-data')),
+                ['/srv/app/changed.conf'], sudo=True)
+
+    @istest
+    def changes_modes_without_sending_anything(self):
+        with self.local_dir({'run.sh': ('run', 0o755), 'extra': ('extra', 0o644)}) as local_dir, self.mock_role_methods('remote_manifest', 'put_file', '_mutate'):
+            self.role.remote_manifest.return_value = {
+                'run.sh': (3, 644, hashlib.md5('run').hexdigest()),
+                'extra': (5, 644, hashlib.md5('extra').hexdigest()),
+                'old.conf': (3, 644, 'some hash'),
+            }
+
+            self.assertEqual(self.role.sync_dir(local_dir, '/srv/app'), ['run.sh'])
+
+            self.assertFalse(self.role.put_file.called)
+            self.role._mutate.assert_called_once_with('chmod 755 /srv/app/run.sh', ['/srv/app'], sudo=False)
+
+    @istest
+    def doesnt_sync_anything_when_the_directories_match(self):
+        with self.local_dir({'app.conf': ('same', 0o644)}) as local_dir, self.mock_role_methods('remote_manifest', 'put_file', '_mutate'):
+            self.role.remote_manifest.return_value = {'app.conf': (4, 644, hashlib.md5('same').hexdigest())}
+
+            self.assertEqual(self.role.sync_dir(local_dir, '/srv/app'), [])
+
+            self.assertFalse(self.role.put_file.called)
+            self.assertFalse(self.role._mutate.called)
+
     @istest
     def checks_that_content_differs_when_md5_is_different(self):
         self.assertTrue(self.role._contents_differ('some local md5', 'some remote md5'))
@@ -904,16 +1332,42 @@ class RoleTest(ProvyTestCase):
         self.assertFalse(self.role._contents_differ(None, None))
 
     @istest
-    def reads_a_remote_file(self):
-        path = '/some/path'
-        sudo = 'is it sudo?'
-        content = 'some content'
-        with self.mock_role_method('execute_python') as execute_python:
-            execute_python.return_value = content
+    def reads_a_remote_file_exactly_as_it_is(self):
+        with self.remote_channel(['some \xff', 'content\n']) as RemoteChannel:
+            self.assertEqual(self.role.read_remote_file('/some/path'), 'some \xffcontent\n')
 
-            self.assertEqual(self.role.read_remote_file(path, sudo), content)
+            RemoteChannel.assert_called_once_with('cat /some/path', sudo=True)
 
-            execute_python.assert_called_with("import codecs; print codecs.open('%s', 'r', 'utf-8').read()" % path, stdout=False, sudo=sudo)
+    @istest
+    def downloads_a_remote_file_in_chunks(self):
+        directory = tempfile.mkdtemp()
+        try:
+            local_path = os.path.join(directory, 'db.dump')
+            with self.remote_channel(['\x00\x01', '\x02']):
+                self.assertEqual(self.role.get_file('/var/backups/db.dump', local_path, sudo=True), 3)
+
+            with open(local_path, 'rb') as f:
+                self.assertEqual(f.read(), '\x00\x01\x02')
+        finally:
+            shutil.rmtree(directory)
+
+    @istest
+    def downloads_a_range_of_bytes_of_a_remote_file(self):
+        with self.remote_channel([]) as RemoteChannel:
+            self.role.get_file('/var/log/my app.log', StringIO(), offset=100, length=50)
+            self.role.get_file('/var/log/app.log', StringIO(), offset=100)
+            self.role.get_file('/var/log/app.log', StringIO(), length=50)
+
+            self.assertEqual([mock_call[1][0] for mock_call in RemoteChannel.mock_calls if mock_call[0] == ''], [
+                "test -e '/var/log/my app.log' && { tail -c +101 '/var/log/my app.log' | head -c 50; }",
+                'test -e /var/log/app.log && { tail -c +101 /var/log/app.log; }',
+                'test -e /var/log/app.log && { cat /var/log/app.log | head -c 50; }',
+            ])
+
+    @istest
+    def aborts_the_download_when_the_file_cant_be_read(self):
+        with self.remote_channel([], return_code=1), fabric.api.settings(fabric.api.hide('everything', 'aborts')):
+            self.assertRaises(SystemExit, self.role.get_file, '/missing', StringIO())
 
     @istest
     def checks_that_a_process_is_running(self):
@@ -1017,29 +1471,39 @@ class RoleTest(ProvyTestCase):
         self.assertIs(self.role.roles_in_context, dir)
 
     @istest
-    def removes_paths_if_in_paths_to_remove(self):
+    def creates_the_scratch_dir_once_per_server(self):
+        with self.execute_mock() as execute, self.mock_role_method('remote_temp_dir') as remote_temp_dir, patch('uuid.uuid4') as uuid4:
+            remote_temp_dir.return_value = '/tmp'
+            uuid4.return_value.hex = 'abc'
 
-        self.role._paths_to_remove.add("foo")
-        with self.mock_role_method("remove_dir") as remove:
-            self.role.cleanup()
-        remove.assert_called_once_with("foo", True, True)
+            self.assertEqual(self.role.remote_scratch_dir(), '/tmp/provy-abc')
+            self.assertEqual(Role(None, self.role.context).remote_scratch_dir(), '/tmp/provy-abc')
+
+            execute.assert_called_once_with('mkdir -m 1777 /tmp/provy-abc', stdout=False, sudo=False)
 
     @istest
-    def assert_paths_to_remove_empty_on_creation(self):
-        self.assertEqual(len(self.role._paths_to_remove), 0)
+    def removes_the_scratch_dir_with_a_single_command(self):
+        self.role.context['scratch_dir'] = '/tmp/provy-abc'
+        with self.execute_mock() as execute:
+            self.role.remove_remote_scratch_dir()
+            self.role.remove_remote_scratch_dir()
+
+        execute.assert_called_once_with('rm -rf /tmp/provy-abc', stdout=False, sudo=True)
+        self.assertNotIn('scratch_dir', self.role.context)
 
     @istest
-    def assert_no_exception_on_error_while_deleting(self):
-        self.role._paths_to_remove.add("foo")
-        with patch("provy.core.roles.Role.remove_dir", Mock(side_effect=IOError)):
-            self.role.cleanup()
+    def doesnt_remove_a_scratch_dir_that_wasnt_created(self):
+        with self.execute_mock() as execute:
+            self.role.remove_remote_scratch_dir()
+
+        self.assertFalse(execute.called)
 
     @istest
     def assert_error_logged_on_deleting(self):
-        self.role._paths_to_remove.add("foo")
-        with patch("provy.core.roles.Role.remove_dir", Mock(side_effect=IOError)):
+        self.role.context['scratch_dir'] = '/tmp/provy-abc'
+        with patch("provy.core.roles.Role.execute", Mock(side_effect=IOError)):
             with self.mock_role_method("log") as log:
-                self.role.cleanup()
+                self.role.remove_remote_scratch_dir()
         self.assertEqual(len(log.mock_calls), 1)
 
     @istest
@@ -1087,6 +1551,450 @@ class RoleTest(ProvyTestCase):
         self.assertIs(values['put_file'].mock_calls[0][1][0], script)
 
 
+class RoleWithAgentTest(ProvyTestCase):
+    def setUp(self):
+        super(RoleWithAgentTest, self).setUp()
+        self.agent = MagicMock()
+        self.role = Role(prov=None, context={'agent': self.agent})
+
+    @istest
+    def checks_remote_paths_with_the_agent(self):
+        with self.execute_mock() as execute:
+            self.agent.call.side_effect = [True, False]
+
+            self.assertTrue(self.role.remote_exists('/some/file'))
+            self.assertFalse(self.role.remote_exists_dir('/some/file'))
+
+            self.assertEqual(self.agent.call.mock_calls, [
+                call('exists', path='/some/file'),
+                call('exists_dir', path='/some/file'),
+            ])
+            self.assertFalse(execute.called)
+
+    @istest
+    def gets_hash_and_mode_with_the_agent(self):
+        with self.execute_mock() as execute:
+            self.agent.call.side_effect = ['some-hash', [['81a4', '644', 0, 0, 'root', 'root', 12, 1380000000, '', '']]]
+
+            self.assertEqual(self.role.md5_remote('/some/file'), 'some-hash')
+            self.assertEqual(self.role.get_object_mode('/some/file'), 644)
+
+            self.assertEqual(self.agent.call.mock_calls, [
+                call('md5', path='/some/file'),
+                call('stat', paths=['/some/file'], hashes=False),
+            ])
+            self.assertFalse(execute.called)
+
+    @istest
+    def accounts_each_call_to_the_agent(self):
+        class AppRole(Role):
+            def provision(self):
+                self.remote_exists('/some/file')
+                self.md5_remote('/some/file')
+
+        stats = CallStats()
+        self.agent.call.side_effect = [True, 'some-hash']
+        with fabric.api.settings(host_string='vagrant@33.33.33.33'):
+            AppRole(prov=None, context={'agent': self.agent, 'stats': stats}).provision()
+
+        report = stats.report()
+        self.assertIn('2 calls in all servers', report)
+        self.assertIn('agent   AppRole.provision', report)
+
+    @istest
+    def hashes_many_files_with_the_agent(self):
+        with self.execute_mock() as execute:
+            self.agent.call.return_value = {'/some/file': 'some-hash', '/other/file': None}
+
+            self.assertEqual(self.role.md5_remote_files(['/some/file', '/other/file']), {'/some/file': 'some-hash', '/other/file': None})
+
+            self.agent.call.assert_called_once_with('md5_files', paths=['/some/file', '/other/file'])
+            self.assertFalse(execute.called)
+
+    @istest
+    def gets_the_manifest_of_a_remote_directory_with_the_agent(self):
+        with self.execute_mock() as execute:
+            self.agent.call.return_value = {'app.conf': [13, 644, 'some-hash']}
+
+            self.assertEqual(self.role.remote_manifest('/srv/app'), {'app.conf': (13, 644, 'some-hash')})
+
+            self.agent.call.assert_called_once_with('manifest', directory='/srv/app')
+            self.assertFalse(execute.called)
+
+    @contextmanager
+    def large_local_file(self, content):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(content)
+            f.flush()
+            yield f.name
+
+    def signatures(self, content, block_size=2048):
+        blocks = [content[start:start + block_size] for start in range(0, len(content), block_size)]
+        return [[weak_checksum(block), hashlib.md5(block).hexdigest()] for block in blocks]
+
+    @istest
+    def sends_only_the_changes_of_large_files(self):
+        self.role.context['delta_threshold'] = 10
+        with self.large_local_file('some large content') as local_path, patch('fabric.api.put') as put:
+            self.agent.call.side_effect = [self.signatures('some large content'), '/tmp', None]
+
+            self.role.put_file(local_path, '/etc/large.conf', sudo=True, stdout=False)
+
+            remote_delta = put.call_args[0][1]
+            self.assertTrue(remote_delta.startswith('/tmp/provy-delta-'))
+            self.assertEqual(self.agent.call.mock_calls, [
+                call('signatures', path='/etc/large.conf', block_size=2048),
+                call('temp_dir'),
+                call('patch', path='/etc/large.conf', delta_path=remote_delta, block_size=2048, md5=hashlib.md5('some large content').hexdigest()),
+            ])
+            self.assertEqual(put.call_count, 1)
+
+    @istest
+    def sends_only_the_changes_of_rendered_templates(self):
+        self.role.context.update({'delta_threshold': 10, 'host': 'localhost'})
+        template_file = os.path.join(PROJECT_ROOT, 'tests', 'unit', 'fixtures', 'some_template.txt')
+        old_content = 'foo=' + 'x' * 4096 + 'old'
+        answers = {
+            'md5': hashlib.md5(old_content).hexdigest(),
+            'exists': True,
+            'signatures': self.signatures(old_content),
+            'temp_dir': '/tmp',
+            'patch': None,
+        }
+        with patch('fabric.api.put') as put:
+            self.agent.call.side_effect = lambda operation, **kwargs: answers[operation]
+
+            self.assertTrue(self.role.update_file(template_file, '/etc/large.conf', options={'foo': 'x' * 4096 + 'new'}, sudo=True))
+
+            remote_delta = put.call_args[0][1]
+            self.assertTrue(remote_delta.startswith('/tmp/provy-delta-'))
+            self.assertEqual(put.call_count, 1)
+            self.assertEqual(self.agent.call.mock_calls[-1], call(
+                'patch', path='/etc/large.conf', delta_path=remote_delta, block_size=2048,
+                md5=hashlib.md5('foo=' + 'x' * 4096 + 'new').hexdigest()))
+
+    @istest
+    def sends_only_the_changes_of_large_files_the_logged_user_can_write(self):
+        self.role.context['delta_threshold'] = 10
+        with self.large_local_file('some large content') as local_path, patch('fabric.api.put') as put, self.execute_mock() as execute:
+            execute.return_value = '0'
+            self.agent.call.side_effect = [self.signatures('some large content'), '/tmp', None]
+
+            self.role.put_file(local_path, '/srv/large.conf', stdout=False)
+
+            execute.assert_called_once_with('test -w /srv/large.conf; echo $?', stdout=False)
+            self.assertEqual(self.agent.call.mock_calls[-1][1], ('patch',))
+            self.assertEqual(put.call_count, 1)
+
+    @istest
+    def sends_whole_files_the_logged_user_cant_write(self):
+        self.role.context['delta_threshold'] = 10
+        with self.large_local_file('some large content') as local_path, patch('fabric.api.put') as put, self.execute_mock() as execute:
+            execute.return_value = '1'
+
+            self.role.put_file(local_path, '/etc/large.conf', stdout=False)
+
+            put.assert_called_once_with(local_path, '/etc/large.conf', use_sudo=False)
+            self.assertFalse(self.agent.call.called)
+
+    @istest
+    def sends_the_whole_file_if_too_much_of_it_changed(self):
+        self.role.context['delta_threshold'] = 10
+        with self.large_local_file('some large content') as local_path, patch('fabric.api.put') as put:
+            self.agent.call.side_effect = [self.signatures('completely different content')]
+
+            self.role.put_file(local_path, '/etc/large.conf', sudo=True, stdout=False)
+
+            put.assert_called_once_with(local_path, '/etc/large.conf', use_sudo=True)
+            self.assertEqual(self.agent.call.call_count, 1)
+
+    @istest
+    def sends_whole_files_below_the_delta_threshold(self):
+        with self.large_local_file('some content') as local_path, patch('fabric.api.put') as put:
+            self.role.put_file(local_path, '/etc/small.conf', sudo=True, stdout=False)
+
+            put.assert_called_once_with(local_path, '/etc/small.conf', use_sudo=True)
+            self.assertFalse(self.agent.call.called)
+
+    @istest
+    def sends_whole_files_that_dont_exist_in_the_server_yet(self):
+        self.role.context['delta_threshold'] = 10
+        with self.large_local_file('some large content') as local_path, patch('fabric.api.put') as put:
+            self.agent.call.return_value = None
+
+            self.role.put_file(local_path, '/etc/large.conf', sudo=True, stdout=False)
+
+            put.assert_called_once_with(local_path, '/etc/large.conf', use_sudo=True)
+
+    @istest
+    def sends_the_whole_file_if_the_patch_fails(self):
+        self.role.context['delta_threshold'] = 10
+        with self.large_local_file('some large content') as local_path, patch('fabric.api.put') as put:
+            self.agent.call.side_effect = [self.signatures('some large content'), '/tmp', IOError('The patched file does not match')]
+
+            self.role.put_file(local_path, '/etc/large.conf', sudo=True, stdout=False)
+
+            self.assertEqual(put.call_count, 2)
+            put.assert_called_with(local_path, '/etc/large.conf', use_sudo=True)
+
+    @istest
+    def gets_temp_dir_and_directory_listing_with_the_agent(self):
+        with self.mock_role_method('execute_python') as execute_python:
+            self.agent.call.side_effect = ['/tmp', ['foo', 'bar']]
+
+            self.assertEqual(self.role.remote_temp_dir(), '/tmp')
+            self.assertEqual(self.role.remote_list_directory('/some/dir'), ['foo', 'bar'])
+
+            self.assertEqual(self.agent.call.mock_calls, [
+                call('temp_dir'),
+                call('list_directory', path='/some/dir'),
+            ])
+            self.assertFalse(execute_python.called)
+
+
+class RoleWithHostFactsTest(ProvyTestCase):
+    def setUp(self):
+        super(RoleWithHostFactsTest, self).setUp()
+        self.role = Role(prov=None, context={'facts': HostFacts()})
+
+    @istest
+    def gathers_all_facts_in_a_single_command(self):
+        with self.execute_mock() as execute:
+            execute.return_value = FACTS_OUTPUT
+
+            self.assertEqual(self.role.get_distro_info().distributor_id, 'Ubuntu')
+            self.assertEqual(self.role.get_logged_user(), 'vagrant')
+            self.assertEqual(self.role.get_hostname(), 'precise64')
+            self.assertEqual(self.role.remote_temp_dir(), '/tmp')
+
+            execute.assert_called_once_with(facts_command(), stdout=False)
+
+    @istest
+    def shares_facts_between_roles_in_the_same_server(self):
+        other_role = Role(prov=None, context=self.role.context)
+        with self.execute_mock() as execute:
+            execute.return_value = FACTS_OUTPUT
+
+            self.role.gather_facts()
+            facts = other_role.gather_facts()
+
+            self.assertEqual(facts.cpus, 2)
+            self.assertEqual(execute.call_count, 1)
+
+    @istest
+    def gathering_facts_doesnt_forget_remembered_queries(self):
+        self.role.context['query_cache'] = QueryCache()
+        with patch('fabric.api.run') as run, patch('fabric.api.sudo') as sudo:
+            run.return_value = FACTS_OUTPUT
+            sudo.return_value = '0'
+
+            self.role.remote_exists('/srv/app.conf')
+            self.role.gather_facts()
+            self.role.remote_exists('/srv/app.conf')
+
+            self.assertEqual(sudo.call_count, 1)
+
+    @istest
+    def gets_the_hostname_without_facts(self):
+        role = Role(prov=None, context={})
+        with patch.object(Role, 'execute_python') as execute_python:
+            execute_python.return_value = 'precise64'
+
+            self.assertEqual(role.get_hostname(), 'precise64')
+            execute_python.assert_called_once_with('import os; print os.uname()[1]', stdout=False)
+
+
+class RoleWithQueryCacheTest(ProvyTestCase):
+    def setUp(self):
+        super(RoleWithQueryCacheTest, self).setUp()
+        self.role = Role(prov=None, context={'query_cache': QueryCache()})
+
+    @istest
+    def remembers_read_only_queries(self):
+        with self.execute_mock() as execute:
+            execute.return_value = '0'
+
+            self.assertTrue(self.role.remote_exists('/srv/app.conf'))
+            self.assertTrue(self.role.remote_exists('/srv/app.conf'))
+            self.role.remote_exists_dir('/srv/app.conf')
+
+            self.assertEqual(execute.call_count, 2)
+
+    @istest
+    def keys_queries_by_all_their_arguments(self):
+        with self.mock_role_method('get_file') as get_file:
+            self.role.read_remote_file('/srv/app.conf')
+            self.role.read_remote_file('/srv/app.conf', sudo=False)
+
+            self.assertEqual(get_file.call_count, 2)
+
+    @istest
+    def forgets_queries_over_changed_paths(self):
+        with self.execute_mock() as execute:
+            execute.return_value = '0'
+
+            self.role.remote_exists('/srv/app/app.conf')
+            self.role.remote_exists('/etc/app.conf')
+            self.role.change_path_owner('/srv/app', 'app')
+            self.role.remote_exists('/srv/app/app.conf')
+            self.role.remote_exists('/etc/app.conf')
+
+            self.assertEqual(execute.mock_calls, [
+                call('test -f /srv/app/app.conf; echo $?', stdout=False, sudo=True),
+                call('test -f /etc/app.conf; echo $?', stdout=False, sudo=True),
+                call(owner_command('/srv/app', 'app'), stdout=False, sudo=True),
+                call('test -f /srv/app/app.conf; echo $?', stdout=False, sudo=True),
+            ])
+
+    @istest
+    def forgets_queries_over_uploaded_files(self):
+        with self.execute_mock() as execute, patch('fabric.api.put'):
+            execute.return_value = '1'
+
+            self.role.remote_exists('/srv/app.conf')
+            self.role.put_file('/local/app.conf', '/srv/app.conf', stdout=False)
+            self.role.remote_exists('/srv/app.conf')
+
+            self.assertEqual(execute.call_count, 2)
+
+    @istest
+    def forgets_path_queries_after_any_other_command(self):
+        with patch('fabric.api.run') as run, patch('fabric.api.sudo') as sudo:
+            sudo.return_value = '0'
+            run.return_value = 'vagrant'
+
+            self.role.remote_exists('/srv/app.conf')
+            self.role.get_logged_user()
+            self.role.execute('touch /srv/app.conf', stdout=False)
+            self.role.remote_exists('/srv/app.conf')
+            self.role.get_logged_user()
+
+            self.assertEqual(sudo.call_count, 2)
+            self.assertEqual(run.call_count, 2)
+
+
+class RoleWithMutationQueueTest(ProvyTestCase):
+    def setUp(self):
+        super(RoleWithMutationQueueTest, self).setUp()
+        self.queue = MutationQueue(automatic=True)
+        self.role = Role(prov=None, context={'mutations': self.queue})
+
+    @contextmanager
+    def fabric_mocks(self):
+        with patch('fabric.api.run') as run, patch('fabric.api.sudo') as sudo:
+            run.return_value = sudo.return_value = ''
+            yield run, sudo
+
+    @istest
+    def queues_changes_made_by_the_base_helpers(self):
+        with self.fabric_mocks() as (run, sudo), self.mock_role_method('remote_stat') as remote_stat:
+            remote_stat.return_value = {'/srv/app': PathInfo('/srv/app')}
+
+            self.role.ensure_dir('/srv/app', owner='app')
+
+            self.assertFalse(run.called)
+            self.assertFalse(sudo.called)
+            self.assertEqual([mutation.command for mutation in self.queue.pending], ['mkdir -p /srv/app', owner_command('/srv/app', 'app')])
+
+    @istest
+    def flushes_queued_changes_before_a_query_that_depends_on_them(self):
+        with self.fabric_mocks() as (run, sudo):
+            self.role.change_path_owner('/srv/app', 'app')
+
+            self.role.remote_exists('/etc/app.conf')
+            self.assertEqual(sudo.call_count, 1)
+            self.assertEqual(len(self.queue.pending), 1)
+
+            self.role.remote_exists('/srv/app/app.conf')
+            self.assertEqual(sudo.call_count, 3)
+            self.assertIn(owner_command('/srv/app', 'app'), sudo.call_args_list[1][0][0])
+            self.assertEqual(self.queue.pending, [])
+
+    @istest
+    def flushes_queued_changes_before_any_other_command(self):
+        with self.fabric_mocks() as (run, sudo):
+            self.role.change_path_owner('/srv/app', 'app')
+
+            self.role.execute('service app restart', sudo=True)
+
+            self.assertIn(owner_command('/srv/app', 'app'), sudo.call_args_list[0][0][0])
+            self.assertEqual(sudo.call_args_list[1], call('service app restart', user=None))
+
+    @istest
+    def flushes_queued_changes_on_cleanup(self):
+        with self.fabric_mocks() as (run, sudo):
+            self.role.change_path_owner('/srv/app', 'app')
+
+            self.role.cleanup()
+
+            self.assertEqual(sudo.call_count, 1)
+            self.assertEqual(self.queue.pending, [])
+
+    @istest
+    def defers_changes_inside_a_batch_block(self):
+        role = Role(prov=None, context={})
+        with self.fabric_mocks() as (run, sudo):
+            with role.batch() as queue:
+                result = role.change_path_owner('/srv/app', 'app')
+                role.change_path_mode('/srv/app', 755, recursive=True)
+
+                self.assertIsNone(result)
+                self.assertFalse(sudo.called)
+                self.assertEqual(len(queue.pending), 2)
+
+            self.assertEqual(sudo.call_count, 1)
+            self.assertFalse(run.called)
+            self.assertEqual(queue.pending, [])
+
+    @istest
+    def runs_other_commands_right_away_inside_a_batch_block(self):
+        role = Role(prov=None, context={})
+        with self.fabric_mocks() as (run, sudo):
+            run.return_value = '1234'
+            with role.batch() as queue:
+                role.change_path_owner('/srv/app', 'app')
+
+                self.assertEqual(int(role.execute('pgrep -f app', stdout=False)), 1234)
+                self.assertIn(owner_command('/srv/app', 'app'), sudo.call_args[0][0])
+                self.assertEqual(queue.pending, [])
+
+    @istest
+    def keeps_the_fabric_prefixes_of_queued_changes(self):
+        role = Role(prov=None, context={})
+        directories = []
+        with self.fabric_mocks() as (run, sudo):
+            sudo.side_effect = lambda command, user: directories.append(fabric.api.env.cwd) or ''
+            with fabric.api.cd('/srv'), role.batch():
+                role.change_path_owner('app', 'app')
+
+            self.assertIn('cd /srv >/dev/null && %s' % owner_command('app', 'app'), sudo.call_args[0][0])
+            self.assertEqual(directories, [''])
+
+    @istest
+    def discards_queued_commands_if_the_batch_block_fails(self):
+        role = Role(prov=None, context={})
+        with self.fabric_mocks() as (run, sudo):
+            with self.assertRaises(ValueError):
+                with role.batch():
+                    role.change_path_owner('/srv/app', 'app')
+                    raise ValueError()
+
+            self.assertFalse(sudo.called)
+            self.assertEqual(role.context['mutations'].pending, [])
+
+    @istest
+    def keeps_commands_queued_before_a_failed_batch_block(self):
+        with self.fabric_mocks() as (run, sudo):
+            self.role.change_path_owner('/srv/app', 'app')
+
+            with self.assertRaises(ValueError):
+                with self.role.batch():
+                    self.role.change_path_owner('/srv/other', 'app')
+                    raise ValueError()
+
+            self.assertEqual([mutation.command for mutation in self.queue.pending], [owner_command('/srv/app', 'app')])
+
+
 class UsingRoleTest(ProvyTestCase):
     def any_context(self):
         return {'used_roles': {}}
@@ -1160,10 +2068,17 @@ class RemoteTempFileTests(ProvyTestCase):
         self.patcher.start()
         self.ensure_dir_patcher = patch("provy.core.roles.Role.ensure_dir", Mock(return_value="/tmp"))
         self.ensure_dir_patcher.start()
+        self.mutate_patcher = patch("provy.core.roles.Role._mutate")
+        self.mutate = self.mutate_patcher.start()
 
     def tearDown(self):
         self.patcher.stop()
         self.ensure_dir_patcher.stop()
+        self.mutate_patcher.stop()
+
+    @property
+    def scratch_dir(self):
+        return self.instance.context['scratch_dir']
 
     @istest
     def file_created_in_tempdir(self):
@@ -1173,14 +2088,13 @@ class RemoteTempFileTests(ProvyTestCase):
     @istest
     def directory_created_with_proper_name(self):
         dir = self.instance.create_remote_temp_dir("foobar")
-        self.assertEqual("/tmp/foobar", dir)
-        self.assertEqual(list(self.instance._paths_to_remove)[0], '/tmp/foobar')
+        self.assertEqual(self.scratch_dir + "/foobar", dir)
 
     @istest
     def directory_created_without_cleanup(self):
         dir = self.instance.create_remote_temp_dir("foobar", cleanup=False)
         self.assertEqual("/tmp/foobar", dir)
-        self.assertEqual(self.instance._paths_to_remove, set())
+        self.assertNotIn('scratch_dir', self.instance.context)
 
     @istest
     def file_created_with_proper_suffix(self):
@@ -1190,22 +2104,31 @@ class RemoteTempFileTests(ProvyTestCase):
     @istest
     def files_will_be_deleted_on_cleanup_if_requested(self):
         file = self.instance.create_remote_temp_file(cleanup=True)
-        self.assertIn(file, self.instance._paths_to_remove)
+        self.assertTrue(file.startswith(self.scratch_dir + "/"))
 
     @istest
     def directories_will_be_deleted_on_cleanup_if_requested(self):
         directory = self.instance.create_remote_temp_dir(cleanup=True)
-        self.assertIn(directory, self.instance._paths_to_remove)
+        self.assertTrue(directory.startswith(self.scratch_dir + "/"))
 
     @istest
     def files_will_not_be_deleted_on_cleanup_if_requested(self):
         file = self.instance.create_remote_temp_file(cleanup=False)
-        self.assertNotIn(file, self.instance._paths_to_remove)
+        self.assertTrue(file.startswith("/tmp/"))
+        self.assertNotIn('scratch_dir', self.instance.context)
 
     @istest
     def directories_will_not_be_deleted_on_cleanup_if_requested(self):
-        dirs = self.instance.create_remote_temp_file(cleanup=False)
-        self.assertNotIn(dirs, self.instance._paths_to_remove)
+        directory = self.instance.create_remote_temp_dir(cleanup=False)
+        self.assertTrue(directory.startswith("/tmp/"))
+        self.assertNotIn('scratch_dir', self.instance.context)
+
+    @istest
+    def allocates_many_temp_files_with_a_single_command(self):
+        for _ in range(10):
+            self.instance.create_remote_temp_file()
+
+        self.mutate.assert_called_once_with('mkdir -m 1777 %s' % self.scratch_dir, [self.scratch_dir])
 
     @istest
     def check_if_random_files_have_different_names(self):
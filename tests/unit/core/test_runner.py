@@ -1,7 +1,17 @@
+import os
+import shutil
+import tempfile
+
+from mock import MagicMock, patch
 from nose.tools import istest
 
+from provy.core.blobs import DEFAULT_BLOB_DIR
 from provy.core.errors import ConfigurationError
-from provy.core.runner import get_items, recurse_items
+from provy.core.facts import HostFacts
+from provy.core.pathinfo import owner_command
+from provy.core.roles import Role
+from provy.core.runner import GATEWAY_KEEPALIVE, build_transport, get_items, get_servers_for, provision_server, recurse_items, run
+from tests.unit.core.test_facts import FACTS_OUTPUT
 from tests.unit.tools.helpers import ProvyTestCase
 
 
@@ -41,3 +51,367 @@ class RunnerTest(ProvyTestCase):
             },
         ]
         self.assertListEqual(sorted(found_items), sorted(expected_items), found_items)
+
+    @istest
+    def servers_inherit_the_gateway_of_their_groups(self):
+        class prov:
+            servers = {
+                'production': {
+                    'gateway': 'deploy@bastion',
+                    'keepalive': 10,
+                    'frontend': {'address': '10.0.0.1'},
+                    'backend': {'address': '10.0.0.2', 'gateway': 'deploy@other-bastion'},
+                },
+                'test': {
+                    'frontend': {'address': '33.33.33.33'},
+                },
+            }
+
+        servers = get_servers_for(prov, 'production')
+        test_servers = get_servers_for(prov, 'test')
+
+        gateways = sorted((server['address'], server['gateway'], server['keepalive']) for server in servers)
+        self.assertEqual(gateways, [('10.0.0.1', 'deploy@bastion', 10), ('10.0.0.2', 'deploy@other-bastion', 10)])
+        self.assertNotIn('gateway', test_servers[0])
+
+    @istest
+    def servers_inherit_the_gateway_of_groups_above_the_selected_one(self):
+        class prov:
+            servers = {
+                'production': {
+                    'gateway': 'deploy@bastion',
+                    'frontend': {'address': '10.0.0.1'},
+                },
+            }
+
+        servers = get_servers_for(prov, 'production.frontend')
+
+        self.assertEqual(servers[0]['gateway'], 'deploy@bastion')
+
+
+class BuildTransportTest(ProvyTestCase):
+    @istest
+    def doesnt_build_a_transport_by_default(self):
+        self.assertIsNone(build_transport(None, None, False))
+
+    @istest
+    def builds_a_recorder_or_a_player(self):
+        with patch('provy.core.runner.Recorder') as Recorder, patch('provy.core.runner.Player') as Player:
+            self.assertEqual(build_transport('trace', None, False), Recorder.return_value)
+            self.assertEqual(build_transport(None, 'trace', True), Player.return_value)
+
+            Recorder.assert_called_once_with('trace')
+            Player.assert_called_once_with('trace', latency=True)
+
+    @istest
+    def cannot_record_and_replay_at_the_same_time(self):
+        self.assertRaises(ConfigurationError, build_transport, 'trace', 'trace', False)
+
+
+class ProvisionServerTest(ProvyTestCase):
+    def server(self, **settings):
+        server = {
+            'address': '33.33.33.33',
+            'user': 'vagrant',
+            'roles': [],
+        }
+        server.update(settings)
+        return server
+
+    def provision(self, server):
+        with patch('provy.core.runner.print_header'):
+            provision_server(server, 'provyfile.py', 'some-pass', None)
+
+    @istest
+    def doesnt_start_an_agent_by_default(self):
+        with patch('provy.core.runner.RemoteAgent') as RemoteAgent:
+            self.provision(self.server())
+
+            self.assertFalse(RemoteAgent.called)
+
+    @istest
+    def closes_the_agent_after_provisioning(self):
+        with patch('provy.core.runner.RemoteAgent') as RemoteAgent:
+            self.provision(self.server(agent=True))
+
+            RemoteAgent.return_value.close.assert_called_once_with()
+
+    @istest
+    def closes_the_sudo_sessions_after_provisioning(self):
+        with patch('provy.core.runner.SessionPool') as SessionPool:
+            self.provision(self.server(sudo_session=True))
+
+            SessionPool.return_value.close.assert_called_once_with()
+
+    @istest
+    def queues_changes_automatically_when_batching(self):
+        with patch('provy.core.runner.MutationQueue') as MutationQueue:
+            self.provision(self.server(batch=True))
+
+            MutationQueue.assert_called_once_with(automatic=True)
+
+    @istest
+    def remembers_queries_unless_disabled(self):
+        with patch('provy.core.runner.QueryCache') as QueryCache:
+            self.provision(self.server())
+            self.provision(self.server(query_cache=False))
+
+            QueryCache.assert_called_once_with()
+
+    @istest
+    def shares_the_host_facts_between_roles(self):
+        contexts = []
+
+        class SomeRole(object):
+            def __init__(self, prov, context):
+                contexts.append(context)
+
+            def provision(self):
+                pass
+
+            def cleanup(self):
+                pass
+
+        self.provision(self.server(roles=[SomeRole, SomeRole]))
+
+        self.assertIsInstance(contexts[0]['facts'], HostFacts)
+        self.assertFalse(contexts[0]['facts'].gathered)
+        self.assertIs(contexts[0]['facts'], contexts[1]['facts'])
+
+    @istest
+    def shares_the_fact_store_with_roles(self):
+        contexts = []
+
+        class SomeRole(object):
+            def __init__(self, prov, context):
+                contexts.append(context)
+
+            def provision(self):
+                pass
+
+            def cleanup(self):
+                pass
+
+        with patch('provy.core.runner.print_header'):
+            provision_server(self.server(roles=[SomeRole]), 'provyfile.py', 'some-pass', None, fact_store='some-store')
+
+        self.assertEqual(contexts[0]['fact_store'], 'some-store')
+
+    @istest
+    def shares_the_local_hashes_with_roles(self):
+        contexts = []
+
+        class SomeRole(object):
+            def __init__(self, prov, context):
+                contexts.append(context)
+
+            def provision(self):
+                pass
+
+            def cleanup(self):
+                pass
+
+        with patch('provy.core.runner.print_header'):
+            provision_server(self.server(roles=[SomeRole]), 'provyfile.py', 'some-pass', None, local_hashes='some-hashes')
+
+        self.assertEqual(contexts[0]['local_hashes'], 'some-hashes')
+
+    @istest
+    def waits_for_background_commands_before_cleaning_up(self):
+        events = []
+        background = MagicMock()
+        background.wait.side_effect = lambda: events.append('wait')
+
+        class SomeRole(object):
+            def __init__(self, prov, context):
+                self.context = context
+
+            def provision(self):
+                self.context['background'] = [background]
+
+            def cleanup(self):
+                events.append('cleanup')
+
+        self.provision(self.server(roles=[SomeRole]))
+
+        self.assertEqual(events, ['wait', 'cleanup'])
+
+    @istest
+    def removes_the_scratch_dir_after_all_roles_are_cleaned_up(self):
+        events = []
+
+        class SomeRole(object):
+            def __init__(self, prov, context):
+                self.context = context
+
+            def provision(self):
+                self.context['scratch_dir'] = '/tmp/provy-abc'
+
+            def cleanup(self):
+                events.append('cleanup')
+
+            def remove_remote_scratch_dir(self):
+                events.append(('remove', self.context['scratch_dir']))
+
+        self.provision(self.server(roles=[SomeRole, SomeRole]))
+
+        self.assertEqual(events, ['cleanup', 'cleanup', ('remove', '/tmp/provy-abc')])
+
+    @istest
+    def runs_the_commands_queued_by_the_cleanups_when_batching(self):
+        class SomeRole(Role):
+            def cleanup(self):
+                super(SomeRole, self).cleanup()
+                self.change_path_owner('/srv/app', 'app')
+
+        with patch('fabric.api.run') as run, patch('fabric.api.sudo') as sudo:
+            run.return_value = sudo.return_value = ''
+
+            self.provision(self.server(roles=[SomeRole], batch=True))
+
+            self.assertEqual(sudo.call_count, 1)
+            self.assertIn(owner_command('/srv/app', 'app'), sudo.call_args[0][0])
+
+    @istest
+    def replays_a_recorded_run_while_keeping_facts_between_runs(self):
+        directory = tempfile.mkdtemp()
+        trace = os.path.join(directory, 'trace')
+        distros = []
+
+        class SomeRole(Role):
+            def provision(self):
+                distros.append(self.get_distro_info().distributor_id)
+
+        output = '\r\n'.join(['provy-fact:fingerprint', 'some-boot-id 1380000000', FACTS_OUTPUT])
+        try:
+            with patch('provy.core.runner.import_module'), patch('provy.core.runner.print_header'), \
+                    patch('provy.core.runner.get_servers_for') as get_servers_for, \
+                    patch('os.path.expanduser', return_value=directory), \
+                    patch('fabric.api.run') as fabric_run, patch('fabric.api.sudo') as fabric_sudo:
+                get_servers_for.return_value = [self.server(roles=[SomeRole])]
+                fabric_run.return_value = fabric_sudo.return_value = output
+
+                run('provyfile.py', 'server', 'some-pass', {}, record=trace)
+                fabric_run.reset_mock()
+                fabric_sudo.reset_mock()
+                run('provyfile.py', 'server', 'some-pass', {}, replay=trace)
+
+                self.assertFalse(fabric_run.called)
+                self.assertFalse(fabric_sudo.called)
+                self.assertEqual(distros, ['Ubuntu', 'Ubuntu'])
+        finally:
+            shutil.rmtree(directory)
+
+    @istest
+    def connects_through_the_gateway_with_keepalive(self):
+        with patch('provy.core.runner._settings') as settings:
+            self.provision(self.server(gateway='deploy@bastion'))
+
+            settings.assert_called_once_with(host_string='vagrant@33.33.33.33', password='some-pass', gateway='deploy@bastion', keepalive=GATEWAY_KEEPALIVE)
+
+    @istest
+    def connects_directly_without_a_gateway(self):
+        with patch('provy.core.runner._settings') as settings:
+            self.provision(self.server(keepalive=5))
+
+            settings.assert_called_once_with(host_string='vagrant@33.33.33.33', password='some-pass', keepalive=5)
+
+    @istest
+    def doesnt_start_the_agent_while_recording_or_replaying(self):
+        contexts = []
+
+        class SomeRole(object):
+            def __init__(self, prov, context):
+                contexts.append(context)
+
+            def provision(self):
+                pass
+
+            def cleanup(self):
+                pass
+
+        with patch('provy.core.runner.print_header'), patch('provy.core.runner.RemoteAgent') as RemoteAgent:
+            provision_server(self.server(agent=True, roles=[SomeRole]), 'provyfile.py', 'some-pass', None, transport='some-transport')
+
+            self.assertFalse(RemoteAgent.called)
+        self.assertEqual(contexts[0]['transport'], 'some-transport')
+
+    @istest
+    def reports_the_calls_made_to_the_server(self):
+        stats = MagicMock()
+        contexts = []
+
+        class SomeRole(object):
+            def __init__(self, prov, context):
+                contexts.append(context)
+
+            def provision(self):
+                pass
+
+            def cleanup(self):
+                pass
+
+        with patch('provy.core.runner.print_header'):
+            provision_server(self.server(roles=[SomeRole]), 'provyfile.py', 'some-pass', None, stats=stats)
+
+        self.assertIs(contexts[0]['stats'], stats)
+        stats.report.assert_called_once_with('vagrant@33.33.33.33')
+
+    @istest
+    def sets_the_upload_thresholds_of_the_server(self):
+        contexts = []
+
+        class SomeRole(object):
+            def __init__(self, prov, context):
+                contexts.append(context)
+
+            def provision(self):
+                pass
+
+            def cleanup(self):
+                pass
+
+        self.provision(self.server(roles=[SomeRole]))
+        self.provision(self.server(roles=[SomeRole], delta_threshold=None, compress_threshold=1024))
+
+        self.assertNotIn('delta_threshold', contexts[0])
+        self.assertIsNone(contexts[1]['delta_threshold'])
+        self.assertEqual(contexts[1]['compress_threshold'], 1024)
+
+    @istest
+    def stores_the_uploaded_blobs_before_cleaning_up(self):
+        events = []
+
+        class SomeRole(object):
+            def __init__(self, prov, context):
+                self.context = context
+
+            def provision(self):
+                self.context['blobs'].flush = lambda: events.append(('flush', self.context['blobs'].directory))
+
+            def cleanup(self):
+                events.append('cleanup')
+
+        self.provision(self.server(roles=[SomeRole], blob_cache='/srv/blobs'))
+
+        self.assertEqual(events, [('flush', '/srv/blobs'), 'cleanup'])
+
+    @istest
+    def keeps_blobs_in_the_default_directory(self):
+        contexts = []
+
+        class SomeRole(object):
+            def __init__(self, prov, context):
+                contexts.append(context)
+
+            def provision(self):
+                pass
+
+            def cleanup(self):
+                pass
+
+        self.provision(self.server(roles=[SomeRole], blob_cache=True))
+        self.provision(self.server(roles=[SomeRole]))
+
+        self.assertEqual(contexts[0]['blobs'].directory, DEFAULT_BLOB_DIR)
+        self.assertNotIn('blobs', contexts[1])
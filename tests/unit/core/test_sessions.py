@@ -0,0 +1,145 @@
+from mock import MagicMock, patch
+from nose.tools import istest
+
+import fabric.api
+
+from provy.core.sessions import CommandResult, PrivilegedSession, SessionPool, wrap_command
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+class PrivilegedSessionTest(ProvyTestCase):
+    def setUp(self):
+        super(PrivilegedSessionTest, self).setUp()
+        self.session = PrivilegedSession()
+        self.session.channel = MagicMock()
+        self.session.channel.read_until.return_value = ('some output\n', '', '0')
+
+    def sent_script(self):
+        return self.session.channel.write.call_args[0][0]
+
+    def run_command(self, command):
+        with fabric.api.settings(fabric.api.hide('running', 'stdout')):
+            return self.session.run(command)
+
+    @istest
+    def starts_a_super_user_shell_on_first_command(self):
+        session = PrivilegedSession()
+        with patch('provy.core.sessions.RemoteChannel') as RemoteChannel:
+            RemoteChannel.return_value.open.return_value.read_until.return_value = ('', '', '0')
+            with fabric.api.settings(fabric.api.hide('running', 'stdout')):
+                session.run('ls')
+                session.run('ls')
+
+            RemoteChannel.assert_called_once_with('/bin/sh', sudo=True, user=None)
+
+    @istest
+    def starts_a_shell_for_another_user(self):
+        session = PrivilegedSession('foo')
+        with patch('provy.core.sessions.RemoteChannel') as RemoteChannel:
+            RemoteChannel.return_value.open.return_value.read_until.return_value = ('', '', '0')
+            with fabric.api.settings(fabric.api.hide('running', 'stdout')):
+                session.run('ls')
+
+            RemoteChannel.assert_called_once_with('/bin/sh', sudo=True, user='foo')
+
+    @istest
+    def runs_command_in_a_subshell_delimited_by_a_marker(self):
+        with patch('uuid.uuid4') as uuid4:
+            uuid4.return_value.hex = 'abc'
+
+            self.run_command('ls /')
+
+            self.assertEqual(self.sent_script(), '( /bin/bash -l -c "ls /" ) < /dev/null\n'
+                                                 "printf '\\nprovy-session-abc %d\\n' $?\nprintf '\\nprovy-session-abc\\n' >&2\n")
+            self.session.channel.read_until.assert_called_once_with('provy-session-abc')
+
+    @istest
+    def returns_output_error_and_exit_code(self):
+        self.session.channel.read_until.return_value = ('some output\n', 'some warning\n', '0')
+
+        result = self.run_command('ls /')
+
+        self.assertEqual(result, 'some output')
+        self.assertEqual(result.stderr, 'some warning')
+        self.assertEqual(result.return_code, 0)
+        self.assertTrue(result.succeeded)
+
+    @istest
+    def changes_to_fabric_cwd_before_running(self):
+        with fabric.api.cd('/some/dir'):
+            self.run_command('ls')
+
+        self.assertTrue(self.sent_script().startswith('( /bin/bash -l -c "cd /some/dir >/dev/null && ls" ) < /dev/null\n'))
+
+    @istest
+    def wraps_commands_like_fabric(self):
+        with fabric.api.settings(fabric.api.prefix('source /srv/venv/bin/activate'), fabric.api.shell_env(LANG='C'), shell='/bin/sh -c'):
+            self.assertEqual(wrap_command('pip install "django"'), '/bin/sh -c "export LANG=\\"C\\" && source /srv/venv/bin/activate && pip install \\"django\\""')
+            self.run_command('pip install django')
+
+        self.assertIn('source /srv/venv/bin/activate && pip install django', self.sent_script())
+
+    @istest
+    def aborts_when_command_fails(self):
+        self.session.channel.read_until.return_value = ('', 'boom', '2')
+
+        with fabric.api.settings(fabric.api.hide('everything', 'aborts')):
+            self.assertRaises(SystemExit, self.run_command, 'false')
+
+    @istest
+    def returns_failure_when_only_warning(self):
+        self.session.channel.read_until.return_value = ('', 'boom', '2')
+
+        with fabric.api.settings(fabric.api.hide('everything'), warn_only=True):
+            result = self.run_command('false')
+
+        self.assertEqual(result.return_code, 2)
+        self.assertTrue(result.failed)
+
+    @istest
+    def closes_the_channel(self):
+        channel = self.session.channel
+
+        self.session.close()
+
+        channel.close.assert_called_once_with()
+        self.assertIsNone(self.session.channel)
+
+
+class SessionPoolTest(ProvyTestCase):
+    @istest
+    def keeps_one_session_per_user(self):
+        pool = SessionPool()
+        with patch('provy.core.sessions.PrivilegedSession') as PrivilegedSession:
+            PrivilegedSession.side_effect = lambda user: MagicMock(user=user)
+
+            pool.run('ls')
+            pool.run('ls', user='foo')
+            pool.run('ls')
+
+            self.assertEqual(sorted(pool.sessions.keys()), [None, 'foo'])
+            self.assertEqual(pool.sessions[None].run.call_count, 2)
+            pool.sessions['foo'].run.assert_called_once_with('ls')
+
+    @istest
+    def closes_all_sessions(self):
+        pool = SessionPool()
+        root, foo = MagicMock(), MagicMock()
+        pool.sessions = {None: root, 'foo': foo}
+
+        pool.close()
+
+        root.close.assert_called_once_with()
+        foo.close.assert_called_once_with()
+        self.assertEqual(pool.sessions, {})
+
+
+class CommandResultTest(ProvyTestCase):
+    @istest
+    def is_the_output_string(self):
+        result = CommandResult('out', 'err', 1, 'some command')
+
+        self.assertEqual(result, 'out')
+        self.assertEqual(result.stderr, 'err')
+        self.assertTrue(result.failed)
+        self.assertEqual(result.command, 'some command')
@@ -0,0 +1,112 @@
+import sys
+from StringIO import StringIO
+
+from mock import patch
+from nose.tools import istest
+
+from provy.core.roles import Role
+from provy.core.stats import CallStats, find_caller, human_size, payload_size
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+class SomeRole(Role):
+    def provision(self):
+        return find_caller(sys._getframe(), Role)
+
+    def nested(self):
+        return self.provision()
+
+
+class FindCallerTest(ProvyTestCase):
+    @istest
+    def finds_the_innermost_role_method(self):
+        role = SomeRole(None, {})
+
+        self.assertEqual(role.provision(), ('SomeRole', 'provision'))
+        self.assertEqual(role.nested(), ('SomeRole', 'provision'))
+
+    @istest
+    def skips_the_base_role_helpers(self):
+        role = SomeRole(None, {'stats': CallStats()})
+        with patch('fabric.api.run'), patch('fabric.api.sudo'), fabric_host():
+            role.provision = lambda: role.ensure_dir('/srv/app')
+            SomeRole.nested(role)
+
+        callers = set(caller for host, kind, caller in role.context['stats'].totals)
+        self.assertEqual(callers, set([('SomeRole', 'nested')]))
+
+    @istest
+    def doesnt_find_anything_outside_roles(self):
+        self.assertEqual(find_caller(sys._getframe(), Role), ('?', '?'))
+
+
+class PayloadSizeTest(ProvyTestCase):
+    @istest
+    def measures_local_files_and_in_memory_files(self):
+        self.assertEqual(payload_size(__file__.replace('.pyc', '.py')), len(open(__file__.replace('.pyc', '.py')).read()))
+        self.assertEqual(payload_size(StringIO('some content')), 12)
+        self.assertIsNone(payload_size('/some/inexistent/file'))
+        self.assertIsNone(payload_size(object()))
+
+    @istest
+    def formats_sizes(self):
+        self.assertEqual(human_size(10), '10 B')
+        self.assertEqual(human_size(2048), '2.0 KB')
+        self.assertEqual(human_size(3 * 1024 * 1024), '3.0 MB')
+
+
+class CallStatsTest(ProvyTestCase):
+    def setUp(self):
+        super(CallStatsTest, self).setUp()
+        self.stats = CallStats()
+
+    @istest
+    def measures_calls(self):
+        with patch('time.time') as time:
+            time.side_effect = [10.0, 10.5]
+
+            result = self.stats.measure('host-a', 'execute', ('SomeRole', 'provision'), lambda: 'some output', sent=7)
+
+        self.assertEqual(result, 'some output')
+        totals = self.stats.totals[('host-a', 'execute', ('SomeRole', 'provision'))]
+        self.assertEqual((totals.count, totals.elapsed, totals.sent, totals.received), (1, 0.5, 7, 11))
+
+    @istest
+    def measures_calls_that_know_what_they_sent_at_the_end(self):
+        sent = []
+
+        self.stats.measure('host-a', 'put', ('SomeRole', 'provision'), lambda: sent.append(42), sent=lambda: sent[0])
+
+        self.assertEqual(self.stats.totals[('host-a', 'put', ('SomeRole', 'provision'))].sent, 42)
+
+    @istest
+    def measures_failed_calls(self):
+        def fail():
+            raise SystemExit(1)
+
+        with self.assertRaises(SystemExit):
+            self.stats.measure('host-a', 'execute', ('SomeRole', 'provision'), fail)
+
+        self.assertEqual(self.stats.totals[('host-a', 'execute', ('SomeRole', 'provision'))].count, 1)
+
+    @istest
+    def reports_the_top_callers_per_host_and_overall(self):
+        self.stats.add('host-a', 'execute', ('AptitudeRole', 'ensure_package_installed'), 2.0, 100, 2048)
+        self.stats.add('host-a', 'execute', ('AptitudeRole', 'ensure_package_installed'), 1.0, 100, 0)
+        self.stats.add('host-a', 'put', ('NginxRole', 'provision'), 0.5, 4096, 0)
+        self.stats.add('host-b', 'execute', ('NginxRole', 'provision'), 0.25, 10, 10)
+
+        host_report = self.stats.report('host-a').splitlines()
+        report = self.stats.report(top=1).splitlines()
+
+        self.assertEqual(host_report[0], '3 calls in host-a, taking 3.50s (4.2 KB sent, 2.0 KB received)')
+        self.assertIn('AptitudeRole.ensure_package_installed', host_report[2])
+        self.assertTrue(host_report[2].strip().startswith('2 '))
+        self.assertIn('NginxRole.provision', host_report[3])
+        self.assertEqual(report[0], '4 calls in all servers, taking 3.75s (4.2 KB sent, 2.0 KB received)')
+        self.assertEqual(len(report), 3)
+
+
+def fabric_host():
+    import fabric.api
+    return fabric.api.settings(host_string='vagrant@33.33.33.33')
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import istest
+
+from provy.core.sync import MANIFEST_MARKER, compare, local_manifest, manifest_command, parse_manifest
+from tests.unit.tools.helpers import ProvyTestCase
+
+
+class ManifestTest(ProvyTestCase):
+    def setUp(self):
+        super(ManifestTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, path, content, mode=0o644):
+        full_path = os.path.join(self.directory, path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, 'w') as f:
+            f.write(content)
+        os.chmod(full_path, mode)
+
+    @istest
+    def builds_the_manifest_of_a_local_directory(self):
+        self.write('app.conf', 'some content\n')
+        self.write('bin/run', 'echo run\n', 0o755)
+        os.symlink(os.path.join(self.directory, 'app.conf'), os.path.join(self.directory, 'link.conf'))
+
+        self.assertEqual(local_manifest(self.directory), {
+            'app.conf': (13, 644, 'eb9c2bf0eb63f3a7bc0ea37ef18aeba5'),
+            'bin/run': (9, 755, 'ad6d1afa268876b31abfbce95f62c092'),
+        })
+
+    @istest
+    def builds_the_remote_manifest_command(self):
+        self.assertEqual(manifest_command('/srv/my app'), (
+            "if [ -d '/srv/my app' ]; then cd '/srv/my app' && find . -type f -printf '%P\\t%s\\t%m\\n' && "
+            "echo provy-manifest-hashes && find . -type f -exec md5sum {} +; fi"))
+
+    @istest
+    def parses_the_remote_manifest(self):
+        output = '\r\n'.join([
+            'app.conf\t13\t644',
+            'my dir/run\t9\t755',
+            MANIFEST_MARKER,
+            'eb9c2bf0eb63f3a7bc0ea37ef18aeba5  ./app.conf',
+            'ad6d1afa268876b31abfbce95f62c092  ./my dir/run',
+        ])
+
+        self.assertEqual(parse_manifest(output), {
+            'app.conf': (13, 644, 'eb9c2bf0eb63f3a7bc0ea37ef18aeba5'),
+            'my dir/run': (9, 755, 'ad6d1afa268876b31abfbce95f62c092'),
+        })
+        self.assertEqual(parse_manifest(''), {})
+
+    @istest
+    def compares_manifests(self):
+        local = {
+            'same': (1, 644, 'a'),
+            'changed': (1, 644, 'b'),
+            'resized': (2, 644, 'c'),
+            'mode': (1, 755, 'd'),
+            'new': (1, 644, 'e'),
+        }
+        remote = {
+            'same': (1, 644, 'a'),
+            'changed': (1, 644, 'x'),
+            'resized': (1, 644, 'c'),
+            'mode': (1, 644, 'd'),
+            'old': (1, 644, 'f'),
+        }
+
+        self.assertEqual(compare(local, remote), (['changed', 'new', 'resized'], ['mode'], ['old']))
@@ -1,9 +1,11 @@
 import os
+import shutil
+import tempfile
 
 from mock import patch
 from nose.tools import istest
 
-from provy.core.utils import provyfile_path_from, provyfile_module_from, import_module
+from provy.core.utils import provyfile_path_from, provyfile_module_from, import_module, provy_dir
 from tests.unit.tools.helpers import ProvyTestCase
 
 
@@ -93,3 +95,18 @@ class UtilsTest(ProvyTestCase):
             module = import_module('foo_module')
 
             self.assertEqual(module, foo_module)
+
+    @istest
+    def creates_directories_under_provy_home(self):
+        home = tempfile.mkdtemp()
+        try:
+            with patch.object(os.path, 'expanduser') as expanduser:
+                expanduser.return_value = home
+
+                directory = provy_dir('facts')
+
+                self.assertEqual(directory, os.path.join(home, '.provy', 'facts'))
+                self.assertTrue(os.path.isdir(directory))
+                self.assertEqual(provy_dir('facts'), directory)
+        finally:
+            shutil.rmtree(home)
@@ -39,46 +39,46 @@ class UserRoleTest(ProvyTestCase):
 
     @istest
     def checks_that_a_group_exists(self):
-        with self.execute_mock() as execute:
-            execute.return_value = example_groups
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = example_groups
 
             self.assertTrue(self.role.group_exists('daemon'))
-            execute.assert_called_with("cat /etc/group | cut -d ':' -f 1", stdout=False, sudo=True)
+            execute_iter.assert_called_with("cat /etc/group | cut -d ':' -f 1", stdout=False, sudo=True)
 
     @istest
     def checks_that_a_group_doesnt_exist(self):
-        with self.execute_mock() as execute:
-            execute.return_value = example_groups
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = example_groups
 
             self.assertFalse(self.role.group_exists('iis'))
 
     @istest
     def checks_group_by_exact_name(self):
-        with self.execute_mock() as execute:
-            execute.return_value = example_groups
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = example_groups
 
             self.assertFalse(self.role.group_exists('roo'))
             self.assertFalse(self.role.group_exists('roots'))
 
     @istest
     def checks_that_a_user_exists(self):
-        with self.execute_mock() as execute:
-            execute.return_value = example_users
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = example_users
 
             self.assertTrue(self.role.user_exists('daemon'))
-            execute.assert_called_with("cat /etc/passwd | cut -d ':' -f 1", stdout=False, sudo=True)
+            execute_iter.assert_called_with("cat /etc/passwd | cut -d ':' -f 1", stdout=False, sudo=True)
 
     @istest
     def checks_that_a_user_doesnt_exist(self):
-        with self.execute_mock() as execute:
-            execute.return_value = example_users
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = example_users
 
             self.assertFalse(self.role.user_exists('iis'))
 
     @istest
     def checks_user_by_exact_name(self):
-        with self.execute_mock() as execute:
-            execute.return_value = example_users
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = example_users
 
             self.assertFalse(self.role.user_exists('roo'))
             self.assertFalse(self.role.user_exists('roots'))
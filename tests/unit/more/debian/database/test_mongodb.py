@@ -1,3 +1,4 @@
+from mock import ANY
 from nose.tools import istest
 
 from provy.more.debian import AptitudeRole, MongoDBRole
@@ -12,6 +13,16 @@ class MongoDBRoleTest(ProvyTestCase):
     def content_from_list(self, list_):
         return '\n'.join(list_)
 
+    def configure(self, remote_content, configuration):
+        with self.mock_role_methods('get_file', 'put_file') as (get_file, put_file):
+            get_file.side_effect = lambda from_file, to_file, sudo: to_file.write(remote_content)
+
+            self.role.configure(configuration)
+
+            get_file.assert_called_with('/etc/mongodb.conf', ANY, sudo=True)
+            put_file.assert_called_with(from_file=ANY, to_file='/etc/mongodb.conf', sudo=True)
+            return put_file.call_args[1]['from_file'].read()
+
     @istest
     def installs_necessary_packages_to_provision_to_debian(self):
         with self.using_stub(AptitudeRole) as mock_aptitude:
@@ -53,61 +64,43 @@ class MongoDBRoleTest(ProvyTestCase):
 
     @istest
     def appends_configuration_to_server_config(self):
-        with self.mock_role_methods('read_remote_file', 'write_to_temp_file', 'put_file') as (read_remote_file, write_to_temp_file, put_file):
-            read_remote_file.return_value = self.content_from_list([
-                'foo=Foo',
-            ])
-            write_to_temp_file.return_value = '/some/tmp/path'
-
-            self.role.configure({
-                'bar': 'Bar',
-            })
-
-            read_remote_file.assert_called_with('/etc/mongodb.conf', sudo=True)
-            write_to_temp_file.assert_called_with(self.content_from_list([
-                'foo = Foo',
-                'bar = Bar',
-                '',  # newline in the end of the file
-            ]))
-            put_file.assert_called_with(from_file='/some/tmp/path', to_file='/etc/mongodb.conf', sudo=True)
+        content = self.configure(self.content_from_list([
+            'foo=Foo',
+        ]), {
+            'bar': 'Bar',
+        })
+
+        self.assertEqual(content, self.content_from_list([
+            'foo = Foo',
+            'bar = Bar',
+            '',  # newline in the end of the file
+        ]))
 
     @istest
     def converts_boolean_config_from_input(self):
-        with self.mock_role_methods('read_remote_file', 'write_to_temp_file', 'put_file') as (read_remote_file, write_to_temp_file, put_file):
-            read_remote_file.return_value = self.content_from_list([
-                'foo=Foo',
-            ])
-            write_to_temp_file.return_value = '/some/tmp/path'
-
-            self.role.configure({
-                'bar': True,
-            })
-
-            read_remote_file.assert_called_with('/etc/mongodb.conf', sudo=True)
-            write_to_temp_file.assert_called_with(self.content_from_list([
-                'foo = Foo',
-                'bar = true',
-                '',  # newline in the end of the file
-            ]))
-            put_file.assert_called_with(from_file='/some/tmp/path', to_file='/etc/mongodb.conf', sudo=True)
+        content = self.configure(self.content_from_list([
+            'foo=Foo',
+        ]), {
+            'bar': True,
+        })
+
+        self.assertEqual(content, self.content_from_list([
+            'foo = Foo',
+            'bar = true',
+            '',  # newline in the end of the file
+        ]))
 
     @istest
     def overwrites_original_configuration_when_redefined(self):
-        with self.mock_role_methods('read_remote_file', 'write_to_temp_file', 'put_file') as (read_remote_file, write_to_temp_file, put_file):
-            read_remote_file.return_value = self.content_from_list([
-                'foo=Foo',
-            ])
-            write_to_temp_file.return_value = '/some/tmp/path'
-
-            self.role.configure({
-                'foo': 'Baz',
-                'bar': 'Bar',
-            })
-
-            read_remote_file.assert_called_with('/etc/mongodb.conf', sudo=True)
-            write_to_temp_file.assert_called_with(self.content_from_list([
-                'foo = Baz',
-                'bar = Bar',
-                '',  # newline in the end of the file
-            ]))
-            put_file.assert_called_with(from_file='/some/tmp/path', to_file='/etc/mongodb.conf', sudo=True)
+        content = self.configure(self.content_from_list([
+            'foo=Foo',
+        ]), {
+            'foo': 'Baz',
+            'bar': 'Bar',
+        })
+
+        self.assertEqual(content, self.content_from_list([
+            'foo = Baz',
+            'bar = Bar',
+            '',  # newline in the end of the file
+        ]))
@@ -19,46 +19,46 @@ class MySQLRoleTest(ProvyTestCase):
 
     @istest
     def has_no_grant_if_not_granted(self):
-        with self.execute_mock() as execute:
-            execute.return_value = FOO_DB_WITHOUT_JOHN_GRANTS
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = FOO_DB_WITHOUT_JOHN_GRANTS
             self.assertFalse(self.role.has_grant('ALL', 'foo', 'john', '%', False))
-            execute.assert_called_with('''mysql -u root -E -e "SHOW GRANTS FOR 'john'@'%';" mysql''', sudo=True, stdout=False)
+            execute_iter.assert_called_with('''mysql -u root -E -e "SHOW GRANTS FOR 'john'@'%';" mysql''', sudo=True, stdout=False)
 
     @istest
     def has_grant_if_granted(self):
-        with self.execute_mock() as execute:
-            execute.return_value = FOO_DB_WITH_JOHN_GRANTS
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = FOO_DB_WITH_JOHN_GRANTS
             self.assertTrue(self.role.has_grant('ALL', 'foo', 'john', '%', False))
-            execute.assert_called_with('''mysql -u root -E -e "SHOW GRANTS FOR 'john'@'%';" mysql''', sudo=True, stdout=False)
+            execute_iter.assert_called_with('''mysql -u root -E -e "SHOW GRANTS FOR 'john'@'%';" mysql''', sudo=True, stdout=False)
 
     @istest
     def has_grant_if_granted_with_grant_option(self):
-        with self.execute_mock() as execute:
-            execute.return_value = FOO_DB_WITH_JOHN_GRANTS_AND_GRANT_OPTION
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = FOO_DB_WITH_JOHN_GRANTS_AND_GRANT_OPTION
             self.assertTrue(self.role.has_grant('ALL', 'foo', 'john', '%', True))
-            execute.assert_called_with('''mysql -u root -E -e "SHOW GRANTS FOR 'john'@'%';" mysql''', sudo=True, stdout=False)
+            execute_iter.assert_called_with('''mysql -u root -E -e "SHOW GRANTS FOR 'john'@'%';" mysql''', sudo=True, stdout=False)
 
     @istest
     def has_grant_if_granted_even_if_provided_full(self):
-        with self.execute_mock() as execute:
-            execute.return_value = FOO_DB_WITH_JOHN_GRANTS
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = FOO_DB_WITH_JOHN_GRANTS
             self.assertTrue(self.role.has_grant('ALL PRIVILEGES', 'foo', 'john', '%', False))
-            execute.assert_called_with('''mysql -u root -E -e "SHOW GRANTS FOR 'john'@'%';" mysql''', sudo=True, stdout=False)
+            execute_iter.assert_called_with('''mysql -u root -E -e "SHOW GRANTS FOR 'john'@'%';" mysql''', sudo=True, stdout=False)
 
     @istest
     def has_grant_if_granted_even_if_provided_as_lowercase_string(self):
-        with self.execute_mock() as execute:
-            execute.return_value = FOO_DB_WITH_JOHN_GRANTS
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = FOO_DB_WITH_JOHN_GRANTS
             self.assertTrue(self.role.has_grant('all', 'foo', 'john', '%', False))
-            execute.assert_called_with('''mysql -u root -E -e "SHOW GRANTS FOR 'john'@'%';" mysql''', sudo=True, stdout=False)
+            execute_iter.assert_called_with('''mysql -u root -E -e "SHOW GRANTS FOR 'john'@'%';" mysql''', sudo=True, stdout=False)
 
     @istest
     def can_get_user_grants(self):
-        with self.execute_mock() as execute:
-            execute.return_value = FOO_DB_WITHOUT_JOHN_GRANTS
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = FOO_DB_WITHOUT_JOHN_GRANTS
             expected = ["GRANT USAGE ON *.* TO 'john'@'%' IDENTIFIED BY PASSWORD '*B9EE00DF55E7C816911C6DA56F1E3A37BDB31093'"]
             self.assertEqual(expected, self.role.get_user_grants('john', '%'))
-            execute.assert_called_with('''mysql -u root -E -e "SHOW GRANTS FOR 'john'@'%';" mysql''', sudo=True, stdout=False)
+            execute_iter.assert_called_with('''mysql -u root -E -e "SHOW GRANTS FOR 'john'@'%';" mysql''', sudo=True, stdout=False)
 
     @istest
     def installs_necessary_packages_to_provision(self):
@@ -102,8 +102,8 @@ class MySQLRoleTest(ProvyTestCase):
 
     @istest
     def gets_user_hosts(self):
-        with self.execute_mock() as execute:
-            execute.return_value = HOSTS_FOR_USER
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = HOSTS_FOR_USER
 
             hosts = self.role.get_user_hosts('root')
 
@@ -113,13 +113,13 @@ class MySQLRoleTest(ProvyTestCase):
                 'my-desktop',
                 'localhost',
             ])
-            execute.assert_called_with('''mysql -u root -E -e "select Host from mysql.user where LOWER(User)='root'" mysql''',
-                                       sudo=True, stdout=False)
+            execute_iter.assert_called_with('''mysql -u root -E -e "select Host from mysql.user where LOWER(User)='root'" mysql''',
+                                            sudo=True, stdout=False)
 
     @istest
     def gets_user_hosts_using_password(self):
-        with self.execute_mock() as execute:
-            execute.return_value = HOSTS_FOR_USER
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = HOSTS_FOR_USER
             self.role.mysql_root_pass = 'mypass'
 
             hosts = self.role.get_user_hosts('root')
@@ -130,19 +130,19 @@ class MySQLRoleTest(ProvyTestCase):
                 'my-desktop',
                 'localhost',
             ])
-            execute.assert_called_with('''mysql -u root --password="mypass" -E -e "select Host from mysql.user where LOWER(User)='root'" mysql''',
-                                       sudo=True, stdout=False)
+            execute_iter.assert_called_with('''mysql -u root --password="mypass" -E -e "select Host from mysql.user where LOWER(User)='root'" mysql''',
+                                            sudo=True, stdout=False)
 
     @istest
     def gets_empty_user_hosts(self):
-        with self.execute_mock() as execute:
-            execute.return_value = ''
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = ''
 
             hosts = self.role.get_user_hosts('root')
 
             self.assertEqual(hosts, [])
-            execute.assert_called_with('''mysql -u root -E -e "select Host from mysql.user where LOWER(User)='root'" mysql''',
-                                       sudo=True, stdout=False)
+            execute_iter.assert_called_with('''mysql -u root -E -e "select Host from mysql.user where LOWER(User)='root'" mysql''',
+                                            sudo=True, stdout=False)
 
     @istest
     def checks_that_a_user_exists(self):
@@ -196,33 +196,33 @@ class MySQLRoleTest(ProvyTestCase):
 
     @istest
     def checks_that_a_database_is_present(self):
-        with self.execute_mock() as execute:
-            execute.return_value = DATABASES
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = DATABASES
 
             result = self.role.is_database_present('performance_schema')
 
             self.assertTrue(result)
-            execute.assert_called_with('mysql -u root -E -e "SHOW DATABASES" mysql', stdout=False, sudo=True)
+            execute_iter.assert_called_with('mysql -u root -E -e "SHOW DATABASES" mysql', stdout=False, sudo=True)
 
     @istest
     def checks_that_a_database_is_not_present(self):
-        with self.execute_mock() as execute:
-            execute.return_value = DATABASES
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = DATABASES
 
             result = self.role.is_database_present('bad_bad_database')
 
             self.assertFalse(result)
-            execute.assert_called_with('mysql -u root -E -e "SHOW DATABASES" mysql', stdout=False, sudo=True)
+            execute_iter.assert_called_with('mysql -u root -E -e "SHOW DATABASES" mysql', stdout=False, sudo=True)
 
     @istest
     def checks_that_a_database_is_not_present_when_there_is_none(self):
-        with self.execute_mock() as execute:
-            execute.return_value = ''
+        with self.execute_iter_mock() as execute_iter:
+            execute_iter.output = ''
 
             result = self.role.is_database_present('performance_schema')
 
             self.assertFalse(result)
-            execute.assert_called_with('mysql -u root -E -e "SHOW DATABASES" mysql', stdout=False, sudo=True)
+            execute_iter.assert_called_with('mysql -u root -E -e "SHOW DATABASES" mysql', stdout=False, sudo=True)
 
     @istest
     def creates_a_database_if_it_doesnt_exist_yet(self):
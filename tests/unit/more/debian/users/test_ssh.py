@@ -33,16 +33,13 @@ class SSHRoleTest(ProvyTestCase):
 
     @istest
     def writes_keys(self):
-        with self.mock_role_methods('execute_python', 'write_to_temp_file', 'update_file') as (execute_python, write_to_temp_file, update_file):
-            self.role._SSHRole__write_keys('user', '..private..', '..public..')
+        with self.mock_role_methods('get_hostname', 'write_to_temp_file', 'update_file') as (get_hostname, write_to_temp_file, update_file):
+            get_hostname.return_value = 'some-host'
 
-            self.assertEqual(
-                execute_python.call_args,
-                call('import os; print os.uname()[1]', stdout=False)
-            )
+            self.role._SSHRole__write_keys('user', '..private..', '..public..')
 
             write_to_temp_file.assert_has_calls([
-                call('..public.. user@' + str(execute_python.return_value)),
+                call('..public.. user@some-host'),
                 call('..private..'),
             ])
 
@@ -59,7 +56,7 @@ class SSHRoleTest(ProvyTestCase):
 
     @istest
     def doesnt_log_if_updating_keys_files_fails(self):
-        with self.mock_role_methods('execute_python', 'write_to_temp_file', 'update_file', 'log') as (execute_python, write_to_temp_file, update_file, log):
+        with self.mock_role_methods('get_hostname', 'write_to_temp_file', 'update_file', 'log') as (get_hostname, write_to_temp_file, update_file, log):
             update_file.return_value = False
 
             self.role._SSHRole__write_keys('user', '..private..', '..public..')
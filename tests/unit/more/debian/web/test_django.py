@@ -240,13 +240,13 @@ class DjangoRoleTest(ProvyTestCase):
         with self.role.create_site('bar-site') as website:
             website.settings_path = '/foo/settings.py'
 
-        with self.mock_role_methods('execute', 'update_file'):
-            self.role.update_file.return_value = True
+        with self.mock_role_methods('execute', 'update_files'):
+            self.role.update_files.return_value = ['/etc/init.d/bar-site-8000']
 
             result = self.role._update_init_script(website)
 
             self.assertTrue(result)
-            self.role.update_file.assert_called_once_with('website.init.template', '/etc/init.d/bar-site-8000', options={
+            self.role.update_files.assert_called_once_with([('website.init.template', '/etc/init.d/bar-site-8000', {
                 'pid_file_path': '/var/run',
                 'name': 'bar-site',
                 'threads': 1,
@@ -255,9 +255,8 @@ class DjangoRoleTest(ProvyTestCase):
                 'port': 8000,
                 'user': None,
                 'daemon': True
-            }, sudo=True, owner=None)
+            }, None, 755)], sudo=True)
             self.assertEqual(self.role.execute.mock_calls, [
-                call('chmod +x /etc/init.d/bar-site-8000', sudo=True, stdout=False),
                 call('update-rc.d bar-site-8000 defaults', sudo=True, stdout=False),
             ])
 
@@ -267,13 +266,13 @@ class DjangoRoleTest(ProvyTestCase):
             website.settings_path = '/foo/settings.py'
             website.auto_start = False
 
-        with self.mock_role_methods('execute', 'update_file'):
-            self.role.update_file.return_value = True
+        with self.mock_role_methods('execute', 'update_files'):
+            self.role.update_files.return_value = ['/etc/init.d/bar-site-8000']
 
             result = self.role._update_init_script(website)
 
             self.assertTrue(result)
-            self.role.update_file.assert_called_once_with('website.init.template', '/etc/init.d/bar-site-8000', options={
+            self.role.update_files.assert_called_once_with([('website.init.template', '/etc/init.d/bar-site-8000', {
                 'pid_file_path': '/var/run',
                 'name': 'bar-site',
                 'threads': 1,
@@ -282,23 +281,21 @@ class DjangoRoleTest(ProvyTestCase):
                 'port': 8000,
                 'user': None,
                 'daemon': True
-            }, sudo=True, owner=None)
-            self.assertEqual(self.role.execute.mock_calls, [
-                call('chmod +x /etc/init.d/bar-site-8000', sudo=True, stdout=False),
-            ])
+            }, None, 755)], sudo=True)
+            self.assertFalse(self.role.execute.called)
 
     @istest
     def doesnt_update_init_script_if_update_file_fails(self):
         with self.role.create_site('bar-site') as website:
             website.settings_path = '/foo/settings.py'
 
-        with self.mock_role_methods('execute', 'update_file'):
-            self.role.update_file.return_value = False
+        with self.mock_role_methods('execute', 'update_files'):
+            self.role.update_files.return_value = []
 
             result = self.role._update_init_script(website)
 
             self.assertFalse(result)
-            self.role.update_file.assert_called_once_with('website.init.template', '/etc/init.d/bar-site-8000', options={
+            self.role.update_files.assert_called_once_with([('website.init.template', '/etc/init.d/bar-site-8000', {
                 'pid_file_path': '/var/run',
                 'name': 'bar-site',
                 'threads': 1,
@@ -307,5 +304,5 @@ class DjangoRoleTest(ProvyTestCase):
                 'port': 8000,
                 'user': None,
                 'daemon': True
-            }, sudo=True, owner=None)
+            }, None, 755)], sudo=True)
             self.assertFalse(self.role.execute.called)
@@ -11,7 +11,14 @@ class HostsRoleTest(ProvyTestCase):
 
     @istest
     def ensures_a_host_line_exists_in_the_hosts_file(self):
-        with self.mock_role_method('ensure_line') as ensure_line:
+        with self.mock_role_method('ensure_lines') as ensure_lines:
             self.role.ensure_host('my-server', '0.0.0.0')
 
-            ensure_line.assert_called_once_with('0.0.0.0        my-server', '/etc/hosts', sudo=True)
+            ensure_lines.assert_called_once_with(['0.0.0.0        my-server'], '/etc/hosts', sudo=True)
+
+    @istest
+    def ensures_many_host_lines_with_a_single_command(self):
+        with self.mock_role_method('ensure_lines') as ensure_lines:
+            self.role.ensure_hosts([('db', '10.0.0.2'), ('cache', '10.0.0.3')])
+
+            ensure_lines.assert_called_once_with(['10.0.0.2        db', '10.0.0.3        cache'], '/etc/hosts', sudo=True)
@@ -36,6 +36,16 @@ class ProvyTestCase(TestCase):
         with patch('provy.core.roles.Role.execute') as execute:
             yield execute
 
+    @contextmanager
+    def execute_iter_mock(self):
+        '''
+        Mocks Role.execute_iter. Set the ``output`` attribute of the mock to the whole command output, and each call will iterate over its lines.
+        '''
+        with patch('provy.core.roles.Role.execute_iter') as execute_iter:
+            execute_iter.output = ''
+            execute_iter.side_effect = lambda *args, **kwargs: iter(execute_iter.output.splitlines())
+            yield execute_iter
+
     @contextmanager
     def mock_role_method(self, method):
         '''